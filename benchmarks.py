@@ -0,0 +1,366 @@
+"""Benchmarks for the market simulator.
+
+Run from the command line, e.g. `python benchmarks.py exposure`.
+
+`python benchmarks.py suite --output results.json` runs the benchmark suite: fixed-seed scenarios on the 200-node
+original layout, the directed one-way layout (with and without node capacity, with max_customers_in_store queueing and
+with scaled-up arrival rates) and on synthetic grid markets of 1k to 10k nodes. For every scenario it measures the time
+per simulated day and the peak RSS (each scenario runs in a fresh process), for every market the time to generate,
+save and load its path corpus, and for the original layout the parallel scaling efficiency of simulate_several_days.
+The results are written as JSON, together with the commit they were measured on. Compare two result files with
+`python benchmarks.py compare old.json new.json`.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import networkx as nx
+import numpy as np
+from covid19_supermarket_abm.utils.create_store_network import create_store_network
+
+import core
+from executors import PoolExecutor
+from path_corpus import PathCorpus, load_path_corpus, save_path_corpus
+from shortest_path_cache import compute_shortest_path_table
+from simulator import get_day_seeds, simulate_one_day, simulate_several_days
+import synthetic_path_gen
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Busy market where many buyers share a node at the same time
+crowded_config = {'arrival_rate': 20,
+                  'traversal_time': 3,
+                  'num_hours_open': 4,
+                  'infection_proportion': 0.128,
+                  'trace': 'off',
+                  }
+
+
+def create_grid_market(num_rows: int, num_cols: int, directed: bool = False) -> nx.Graph:
+    """Create a synthetic market whose nodes are arranged in a num_rows x num_cols grid."""
+    pos = {row * num_cols + col: (col, row) for row in range(num_rows) for col in range(num_cols)}
+    edges = [(row * num_cols + col, row * num_cols + col + 1) for row in range(num_rows) for col in range(num_cols - 1)]
+    edges += [(row * num_cols + col, (row + 1) * num_cols + col) for row in range(num_rows - 1) for col in range(num_cols)]
+    return create_store_network(pos, edges, directed=directed)
+
+
+def create_random_full_paths(G: nx.Graph, num_paths: int, num_stops: int = 5, entrance_node: int = 0,
+                             seed: int = 0):
+    """Create full paths that start and end at entrance_node and walk shortest paths between num_stops random nodes."""
+    rng = np.random.RandomState(seed)
+    nodes = list(G)
+    full_paths = []
+    for _ in range(num_paths):
+        stops = [entrance_node] + list(rng.choice(nodes, size=num_stops)) + [entrance_node]
+        path = [entrance_node]
+        for start, end in zip(stops[:-1], stops[1:]):
+            path += nx.shortest_path(G, start, end)[1:]
+        full_paths.append([int(node) for node in path])
+    return full_paths
+
+
+def paths_generator_from_list(all_paths):
+    num_paths = len(all_paths)
+    while True:
+        yield all_paths[np.random.randint(0, num_paths)]
+
+
+def time_one_day(config: dict, G: nx.Graph, path_generator_function, path_generator_args: list, seed: int):
+    """Run simulate_one_day with the given seed and return (seconds, results)."""
+    start_time = time.perf_counter()
+    results = simulate_one_day(config, G, path_generator_function, path_generator_args, seed=seed)
+    return time.perf_counter() - start_time, results
+
+
+def benchmark_exposure_accounting(config: dict = crowded_config, num_rows: int = 10, num_cols: int = 10,
+                                  num_repeats: int = 3, seed: int = 0):
+    """Compare pairwise and integral exposure accounting on a crowded grid market.
+    Both modes are run with the same seeds, so their exposure statistics should agree."""
+    G = create_grid_market(num_rows, num_cols)
+    full_paths = create_random_full_paths(G, 2000, seed=seed)
+    print(f'Grid market with {len(G)} nodes, config: {config}')
+    print(f'{"accounting":>10} {"sec/day":>8} {"speedup":>8} {"total_exposure_time":>20}')
+    reference_seconds = None
+    reference_results = None
+    for exposure_accounting in ['pairwise', 'integral']:
+        run_config = dict(config, exposure_accounting=exposure_accounting)
+        timings = []
+        for i in range(num_repeats):
+            seconds, results = time_one_day(run_config, G, paths_generator_from_list, [full_paths], seed + i)
+            timings.append(seconds)
+        seconds = min(timings)
+        if reference_results is None:
+            reference_seconds, reference_results = seconds, results
+        else:
+            assert np.isclose(results['total_exposure_time'], reference_results['total_exposure_time']), \
+                'Total exposure time differs between accounting modes'
+            assert np.allclose(results['exposure_times'], reference_results['exposure_times']), \
+                'Exposure times differ between accounting modes'
+        print(f'{exposure_accounting:>10} {seconds:8.3f} {reference_seconds / seconds:7.2f}x '
+              f'{results["total_exposure_time"]:20.4f}')
+
+
+# Config of the benchmark suite (the scenarios change some of its keys)
+suite_config = {'arrival_rate': 2.88,
+                'traversal_time': 0.49,
+                'num_hours_open': 12,
+                'infection_proportion': 0.128,
+                'trace': 'off',
+                }
+
+# Markets: the layouts of synthetic_path_gen.py (with synthetic paths) and num_rows x num_cols grids (with random
+# paths between random stops)
+suite_markets = {'original': {'layout': 'original', 'directed': False, 'num_paths': 100000},
+                 'oneway': {'layout': 'oneway', 'directed': True, 'num_paths': 100000},
+                 'grid_1k': {'num_rows': 32, 'num_cols': 32, 'num_paths': 200},
+                 'grid_4k': {'num_rows': 64, 'num_cols': 64, 'num_paths': 200},
+                 'grid_10k': {'num_rows': 100, 'num_cols': 100, 'num_paths': 200},
+                 }
+
+# Scenarios: (market, changes to suite_config)
+suite_scenarios = {'original': ('original', {}),
+                   'oneway': ('oneway', {}),
+                   'original_node_capacity': ('original', {'with_node_capacity': True, 'node_capacity': 4}),
+                   'oneway_node_capacity': ('oneway', {'with_node_capacity': True, 'node_capacity': 4}),
+                   'original_queueing': ('original', {'max_customers_in_store': 30, 'arrival_rate': 6}),
+                   'oneway_queueing': ('oneway', {'max_customers_in_store': 30, 'arrival_rate': 6}),
+                   'original_arrival_x2': ('original', {'arrival_rate': 2 * 2.88}),
+                   'original_arrival_x4': ('original', {'arrival_rate': 4 * 2.88}),
+                   'grid_1k': ('grid_1k', {'num_hours_open': 2}),
+                   'grid_4k': ('grid_4k', {'num_hours_open': 2}),
+                   'grid_10k': ('grid_10k', {'num_hours_open': 2}),
+                   }
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MB (None where it is not available).
+    On Linux, it is read from /proc, as ru_maxrss is inherited from the parent process across fork and exec."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if platform.system() == 'Darwin' else max_rss / 2 ** 10  # bytes on macOS, else KB
+
+
+def create_market_graph(market: str) -> nx.Graph:
+    spec = suite_markets[market]
+    if 'layout' in spec:
+        return synthetic_path_gen.create_layout_graph(spec['layout'], directed=spec['directed'])
+    return create_grid_market(spec['num_rows'], spec['num_cols'])
+
+
+def benchmark_corpus(market: str, corpus_path: str, seed: int = 0) -> dict:
+    """Generate the path corpus of market, save it to corpus_path and load it again, and time each step."""
+    spec = suite_markets[market]
+    G = create_market_graph(market)
+    timings = {'num_nodes': len(G), 'num_paths': spec['num_paths']}
+    start_time = time.perf_counter()
+    if 'layout' in spec:
+        shortest_path_table = compute_shortest_path_table(G)
+        timings['shortest_paths_sec'] = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        np.random.seed(seed)
+        corpus = synthetic_path_gen.generate_synthetic_corpus(
+            synthetic_path_gen.mu, synthetic_path_gen.sigma, synthetic_path_gen.entrance_nodes,
+            synthetic_path_gen.exit_nodes, synthetic_path_gen.item_nodes, shortest_path_table, spec['num_paths'])
+    else:
+        timings['shortest_paths_sec'] = 0.
+        corpus = PathCorpus.from_paths(create_random_full_paths(G, spec['num_paths'], seed=seed))
+    timings['generation_sec'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    save_path_corpus(corpus, corpus_path)
+    timings['save_sec'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    corpus = load_path_corpus(corpus_path)
+    timings['load_sec'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    core.StoreLayout(G).validate_paths(corpus)
+    timings['validation_sec'] = time.perf_counter() - start_time
+    timings['num_path_nodes'] = int(len(corpus.nodes))
+    timings['file_mb'] = os.path.getsize(corpus_path) / 2 ** 20
+    return timings
+
+
+def run_scenario(market: str, config: dict, corpus_path: str, num_days: int, seed: int = 0) -> dict:
+    """Simulate num_days days of a scenario in this process and measure the time per day and the peak RSS.
+    The days get the seeds of simulate_several_days(..., seed=seed)."""
+    G = core.StoreLayout(create_market_graph(market))
+    start_time = time.perf_counter()
+    corpus = load_path_corpus(corpus_path)
+    load_sec = time.perf_counter() - start_time
+    baseline_rss_mb = get_peak_rss_mb()
+    seconds = []
+    num_customers = []
+    for day, day_seed in enumerate(get_day_seeds(num_days, seed)):
+        start_time = time.perf_counter()
+        results = simulate_one_day(config, G, synthetic_path_gen.paths_generator_from_actual_paths, [corpus],
+                                   seed=day_seed, day=day, compact=True)
+        seconds.append(time.perf_counter() - start_time)
+        num_customers.append(int(results.scalars['num_cust'][0]))
+    seconds = np.array(seconds)
+    return {'market': market,
+            'num_nodes': len(G),
+            'config': config,
+            'num_days': num_days,
+            'sec_per_day': float(seconds.mean()),
+            'sec_per_day_median': float(np.median(seconds)),
+            'sec_per_day_min': float(seconds.min()),
+            'sec_first_day': float(seconds[0]),  # includes validating the corpus
+            'customers_per_day': float(np.mean(num_customers)),
+            'customers_per_sec': float(np.sum(num_customers) / seconds.sum()),
+            'corpus_load_sec': load_sec,
+            'baseline_rss_mb': baseline_rss_mb,
+            'peak_rss_mb': get_peak_rss_mb(),
+            }
+
+
+def benchmark_parallel_scaling(market: str, config: dict, corpus_path: str, num_days: int,
+                               process_counts: List[int], seed: int = 0) -> List[dict]:
+    """Time simulate_several_days with every number of processes in process_counts (including starting the pool).
+    The efficiency is the speedup over the first process count, divided by the relative number of processes."""
+    G = create_market_graph(market)
+    corpus = load_path_corpus(corpus_path)
+    rows = []
+    for num_processes in process_counts:
+        with PoolExecutor(num_processes) as executor:
+            start_time = time.perf_counter()
+            simulate_several_days(config, G, synthetic_path_gen.paths_generator_from_actual_paths, [corpus],
+                                  num_iterations=num_days, seed=seed, executor=executor)
+            seconds = time.perf_counter() - start_time
+        rows.append({'num_processes': num_processes, 'num_days': num_days, 'sec': seconds,
+                     'days_per_sec': num_days / seconds})
+    for row in rows:
+        speedup = rows[0]['sec'] / row['sec']
+        row['speedup'] = speedup
+        row['efficiency'] = speedup * rows[0]['num_processes'] / row['num_processes']
+    return rows
+
+
+def get_commit() -> Optional[str]:
+    """The git commit of this checkout (with a -dirty suffix if there are uncommitted changes), if any."""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        is_dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                                  capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if is_dirty else '')
+
+
+def run_benchmark_suite(output_path: str = 'benchmark_results.json', num_days: int = 10,
+                        scenarios: Optional[List[str]] = None, process_counts: Optional[List[int]] = None,
+                        num_parallel_days: int = 40, seed: int = 0) -> dict:
+    """
+    Run the benchmark suite and write its results to output_path as JSON.
+
+    :param num_days: Number of days per scenario
+    :param scenarios: Names of the scenarios to run (default: all of suite_scenarios)
+    :param process_counts: Numbers of processes of the parallel scaling benchmark (default: 1, 2, 4, ... up to the
+    number of cores). An empty list skips it.
+    :param num_parallel_days: Number of days of the parallel scaling benchmark
+    :param seed: Seed of the corpora and of the simulated days
+    """
+    scenarios = list(suite_scenarios) if scenarios is None else scenarios
+    for name in scenarios:
+        if name not in suite_scenarios:
+            raise ValueError(f'Unknown scenario == {name}')
+    if process_counts is None:
+        process_counts = [2 ** i for i in range(int(np.log2(multiprocessing.cpu_count())) + 1)]
+    benchmark_results = {'commit': get_commit(),
+                         'date': datetime.now().isoformat(timespec='seconds'),
+                         'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'cpu_count': multiprocessing.cpu_count(),
+                         'seed': seed,
+                         'corpora': {},
+                         'scenarios': {},
+                         'parallel_scaling': []}
+    markets = sorted({suite_scenarios[name][0] for name in scenarios} | ({'original'} if process_counts else set()),
+                     key=list(suite_markets).index)
+    # Every scenario runs in a fresh process, so that its peak RSS is its own
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        corpus_paths = {market: os.path.join(corpus_dir, f'{market}.corpus') for market in markets}
+        for market in markets:
+            print(f'Generating the corpus of {market}')
+            benchmark_results['corpora'][market] = benchmark_corpus(market, corpus_paths[market], seed=seed)
+        for name in scenarios:
+            market, changes = suite_scenarios[name]
+            print(f'Running {name}')
+            with context.Pool(1) as pool:
+                results = pool.apply(run_scenario, (market, dict(suite_config, **changes), corpus_paths[market],
+                                                    num_days, seed))
+            benchmark_results['scenarios'][name] = results
+            print(f'{name}: {results["sec_per_day"]:.3f} s/day, peak RSS {results["peak_rss_mb"]} MB')
+        if process_counts:
+            print(f'Parallel scaling with {process_counts} processes')
+            benchmark_results['parallel_scaling'] = benchmark_parallel_scaling(
+                'original', suite_config, corpus_paths['original'], num_parallel_days, process_counts, seed=seed)
+    with open(output_path, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+    print(f'Wrote {output_path}')
+    return benchmark_results
+
+
+def compare_benchmark_results(old_path: str, new_path: str) -> Dict[str, dict]:
+    """Print the time per day and peak RSS of the scenarios of two result files of run_benchmark_suite."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f'old: {old["commit"]} ({old["date"]})')
+    print(f'new: {new["commit"]} ({new["date"]})')
+    print(f'{"scenario":>24} {"old s/day":>10} {"new s/day":>10} {"ratio":>7} {"old MB":>8} {"new MB":>8}')
+    comparison = {}
+    for name, new_results in new['scenarios'].items():
+        if name not in old['scenarios']:
+            continue
+        old_results = old['scenarios'][name]
+        ratio = new_results['sec_per_day'] / old_results['sec_per_day']
+        comparison[name] = {'sec_per_day_ratio': ratio,
+                            'old_peak_rss_mb': old_results['peak_rss_mb'],
+                            'new_peak_rss_mb': new_results['peak_rss_mb']}
+        print(f'{name:>24} {old_results["sec_per_day"]:10.3f} {new_results["sec_per_day"]:10.3f} {ratio:7.2f} '
+              f'{old_results["peak_rss_mb"] or 0:8.1f} {new_results["peak_rss_mb"] or 0:8.1f}')
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the market simulator')
+    parser.add_argument('benchmark', choices=['exposure', 'suite', 'compare'])
+    parser.add_argument('files', nargs='*', help='compare: the old and the new result file')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help='suite: result file')
+    parser.add_argument('--days', type=int, default=10, help='suite: number of days per scenario')
+    parser.add_argument('--scenarios', nargs='+', help=f'suite: subset of {list(suite_scenarios)}')
+    parser.add_argument('--processes', type=int, nargs='*', help='suite: process counts of the parallel scaling')
+    parser.add_argument('--parallel-days', type=int, default=40, help='suite: number of days of the parallel scaling')
+    args = parser.parse_args()
+    if args.benchmark == 'exposure':
+        benchmark_exposure_accounting(num_repeats=args.repeats, seed=args.seed)
+    elif args.benchmark == 'suite':
+        run_benchmark_suite(args.output, num_days=args.days, scenarios=args.scenarios, process_counts=args.processes,
+                            num_parallel_days=args.parallel_days, seed=args.seed)
+    elif len(args.files) != 2:
+        parser.error('compare needs the old and the new result file')
+    else:
+        compare_benchmark_results(*args.files)
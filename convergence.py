@@ -0,0 +1,96 @@
+"""Online means and confidence intervals of daily statistics, used to stop a run once the estimates are precise enough
+(see simulator.simulate_until_converged).
+
+RunningStats keeps the number of days, the mean and the sum of squared deviations of a statistic (Welford's algorithm),
+and folds in a whole batch of days at once with the parallel update of Chan et al. The confidence interval of the mean
+uses the normal approximation, which is accurate for the number of days we run (min_days is 30 by default).
+"""
+from statistics import NormalDist
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+class RunningStats(object):
+    """Online mean and variance of a statistic."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.  # sum of squared deviations from the mean
+
+    def update(self, values):
+        """Fold a batch of values into the mean and variance."""
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        batch_count = len(values)
+        batch_mean = values.mean()
+        batch_m2 = ((values - batch_mean) ** 2).sum()
+        count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_count / count
+        self.m2 += batch_m2 + delta ** 2 * self.count * batch_count / count
+        self.count = count
+
+    @property
+    def variance(self) -> float:
+        """Sample variance (nan for fewer than two values)."""
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    def get_half_width(self, confidence: float = 0.95) -> float:
+        """Half-width of the confidence interval of the mean."""
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        return z * np.sqrt(self.variance / self.count) if self.count > 1 else np.inf
+
+
+class ConvergenceMonitor(object):
+    """Tracks the running statistics of target_stats and decides when all of them have converged, i.e. when the
+    half-width of every confidence interval is at most rel_tol times the absolute mean."""
+
+    def __init__(self, target_stats: List[str], rel_tol: float = 0.05, confidence: float = 0.95, min_days: int = 30):
+        """
+
+        :param target_stats: Scalar statistics of df_stats, e.g. ['num_contacts', 'total_exposure_time']
+        :param rel_tol: Relative tolerance of the confidence interval half-width
+        :param confidence: Confidence level of the intervals
+        :param min_days: Never stop before this many days
+        """
+        if not target_stats:
+            raise ValueError('At least one target stat is needed')
+        self.target_stats = list(target_stats)
+        self.rel_tol = rel_tol
+        self.confidence = confidence
+        self.min_days = min_days
+        self.running_stats: Dict[str, RunningStats] = {stat: RunningStats() for stat in self.target_stats}
+
+    def update(self, scalars: np.ndarray):
+        """Fold in a batch of days, given as a structured array of scalar stats (see results_collector.py)."""
+        for stat in self.target_stats:
+            if stat not in scalars.dtype.names:
+                raise ValueError(f'Unknown target stat == {stat}')
+            self.running_stats[stat].update(scalars[stat])
+
+    def is_converged(self, stat: str) -> bool:
+        running_stats = self.running_stats[stat]
+        return running_stats.get_half_width(self.confidence) <= self.rel_tol * abs(running_stats.mean)
+
+    def has_converged(self) -> bool:
+        """Whether at least min_days days were seen and every target stat has converged."""
+        num_days = self.running_stats[self.target_stats[0]].count
+        return num_days >= self.min_days and all(self.is_converged(stat) for stat in self.target_stats)
+
+    def get_report(self) -> pd.DataFrame:
+        """Number of days, mean, half-width, relative half-width and convergence of every target stat."""
+        rows = []
+        for stat, running_stats in self.running_stats.items():
+            half_width = running_stats.get_half_width(self.confidence)
+            rows.append({'stat': stat,
+                         'num_days': running_stats.count,
+                         'mean': running_stats.mean,
+                         'half_width': half_width,
+                         'rel_half_width': (half_width / abs(running_stats.mean) if running_stats.mean
+                                            else 0. if half_width == 0 else np.inf),
+                         'converged': self.is_converged(stat)})
+        return pd.DataFrame(rows).set_index('stat')
@@ -2,51 +2,163 @@ import datetime
 import logging
 import random
 import uuid
-from typing import List, Optional
+import weakref
+from collections import Counter
+from typing import List, Optional, Union
 
 import networkx as nx
 import numpy as np
 import simpy
 
+from path_corpus import PathCorpus, SharedPathCorpus
+from trace_sinks import NullTraceSink
+
+
+class StoreLayout(object):
+    """The parts of a store that do not change during a simulation: the store graph and lookups derived from it.
+    A layout is built once and shared by the stores of many days (see simulator.simulate_days_batch), which must not
+    modify it.
+
+    valid_next_nodes maps every node to the frozenset of nodes that a customer can move to from there: its
+    successors (all neighbours in an undirected store) and the node itself. validate_paths checks whole corpora of paths
+    against it at once, so that stores do not need to check every move of customers with such paths."""
+
+    def __init__(self, G: nx.Graph):
+        self.G = G
+        self.nodes = list(G)
+        self.node_bits = {node: 1 << i for i, node in enumerate(self.nodes)}
+        self.valid_next_nodes = {node: frozenset(G.neighbors(node)) | {node} for node in self.nodes}
+        self._validated_paths = weakref.WeakSet()  # corpora that passed validate_paths
+        self._last_validated_list = None  # lists have no weak references, so only the last one is remembered
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __getstate__(self) -> dict:
+        # The validated corpora are not sent along (a weakref.WeakSet cannot be pickled)
+        state = dict(self.__dict__, _last_validated_list=None)
+        del state['_validated_paths']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._validated_paths = weakref.WeakSet()
+
+    def is_valid_move(self, start: int, end: int) -> bool:
+        return end in self.valid_next_nodes.get(start, ())
+
+    def _get_valid_move_keys(self) -> Optional[np.ndarray]:
+        """Sorted array of start * num_keys + end of all valid moves, or None if the nodes are not non-negative
+        integers."""
+        if not all(isinstance(node, (int, np.integer)) and node >= 0 for node in self.nodes):
+            return None
+        num_keys = max(self.nodes) + 1
+        return np.sort(np.array([start * num_keys + end for start, next_nodes in self.valid_next_nodes.items()
+                                 for end in next_nodes], dtype=np.int64))
+
+    def validate_paths(self, paths, chunk_size: int = 2000000):
+        """Raise a ValueError if a path of paths (a PathCorpus, a SharedPathCorpus or a list of paths) has a move
+        that is not valid in the store graph. All moves of a PathCorpus are checked at once, in chunks of chunk_size
+        nodes. Every object is only checked once (for lists of paths: as long as no other list is checked)."""
+        if paths in self._validated_paths or paths is self._last_validated_list:
+            return
+        corpus = paths.get_corpus() if isinstance(paths, SharedPathCorpus) else paths
+        if not isinstance(corpus, PathCorpus):
+            corpus = PathCorpus.from_paths([[int(node) for node in path] for path in corpus])
+        valid_move_keys = self._get_valid_move_keys()
+        if valid_move_keys is None:
+            for i in range(len(corpus)):
+                path = corpus[i]
+                for start, end in zip(path[:-1], path[1:]):
+                    if not self.is_valid_move(start, end):
+                        raise ValueError(f'{start} -> {end} is not a valid transition in the graph! (path {i})')
+        else:
+            num_keys = max(self.nodes) + 1
+            # The last node of every path does not start a move
+            is_path_end = np.zeros(len(corpus.nodes), dtype=bool)
+            is_path_end[corpus.offsets[1:][corpus.path_lengths() > 0] - 1] = True
+            for chunk_start in range(0, max(len(corpus.nodes) - 1, 0), chunk_size):
+                chunk_end = min(chunk_start + chunk_size, len(corpus.nodes) - 1)
+                starts = corpus.nodes[chunk_start:chunk_end].astype(np.int64)
+                ends = corpus.nodes[chunk_start + 1:chunk_end + 1].astype(np.int64)
+                keys = starts * num_keys + ends
+                positions = np.minimum(np.searchsorted(valid_move_keys, keys), len(valid_move_keys) - 1)
+                is_invalid = (valid_move_keys[positions] != keys) | (starts >= num_keys) | (ends >= num_keys)
+                is_invalid &= ~is_path_end[chunk_start:chunk_end]
+                if np.any(is_invalid):
+                    j = np.flatnonzero(is_invalid)[0]
+                    i = np.searchsorted(corpus.offsets, chunk_start + j, side='right') - 1
+                    raise ValueError(f'{starts[j]} -> {ends[j]} is not a valid transition in the graph! (path {i})')
+        try:
+            self._validated_paths.add(paths)
+        except TypeError:
+            self._last_validated_list = paths
+
 
 class Store(object):
     """Store object that captures the state of the store"""
 
-    def __init__(self, env: simpy.Environment, G: nx.Graph, max_customers_in_store: Optional[int] = None,
+    def __init__(self, env: simpy.Environment, G: Union[nx.Graph, StoreLayout],
+                 max_customers_in_store: Optional[int] = None,
                  logging_enabled: bool = True,
-                 logger: Optional[logging._loggerClass] = None):
+                 logger: Optional[logging._loggerClass] = None,
+                 crowded_thres: int = 4):
         """
 
         :param env: Simpy environment on which the simulation runs
-        :param G: Store graph
+        :param G: Store graph, or a StoreLayout that is shared with other stores
         :param logging_enabled: Toggle to True to log all simulation outputs
         :param max_customers_in_store: Maximum number of customers in the store
+        :param crowded_thres: A node is crowded when at least this many customers are there
         """
-        self.G = G.copy()
-        self.customers_at_nodes = {node: [] for node in self.G}
-        self.infected_customers_at_nodes = {node: [] for node in self.G}
+        # The store never modifies G, so it is not copied
+        self.layout = G if isinstance(G, StoreLayout) else StoreLayout(G)
+        self.G = self.layout.G
+        self.check_moves = True
+        # Customers at every node, in order of arrival, in dicts that are used as ordered sets (O(1) membership and
+        # removal): all of them, and the infected and the susceptible ones
+        self.customers_at_nodes = {node: {} for node in self.G}
+        self.infected_customers_at_nodes = {node: {} for node in self.G}
+        self.susceptible_customers_at_nodes = {node: {} for node in self.G}
         self.customers = []
         self.infected_customers = []
         self.env = env
         self.number_encounters_with_infected = {}
         self.number_encounters_per_node = {node: 0 for node in self.G}
+        self.number_unique_visitors_per_node = {node: 0 for node in self.G}
+        self.node_bits = self.layout.node_bits
+        self.visited_nodes = {}  # maps customer in the store to a bitset (int) of the nodes that it has visited
         self.arrival_times = {}
         self.exit_times = {}
         self.shopping_times = {}
         self.waiting_times = {}
         self.customers_next_zone = {}  # maps customer to the next zone that it wants to go
+        # maps node to a counter of the next zones of the customers at that node
+        self.customers_heading_to = {node: Counter() for node in self.G}
+        self.capacity_wakeup = 'poll'
+        self.capacity_freed_events = {node: None for node in self.G}
         self.is_open = True
         self.is_closed_event = self.env.event()
         self.time_with_infected_per_customer = {}
         self.time_with_infected_per_node = {node: 0 for node in self.G}
         self.node_arrival_time_stamp = {}
         self.num_customers_waiting_outside = 0
-        self.total_time_crowded = 0
-        self.crowded_thres = 4
+        self.total_time_crowded = 0.
+        self.crowded_thres = crowded_thres
         self.node_is_crowded_since = {node: None for node in self.G}  # is None if not crowded, else it's the start time
+        self.time_crowded_per_node = np.zeros(len(self.layout))
+        # Same for nodes that are at capacity (with node capacity only)
+        self.node_is_at_capacity_since = {node: None for node in self.G}
+        self.time_at_capacity_per_node = np.zeros(len(self.layout))
+        self.num_blocked_moves_per_node = np.zeros(len(self.layout), dtype=np.int64)  # blocked because node is full
+        self.exposure_accounting = 'pairwise'
+        self.infected_time_integral = {node: 0 for node in self.G}  # time integral of number of infected at node
+        self.infected_time_integral_updated_at = {node: 0 for node in self.G}
+        self.infected_time_integral_at_arrival = {}  # maps susceptible customer to integral when it arrived at node
         self.logs = []
         self.logging_enabled = True
         self.logger = logger
+        self.trace_sink = NullTraceSink()  # records the path of every customer that enters (see trace_sinks.py)
 
         # Parameters
         self.node_capacity = np.inf
@@ -59,10 +171,22 @@ class Store(object):
         #     self.logging_enabled = False
         # else:
         #     self.logging_enabled = True
-        self.counter = simpy.Resource(self.env, capacity=self.max_customers_in_store)
+        if isinstance(self.env, simpy.Environment):
+            self.counter = simpy.Resource(self.env, capacity=self.max_customers_in_store)
+        else:
+            self.counter = None  # the event kernel queues customers outside itself
 
         # Stats recording
         self.stats = {}
+        # Number of customers in the store, and its exact history: from occupancy_times[i] on, there were
+        # occupancy_counts[i] customers in the store (the first num_occupancy_changes entries are used)
+        self.num_customers_in_store = 0
+        self.max_num_customers_in_store = 0
+        self.customer_time_in_store = 0.  # time integral of num_customers_in_store
+        self.occupancy_times = np.zeros(1024)
+        self.occupancy_counts = np.zeros(1024, dtype=np.int64)
+        self.num_occupancy_changes = 1
+        self.closing_time = None
 
     def open_store(self):
         assert len(self.customers) == 0, "Customers are already in the store before the store is open"
@@ -73,27 +197,117 @@ class Store(object):
         #          f'({self.num_customers_waiting_outside} are waiting outside')
         self.log(f'Market closed.')
         self.is_open = False
+        self.closing_time = self.env.now
         self.is_closed_event.succeed()
 
     def enable_node_capacity(self, node_capacity: int = 2):
         self.with_node_capacity = True
         self.node_capacity = node_capacity
 
+    def enable_prevalidated_paths(self):
+        """Do not check every move of a customer, as the paths of all customers have been checked already
+        (see StoreLayout.validate_paths)."""
+        self.check_moves = False
+
+    def enable_path_trace(self, trace_sink: NullTraceSink):
+        """Record the path of every customer that enters the store with trace_sink."""
+        self.trace_sink = trace_sink
+
+    def record_customer_path(self, customer_id: int, path_index: int, path: List[int]):
+        """Record that customer_id enters with the path_index-th path of the corpus (-1 if not from a corpus)."""
+        self.trace_sink.record(customer_id, path_index, path)
+
+    def enable_integral_exposure_accounting(self):
+        """Account exposure time with running integrals of the number of infected customers per node.
+        Each node keeps the time integral of the number of infected customers present. A susceptible customer
+        records the integral when it arrives and is credited the difference when it leaves, so arrivals and
+        departures cost O(1) instead of a loop over all co-located customers.
+        Totals agree with the pairwise accounting up to floating-point error once all customers have left."""
+        self.exposure_accounting = 'integral'
+
+    def enable_capacity_wakeup_events(self):
+        """Let customers that are blocked by a full node wait until a customer leaves that node (or a customer there
+        starts heading their way) instead of retrying after every random traversal time."""
+        self.capacity_wakeup = 'event'
+
+    def set_customer_next_zone(self, customer_id: int, node: int, next_zone: int):
+        """Record that the customer at node wants to go to next_zone next."""
+        heading_to = self.customers_heading_to[node]
+        if customer_id in self.customers_next_zone:
+            heading_to[self.customers_next_zone[customer_id]] -= 1
+        self.customers_next_zone[customer_id] = next_zone
+        heading_to[next_zone] += 1
+        if self.capacity_wakeup == 'event':
+            self._notify_capacity_waiters(node)
+
+    def wait_for_capacity(self, node: int) -> simpy.Event:
+        """Event that succeeds the next time a customer departs from node or changes its next zone there."""
+        event = self.capacity_freed_events[node]
+        if event is None:
+            event = self.env.event()
+            self.capacity_freed_events[node] = event
+        return event
+
+    def _notify_capacity_waiters(self, node: int):
+        event = self.capacity_freed_events[node]
+        if event is not None:
+            self.capacity_freed_events[node] = None
+            event.succeed()
+
+    def _update_heading_index(self, customer_id: int, node: int, increment: int):
+        if customer_id in self.customers_next_zone:
+            self.customers_heading_to[node][self.customers_next_zone[customer_id]] += increment
+
     def number_customers_in_store(self):
-        return sum([len(cus) for cus in list(self.customers_at_nodes.values())])
+        return self.num_customers_in_store
+
+    def _update_occupancy(self, change: int):
+        """Add change to the number of customers in the store and record it in the occupancy trace."""
+        now = self.env.now
+        i = self.num_occupancy_changes
+        self.customer_time_in_store += self.num_customers_in_store * (now - self.occupancy_times[i - 1])
+        self.num_customers_in_store += change
+        if self.num_customers_in_store > self.max_num_customers_in_store:
+            self.max_num_customers_in_store = self.num_customers_in_store
+        if i == len(self.occupancy_times):
+            self.occupancy_times = np.concatenate([self.occupancy_times, np.zeros(i)])
+            self.occupancy_counts = np.concatenate([self.occupancy_counts, np.zeros(i, dtype=np.int64)])
+        self.occupancy_times[i] = now
+        self.occupancy_counts[i] = self.num_customers_in_store
+        self.num_occupancy_changes = i + 1
+
+    def get_open_length(self) -> float:
+        """Time from opening until the store is closed and empty (or until now, if it is not)."""
+        if self.closing_time is None or self.num_customers_in_store > 0:
+            return float(self.env.now)
+        return float(max(self.closing_time, self.occupancy_times[self.num_occupancy_changes - 1]))
+
+    def get_occupancy_trace(self) -> (np.ndarray, np.ndarray):
+        """Times at which the number of customers in the store changed (starting with 0 at opening) and the numbers
+        of customers from then on."""
+        return (self.occupancy_times[:self.num_occupancy_changes].copy(),
+                self.occupancy_counts[:self.num_occupancy_changes].copy())
+
+    def get_mean_num_customers_in_store(self) -> float:
+        """Time-weighted mean of the number of customers in the store while it is open or not empty."""
+        open_length = self.get_open_length()
+        last_change = self.occupancy_times[self.num_occupancy_changes - 1]
+        customer_time = self.customer_time_in_store + self.num_customers_in_store * (open_length - last_change)
+        return customer_time / open_length if open_length > 0 else 0.
 
     def move_customer(self, customer_id: int, infected: bool, start: int, end: int) -> bool:
-        if self.check_valid_move(start, end):
+        if not self.check_moves or self.check_valid_move(start, end):
             if start == end:  # start == end
                 self._customer_wait(customer_id, start, infected)
                 # self.log(f'Customer {customer_id} stays at present location to buy something.')
                 has_moved = True
             elif self.with_node_capacity and len(self.customers_at_nodes[end]) >= self.node_capacity \
-                    and start not in [self.customers_next_zone[cust] for cust in self.customers_at_nodes[end]]:
-                # Wait if next node is occupied and doesn't work.
+                    and self.customers_heading_to[end][start] == 0:
+                # Wait if next node is occupied and nobody there wants to swap places with the customer.
                 # self.log(f'Customer {customer_id} is waiting at {start}, ' +
                 #          f'since the next node {end} is full. [{self.customers_at_nodes[end]}]')
                 self._customer_wait(customer_id, start, infected)
+                self.num_blocked_moves_per_node[end] += 1
                 has_moved = False
             else:
                 # self.log(f'Customer {customer_id} is moving from {start} to {end}.')
@@ -105,7 +319,7 @@ class Store(object):
         return has_moved
 
     def check_valid_move(self, start: int, end: int):
-        return self.G.has_edge(start, end) or start == end
+        return self.layout.is_valid_move(start, end)
 
     def add_customer(self, customer_id: int, start_node: int, infected: bool, wait: float):
         # self.log(f'New customer {customer_id} arrives at the store. ' +
@@ -119,11 +333,11 @@ class Store(object):
             self.time_with_infected_per_customer[customer_id] = 0
         else:
             self.infected_customers.append(customer_id)
+        self._update_occupancy(1)
         self._customer_arrival(customer_id, start_node, infected)
 
     def infect_other_customers_at_node(self, customer_id: int, node: int):
-        other_suspectible_customers = [other_customer for other_customer in self.customers_at_nodes[node] if
-                                       other_customer not in self.infected_customers_at_nodes[node]]
+        other_suspectible_customers = self.susceptible_customers_at_nodes[node]
         # if len(other_suspectible_customers) > 0:
             # self.log(
             #     f'Infected customer {customer_id} arrived in {node} and' +
@@ -145,17 +359,35 @@ class Store(object):
 
     def _customer_arrival(self, customer_id: int, node: int, infected: bool):
         """Process a customer arriving at a node."""
-        self.customers_at_nodes[node].append(customer_id)
+        if self.exposure_accounting == 'integral':
+            self._settle_exposure_on_arrival(customer_id, node, infected)
+        self.customers_at_nodes[node][customer_id] = None
         self.node_arrival_time_stamp[customer_id] = self.env.now
         if infected:
-            self.infected_customers_at_nodes[node].append(customer_id)
+            self.infected_customers_at_nodes[node][customer_id] = None
             self.infect_other_customers_at_node(customer_id, node)
         else:
             self.get_infected_by_other_customers_at_node(customer_id, node)
+            self.susceptible_customers_at_nodes[node][customer_id] = None
+        self._update_heading_index(customer_id, node, 1)
+        self._update_crowding_on_arrival(node)
+        self._record_visit(customer_id, node)
+
+    def _record_visit(self, customer_id: int, node: int):
+        """Count customer as a unique visitor of node if it has not been there before."""
+        visited_nodes = self.visited_nodes.get(customer_id, 0)
+        node_bit = self.node_bits[node]
+        if not visited_nodes & node_bit:
+            self.visited_nodes[customer_id] = visited_nodes | node_bit
+            self.number_unique_visitors_per_node[node] += 1
+
+    def _update_crowding_on_arrival(self, node: int):
         num_cust_at_node = len(self.customers_at_nodes[node])
         if num_cust_at_node >= self.crowded_thres and self.node_is_crowded_since[node] is None:
             # self.log(f'Node {node} has become crowded with {num_cust_at_node} customers here.')
             self.node_is_crowded_since[node] = self.env.now
+        if num_cust_at_node >= self.node_capacity and self.node_is_at_capacity_since[node] is None:
+            self.node_is_at_capacity_since[node] = self.env.now
 
     def _customer_wait(self, customer_id: int, node: int, infected: bool):
         if infected:
@@ -165,39 +397,85 @@ class Store(object):
 
     def _customer_departure(self, customer_id: int, node: int, infected: bool):
         """Process a customer departing from a node."""
-        self.customers_at_nodes[node].remove(customer_id)
-        if infected:
-            self.infected_customers_at_nodes[node].remove(customer_id)
-            s_customers = self.get_susceptible_customers_at_node(node)
+        if self.exposure_accounting == 'integral':
+            dt_with_infected = self._settle_exposure_on_departure(customer_id, node, infected)
+            if not infected:
+                self.time_with_infected_per_customer[customer_id] += dt_with_infected
+            del self.customers_at_nodes[node][customer_id]
+            if infected:
+                del self.infected_customers_at_nodes[node][customer_id]
+            else:
+                del self.susceptible_customers_at_nodes[node][customer_id]
+        elif infected:
+            del self.customers_at_nodes[node][customer_id]
+            del self.infected_customers_at_nodes[node][customer_id]
+            s_customers = self.susceptible_customers_at_nodes[node]
             for s_cust in s_customers:
                 dt_with_infected = self.env.now - max(self.node_arrival_time_stamp[s_cust],
                                                       self.node_arrival_time_stamp[customer_id])
                 self.time_with_infected_per_customer[s_cust] += dt_with_infected
                 self.time_with_infected_per_node[node] += dt_with_infected
         else:
+            del self.customers_at_nodes[node][customer_id]
+            del self.susceptible_customers_at_nodes[node][customer_id]
             i_customers = self.infected_customers_at_nodes[node]
             for i_cust in i_customers:
                 dt_with_infected = self.env.now - max(self.node_arrival_time_stamp[i_cust],
                                                       self.node_arrival_time_stamp[customer_id])
                 self.time_with_infected_per_customer[customer_id] += dt_with_infected
                 self.time_with_infected_per_node[node] += dt_with_infected
+        self._update_heading_index(customer_id, node, -1)
+        self._update_crowding_on_departure(node)
+        if self.capacity_wakeup == 'event':
+            self._notify_capacity_waiters(node)
+
+    def _advance_infected_time_integral(self, node: int) -> float:
+        """Bring the infected-present time integral of node up to the current time and return it.
+        Must be called before the number of infected customers at node changes."""
+        now = self.env.now
+        self.infected_time_integral[node] += len(self.infected_customers_at_nodes[node]) * \
+            (now - self.infected_time_integral_updated_at[node])
+        self.infected_time_integral_updated_at[node] = now
+        return self.infected_time_integral[node]
+
+    def _settle_exposure_on_arrival(self, customer_id: int, node: int, infected: bool):
+        integral = self._advance_infected_time_integral(node)
+        if not infected:
+            self.infected_time_integral_at_arrival[customer_id] = integral
 
+    def _settle_exposure_on_departure(self, customer_id: int, node: int, infected: bool) -> float:
+        """Return the time a susceptible customer spent with infected customers at node since arriving there
+        and add it to the node total (returns 0 for infected customers)."""
+        integral = self._advance_infected_time_integral(node)
+        if infected:
+            return 0
+        dt_with_infected = integral - self.infected_time_integral_at_arrival.pop(customer_id)
+        self.time_with_infected_per_node[node] += dt_with_infected
+        return dt_with_infected
+
+    def _update_crowding_on_departure(self, node: int):
         num_cust_at_node = len(self.customers_at_nodes[node])
         if self.node_is_crowded_since[node] is not None and num_cust_at_node < self.crowded_thres:
             # Node is no longer crowded
             total_time_crowded_at_node = self.env.now - self.node_is_crowded_since[node]
             self.total_time_crowded += total_time_crowded_at_node
+            self.time_crowded_per_node[node] += total_time_crowded_at_node
             # self.log(
             #     f'Node {node} is no longer crowded ({num_cust_at_node} customers here. ' +
             #     f'Total time crowded: {total_time_crowded_at_node:.2f}')
             self.node_is_crowded_since[node] = None
+        if self.node_is_at_capacity_since[node] is not None and num_cust_at_node < self.node_capacity:
+            self.time_at_capacity_per_node[node] += self.env.now - self.node_is_at_capacity_since[node]
+            self.node_is_at_capacity_since[node] = None
 
     def get_susceptible_customers_at_node(self, node):
-        return [c for c in self.customers_at_nodes[node] if c not in self.infected_customers_at_nodes[node]]
+        return list(self.susceptible_customers_at_nodes[node])
 
     def remove_customer(self, customer_id: int, last_position: int, infected: bool):
         """Remove customer at exit."""
         self._customer_departure(customer_id, last_position, infected)
+        self._update_occupancy(-1)
+        self.visited_nodes.pop(customer_id, None)
         self.exit_times[customer_id] = self.env.now
         self.node_arrival_time_stamp[customer_id] = self.env.now
         self.shopping_times[customer_id] = self.exit_times[customer_id] - self.arrival_times[customer_id]
@@ -219,7 +497,7 @@ class Store(object):
 
 
 def customer(env: simpy.Environment, customer_id: int, infected: bool, store: Store, path: List[int],
-             traversal_time: float, thres: int = 50):
+             traversal_time: float, thres: int = 50, path_index: int = -1):
     """
     Simpy process simulating a single customer
 
@@ -231,6 +509,7 @@ def customer(env: simpy.Environment, customer_id: int, infected: bool, store: St
     :param traversal_time: Mean time before moving to the next node in path (also called waiting time)
     :param thres: Threshold length of queue outside. If queue exceeds threshold, customer does not enter
     the queue and leaves.
+    :param path_index: Index of path in the path corpus (-1 if it does not come from a corpus)
     """
     
     arrive = env.now
@@ -253,26 +532,24 @@ def customer(env: simpy.Environment, customer_id: int, infected: bool, store: St
 
         if my_turn_to_enter in result:
             #store.log(f'Customer {customer_id} enters the shop after waiting {wait :.2f} min with shopping path {path}.')
-            store.log(f'{path}')
+            store.record_customer_path(customer_id, path_index, path)
             start_node = path[0]
             store.add_customer(customer_id, start_node, infected, wait)
             for start, end in zip(path[:-1], path[1:]):
-                store.customers_next_zone[customer_id] = end
+                store.set_customer_next_zone(customer_id, start, end)
                 has_moved = False
+                is_blocked = False
                 while not has_moved:  # If it hasn't moved, wait a bit
-                    yield env.timeout(random.expovariate(1 / traversal_time))
+                    if is_blocked and store.capacity_wakeup == 'event':
+                        yield store.wait_for_capacity(end)
+                    else:
+                        yield env.timeout(random.expovariate(1 / traversal_time))
                     has_moved = store.move_customer(customer_id, infected, start, end)
+                    is_blocked = True
             yield env.timeout(random.expovariate(1 / traversal_time))  # wait before leaving the store
             store.remove_customer(customer_id, path[-1], infected)
 
 
-def _stats_recorder(store: Store):
-    store.stats['num_customers_in_store'] = {}
-    env = store.env
-    while store.is_open or store.number_customers_in_store() > 0:
-        store.stats['num_customers_in_store'][env.now] = store.number_customers_in_store()
-        yield env.timeout(10)
-
 def _customer_arrivals(env: simpy.Environment, store: Store, path_generator, config: dict):
     """Process that creates all customers."""
     arrival_rate = config['arrival_rate']
@@ -285,7 +562,8 @@ def _customer_arrivals(env: simpy.Environment, store: Store, path_generator, con
     while env.now < num_hours_open * 60:
         infected = np.random.rand() < infection_proportion
         path = path_generator.__next__()
-        env.process(customer(env, customer_id, infected, store, path, traversal_time))
+        path_index = getattr(path_generator, 'last_index', -1)
+        env.process(customer(env, customer_id, infected, store, path, traversal_time, path_index=path_index))
         customer_id += 1
         yield env.timeout(random.expovariate(arrival_rate))
     store.close_store()
@@ -314,7 +592,7 @@ def _sanity_checks(store: Store,
             'Some customers are not recorded in waiting times (or vice versa)'
         assert all([val >= 0 for val in store.waiting_times.values()]), \
             'Some waiting times are negative!'
-        actual_max_customer_in_store = max(store.stats['num_customers_in_store'].values())
+        actual_max_customer_in_store = store.max_num_customers_in_store
         assert actual_max_customer_in_store <= store.max_customers_in_store, \
             f'Somehow more people were in the store than allowed ' + \
             f'(Allowed: {store.max_customers_in_store} | Actual: {actual_max_customer_in_store})'
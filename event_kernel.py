@@ -0,0 +1,143 @@
+"""SimPy-free discrete-event kernel for the market model.
+
+Customers are not generator processes here. Every pending event is a compact tuple (time, seq, kind, customer_id)
+in a single heapq, and each customer is a small state machine that remembers its path and position in the path.
+The kernel reproduces the semantics of core._customer_arrivals and core.customer:
+queueing outside when the store is full (store.counter), balking when more than thres customers are waiting,
+node capacity (including event-driven wakeups) and sending away the queue when the store closes.
+The random numbers are drawn in a different order than with SimPy, so results only agree statistically.
+"""
+import heapq
+import random
+from collections import deque
+from itertools import count
+
+import numpy as np
+
+# Event kinds
+ARRIVAL = 0  # next customer arrives at the store
+MOVE = 1  # customer tries to move to the next node in its path
+EXIT = 2  # customer leaves the store
+
+
+class WakeupEvent(object):
+    """Stand-in for simpy.Event: customers waiting on it retry their move when it succeeds."""
+
+    def __init__(self, env):
+        self.env = env
+        self.customers = []
+
+    def succeed(self):
+        for customer_id in self.customers:
+            self.env.schedule(0, MOVE, customer_id)
+        self.customers = []
+
+
+class EventQueueEnvironment(object):
+    """Stand-in for simpy.Environment: a clock and a heap of (time, seq, kind, customer_id) events."""
+
+    def __init__(self):
+        self.now = 0
+        self.queue = []
+        self.num_processed_events = 0
+        self._seq = count()
+
+    def event(self) -> WakeupEvent:
+        return WakeupEvent(self)
+
+    def schedule(self, delay: float, kind: int, customer_id: int = -1):
+        heapq.heappush(self.queue, (self.now + delay, next(self._seq), kind, customer_id))
+
+
+def run_one_day(store, path_generator, config: dict, until: float, thres: int = 50):
+    """
+    Simulate one day on the event kernel.
+
+    :param store: Store object whose env is an EventQueueEnvironment
+    :param path_generator: Iterator of customer shopping paths
+    :param config: Simulation config (see simulator.simulate_one_day)
+    :param until: Time at which the simulation stops
+    :param thres: Threshold length of queue outside. If queue exceeds threshold, customer does not enter
+    the queue and leaves.
+    """
+    env = store.env
+    arrival_rate = config['arrival_rate']
+    num_hours_open = config['num_hours_open']
+    infection_proportion = config['infection_proportion']
+    mean_traversal_rate = 1 / config['traversal_time']
+    expovariate = random.expovariate
+    schedule = env.schedule
+    queue = env.queue
+
+    # Customer state
+    paths = []
+    path_indices = []
+    is_infected = []
+    positions = []  # index of the current node in the path
+    queue_arrival_times = []
+    waiting_outside = deque()
+    num_customers_admitted = 0
+
+    def enter(customer_id: int):
+        path = paths[customer_id]
+        store.num_customers_waiting_outside -= 1
+        store.record_customer_path(customer_id, path_indices[customer_id], path)
+        store.add_customer(customer_id, path[0], is_infected[customer_id], env.now - queue_arrival_times[customer_id])
+        if len(path) > 1:
+            store.set_customer_next_zone(customer_id, path[0], path[1])
+            schedule(expovariate(mean_traversal_rate), MOVE, customer_id)
+        else:
+            schedule(expovariate(mean_traversal_rate), EXIT, customer_id)
+
+    store.open_store()
+    schedule(expovariate(arrival_rate), ARRIVAL)
+    num_events = 0
+    while queue and queue[0][0] < until:
+        now, _, kind, customer_id = heapq.heappop(queue)
+        env.now = now
+        num_events += 1
+        if kind == MOVE:
+            path = paths[customer_id]
+            position = positions[customer_id]
+            start = path[position]
+            end = path[position + 1]
+            if store.move_customer(customer_id, is_infected[customer_id], start, end):
+                position += 1
+                positions[customer_id] = position
+                if position == len(path) - 1:
+                    schedule(expovariate(mean_traversal_rate), EXIT, customer_id)
+                else:
+                    store.set_customer_next_zone(customer_id, end, path[position + 1])
+                    schedule(expovariate(mean_traversal_rate), MOVE, customer_id)
+            elif store.capacity_wakeup == 'event':
+                store.wait_for_capacity(end).customers.append(customer_id)
+            else:
+                schedule(expovariate(mean_traversal_rate), MOVE, customer_id)
+        elif kind == EXIT:
+            store.remove_customer(customer_id, paths[customer_id][-1], is_infected[customer_id])
+            num_customers_admitted -= 1
+            if waiting_outside:
+                num_customers_admitted += 1
+                enter(waiting_outside.popleft())
+        elif kind == ARRIVAL:
+            if now >= num_hours_open * 60:
+                store.close_store()
+                # Customers in the queue leave, as the shop is closed
+                store.num_customers_waiting_outside -= len(waiting_outside)
+                waiting_outside.clear()
+                continue
+            customer_id = len(paths)
+            is_infected.append(np.random.rand() < infection_proportion)
+            paths.append(path_generator.__next__())
+            path_indices.append(getattr(path_generator, 'last_index', -1))
+            positions.append(0)
+            queue_arrival_times.append(now)
+            if store.num_customers_waiting_outside <= thres:
+                store.num_customers_waiting_outside += 1
+                if num_customers_admitted < store.max_customers_in_store:
+                    num_customers_admitted += 1
+                    enter(customer_id)
+                else:
+                    waiting_outside.append(customer_id)
+            schedule(expovariate(arrival_rate), ARRIVAL)
+    env.num_processed_events += num_events
@@ -0,0 +1,343 @@
+"""Executors run the days of simulate_several_days, simulate_until_converged and sweeps (see sweep.py).
+
+Every run first initializes the workers once, with initializer(*initargs) (e.g. to hand them the store network and the
+path corpus), and then maps a function over small tasks (e.g. (day, seed)). Tasks carry their own seeds, so a task
+gives the same result on any worker and can simply be run again if it fails. Results arrive in any order and are
+merged by the caller (e.g. by day in a ResultsCollector).
+
+- InProcessExecutor: runs everything in the calling process.
+- PoolExecutor: a multiprocessing.Pool on this machine (what use_parallel=True uses), which is kept for all runs.
+  The initializer and initargs of a run are written to a temporary file once, and every worker reads them from there.
+- SocketExecutor: worker processes on any number of machines connect to a coordinator over TCP
+  (multiprocessing.connection, authenticated with authkey) and receive chunks of tasks. Failed chunks (an exception,
+  a lost connection or a timeout) are retried on another worker up to max_retries times. Start a worker on another
+  machine from a checkout of this repository with
+
+      python executors.py worker --host <coordinator host> --port <port> --authkey <key>
+
+  Workers need the same Python packages, and corpus files (PathCorpus loaded from a file) at the same path. With
+  num_local_workers, the executor starts that many worker processes on this machine itself, e.g. for testing.
+
+An executor can be used for several runs; shut it down when it is no longer needed (or use it as a context manager).
+"""
+import argparse
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing.connection import Client, Listener, wait
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+
+class Executor(object):
+    """Interface of the executors."""
+    # Whether workers share memory with this process, so that a PathCorpus can be moved to shared memory
+    shares_memory = False
+
+    @property
+    def num_workers(self) -> int:
+        return 1
+
+    def start(self, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        """Start a run. Every worker calls initializer(*initargs) before its first task of the run."""
+        raise NotImplementedError
+
+    def imap_unordered(self, function: Callable, tasks: Iterable, chunksize: int = 1) -> Iterator:
+        """Yield function(task) for every task, in order of completion."""
+        raise NotImplementedError
+
+    def finish(self):
+        """End the run."""
+        pass
+
+    def shutdown(self):
+        """Release the workers."""
+        self.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class InProcessExecutor(Executor):
+    """Runs all tasks in this process, in order."""
+
+    def start(self, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def imap_unordered(self, function: Callable, tasks: Iterable, chunksize: int = 1) -> Iterator:
+        for task in tasks:
+            yield function(task)
+
+
+# Init file of the PoolExecutor run that this pool worker has been initialized for, set by _run_pool_task
+_pool_worker_init_file = None
+
+
+def _run_pool_task(init_file_path: str, function: Callable, task):
+    """function(task) in a pool worker, which first runs the initializer of the run in init_file_path if it has not
+    yet."""
+    global _pool_worker_init_file
+    if _pool_worker_init_file != init_file_path:
+        with open(init_file_path, 'rb') as f:
+            initializer, initargs = pickle.load(f)
+        if initializer is not None:
+            initializer(*initargs)
+        _pool_worker_init_file = init_file_path
+    return function(task)
+
+
+class PoolExecutor(Executor):
+    """Runs the tasks on a multiprocessing.Pool of num_processes processes (default: one per core).
+    The pool is started with the first run and kept until shutdown(). As a pool cannot send a message to every
+    worker, start() pickles the initializer and initargs of the run to a temporary file, and chunks of tasks only
+    carry its path: every worker loads the file and runs the initializer once, before its first task of the run."""
+    shares_memory = True
+
+    def __init__(self, num_processes: Optional[int] = None):
+        self.num_processes = num_processes or multiprocessing.cpu_count()
+        self.pool = None
+        self.init_file_path = None
+
+    @property
+    def num_workers(self) -> int:
+        return self.num_processes
+
+    def start(self, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        self.finish()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.num_processes)
+        fd, self.init_file_path = tempfile.mkstemp(prefix='pool_init_', suffix='.pickle')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((initializer, initargs), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _get_task_function(self, function: Callable) -> Callable:
+        """function, run by a worker that has been initialized for the current run."""
+        assert self.init_file_path is not None, 'start() the run first'
+        return functools.partial(_run_pool_task, self.init_file_path, function)
+
+    def imap_unordered(self, function: Callable, tasks: Iterable, chunksize: int = 1) -> Iterator:
+        return self.pool.imap_unordered(self._get_task_function(function), tasks, chunksize=chunksize)
+
+    def finish(self):
+        """Delete the init file of the run."""
+        if self.init_file_path is not None:
+            os.remove(self.init_file_path)
+            self.init_file_path = None
+
+    def shutdown(self):
+        """Stop the pool."""
+        self.finish()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def run_worker(address: Tuple[str, int], authkey: bytes):
+    """Connect to a SocketExecutor at address and run the tasks it sends until it stops the worker."""
+    with Client(address, authkey=authkey) as conn:
+        logging.info(f'Worker {os.getpid()} connected to {address}.')
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == 'init':
+                _, initializer, initargs = message
+                if initializer is not None:
+                    initializer(*initargs)
+            elif message[0] == 'task':
+                _, chunk_key, function, chunk = message
+                try:
+                    reply = ('result', chunk_key, [function(task) for task in chunk])
+                except Exception:
+                    reply = ('error', chunk_key, traceback.format_exc())
+                conn.send(reply)
+            elif message[0] == 'stop':
+                break
+            else:
+                raise ValueError(f'Unknown message == {message[0]}')
+
+
+class SocketExecutor(Executor):
+    """Coordinator that sends chunks of tasks to workers connected over TCP (see the module docstring)."""
+
+    def __init__(self, address: Tuple[str, int] = ('0.0.0.0', 0), authkey: Optional[bytes] = None,
+                 num_local_workers: int = 0, max_retries: int = 2, task_timeout: Optional[float] = None,
+                 connect_timeout: float = 60):
+        """
+
+        :param address: (host, port) to listen on. Port 0 picks a free port (see self.address).
+        :param authkey: Shared secret of the coordinator and the workers (default: random, for local workers only)
+        :param num_local_workers: Number of worker processes to start on this machine
+        :param max_retries: Number of times a failed chunk of tasks is run again before the run is aborted
+        :param task_timeout: Seconds after which a chunk that has not returned is given to another worker
+        (the slow worker is dropped)
+        :param connect_timeout: Seconds to wait for a first worker to connect
+        """
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.max_retries = max_retries
+        self.task_timeout = task_timeout
+        self.connect_timeout = connect_timeout
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        self._new_connections = queue.Queue()
+        self._accept_thread = threading.Thread(target=self._accept_connections, daemon=True)
+        self._accept_thread.start()
+        self.connections = []
+        self.initialized = set()
+        self.init_message = ('init', None, ())
+        self.num_maps = 0  # chunks are sent as (number of the imap_unordered call, chunk_id)
+        self.local_workers = []
+        for _ in range(num_local_workers):
+            process = multiprocessing.Process(target=run_worker, args=(self.address, self.authkey), daemon=True)
+            process.start()
+            self.local_workers.append(process)
+        logging.info(f'Waiting for workers on {self.address}.')
+
+    def _accept_connections(self):
+        while True:
+            try:
+                self._new_connections.put(self.listener.accept())
+            except OSError:
+                break  # the listener was closed
+            except Exception:
+                logging.warning(f'Rejected a worker:\n{traceback.format_exc()}')
+
+    @property
+    def num_workers(self) -> int:
+        return max(len(self.connections), len(self.local_workers), 1)
+
+    def _add_new_workers(self, timeout: Optional[float] = None):
+        """Add the workers that have connected since the last call (wait up to timeout seconds for one)."""
+        try:
+            conn = self._new_connections.get(timeout=timeout) if timeout else self._new_connections.get_nowait()
+            while True:
+                self.connections.append(conn)
+                conn = self._new_connections.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _drop(self, conn):
+        if conn in self.connections:
+            self.connections.remove(conn)
+        self.initialized.discard(conn)
+        conn.close()
+
+    def _send(self, conn, message) -> bool:
+        """Send a message, initializing the worker first if it has not seen this run. False if the worker is gone."""
+        try:
+            if conn not in self.initialized:
+                conn.send(self.init_message)
+                self.initialized.add(conn)
+            conn.send(message)
+            return True
+        except OSError:
+            self._drop(conn)
+            return False
+
+    def start(self, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        self.init_message = ('init', initializer, initargs)
+        self.initialized = set()
+
+    def imap_unordered(self, function: Callable, tasks: Iterable, chunksize: int = 1) -> Iterator:
+        self.num_maps += 1
+        map_id = self.num_maps
+        tasks = list(tasks)
+        chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+        pending = deque(range(len(chunks)))
+        num_attempts = [0] * len(chunks)
+        busy = {}  # conn -> (chunk_id, time sent)
+        done = set()
+
+        def retry(chunk_id: int, error: str):
+            num_attempts[chunk_id] += 1
+            if num_attempts[chunk_id] > self.max_retries:
+                raise RuntimeError(f'Task chunk {chunk_id} failed {num_attempts[chunk_id]} times:\n{error}')
+            logging.warning(f'Retrying task chunk {chunk_id}:\n{error}')
+            pending.append(chunk_id)
+
+        while len(done) < len(chunks):
+            self._add_new_workers()
+            if not self.connections:
+                self._add_new_workers(timeout=self.connect_timeout)
+                if not self.connections:
+                    raise RuntimeError(f'No worker connected to {self.address} within {self.connect_timeout} s')
+            for conn in [conn for conn in self.connections if conn not in busy]:
+                if not pending:
+                    break
+                chunk_id = pending.popleft()
+                if self._send(conn, ('task', (map_id, chunk_id), function, chunks[chunk_id])):
+                    busy[conn] = (chunk_id, time.monotonic())
+                else:
+                    retry(chunk_id, 'Worker disconnected')
+            for conn in wait(list(busy), timeout=1):
+                chunk_id, time_sent = busy.pop(conn)
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    self._drop(conn)
+                    retry(chunk_id, 'Worker disconnected')
+                    continue
+                if message[1] != (map_id, chunk_id):
+                    # Late reply to a chunk of an earlier call that was abandoned; the worker is still busy
+                    busy[conn] = (chunk_id, time_sent)
+                elif message[0] == 'result':
+                    if chunk_id not in done:
+                        done.add(chunk_id)
+                        yield from message[2]
+                else:
+                    retry(chunk_id, message[2])
+            if self.task_timeout is not None:
+                now = time.monotonic()
+                for conn, (chunk_id, time_sent) in list(busy.items()):
+                    if now - time_sent > self.task_timeout:
+                        del busy[conn]
+                        self._drop(conn)
+                        retry(chunk_id, f'No result after {self.task_timeout} s')
+
+    def shutdown(self):
+        """Stop all workers and the listener."""
+        self._add_new_workers()
+        for conn in list(self.connections):
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+            self._drop(conn)
+        self.listener.close()
+        for process in self.local_workers:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.local_workers = []
+
+
+def get_executor(use_parallel: bool = False, executor: Optional[Executor] = None) -> Executor:
+    """The executor to use: executor if it is given, else a PoolExecutor with use_parallel=True, else an
+    InProcessExecutor."""
+    if executor is not None:
+        return executor
+    return PoolExecutor() if use_parallel else InProcessExecutor()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a worker for a SocketExecutor.')
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('--host', required=True)
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--authkey', required=True)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    run_worker((args.host, args.port), args.authkey.encode())
@@ -0,0 +1,191 @@
+"""Opt-in instrumentation of simulate_one_day, to see where the time of a day goes.
+
+Set 'instrument': True in the config to add these scalar stats to the results of every day (and so to df_stats):
+
+- time_setup: creating the store and the path generator and validating the corpus (seconds)
+- time_simulation: running the event loop, which includes the following four phases
+- time_path_generation: drawing the shopping paths of the customers
+- time_move: Store.move_customer, which includes the node updates of the moves
+- time_node_updates: customers arriving at, waiting at and departing from nodes, i.e. the contact and exposure
+  accounting and the crowding and occupancy counters
+- time_trace: recording the paths of the customers and writing the trace at the end of the day
+- time_results: building the results of the day
+- num_events: number of events processed by the engine (SimPy events or event_kernel queue entries)
+- num_move_attempts: number of calls of Store.move_customer
+- num_move_retries: number of move attempts that were blocked by a full node (and retried)
+- customers_per_sec and events_per_sec: throughput of the event loop
+
+The timers wrap the methods of the store, the environment and the path generator of that day only, so nothing is
+measured (and nothing costs time) when instrument is off. They do add some overhead to the phases they measure, so
+compare timings of instrumented runs with each other.
+
+Set 'profile_dir' in the config to also run every day under cProfile. Every process accumulates the profile of all
+its days and writes it to profile_dir/profile_<pid>.pstats once at the end of every batch of days (simulate_days_batch)
+or of a day simulated on its own, also if it fails (read it with pstats.Stats).
+"""
+import contextlib
+import cProfile
+import functools
+import os
+import time
+from typing import Optional, Union
+
+import simpy
+
+phases = ['setup', 'simulation', 'path_generation', 'move', 'node_updates', 'trace', 'results']
+
+_worker_profiler: Optional[cProfile.Profile] = None
+_worker_profile_depth = 0  # number of open worker_profile blocks
+
+
+class NullInstrumentation(object):
+    """Measures nothing."""
+
+    def start(self, phase: str):
+        pass
+
+    def stop(self, phase: str):
+        pass
+
+    def instrument_store(self, store):
+        pass
+
+    def instrument_env(self, env):
+        pass
+
+    def instrument_path_generator(self, path_generator):
+        return path_generator
+
+    def get_results(self, store, num_cust: int) -> dict:
+        """Entries to add to the results of the day."""
+        return {}
+
+
+class _TimedPathGenerator(object):
+    """Path generator that adds the time of every draw to a phase of a DayInstrumentation."""
+
+    def __init__(self, path_generator, instrumentation: 'DayInstrumentation'):
+        self.path_generator = path_generator
+        self.instrumentation = instrumentation
+
+    @property
+    def last_index(self) -> int:
+        return getattr(self.path_generator, 'last_index', -1)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        path = self.path_generator.__next__()
+        self.instrumentation.times['path_generation'] += time.perf_counter() - start
+        return path
+
+
+class DayInstrumentation(NullInstrumentation):
+    """Phase timers and counters of one simulated day."""
+
+    def __init__(self):
+        self.times = {phase: 0. for phase in phases}
+        self.started_at = {}
+        self.num_events = 0
+        self.num_move_attempts = 0
+
+    def start(self, phase: str):
+        self.started_at[phase] = time.perf_counter()
+
+    def stop(self, phase: str):
+        """Add the time since start(phase) to phase."""
+        self.times[phase] += time.perf_counter() - self.started_at.pop(phase)
+
+    def _wrap(self, obj, method_name: str, phase: str, counter: Optional[str] = None):
+        """Replace obj.method_name by a wrapper that adds its time to phase (and counts its calls in counter)."""
+        method = getattr(obj, method_name)
+        times = self.times
+
+        @functools.wraps(method)
+        def timed_method(*args, **kwargs):
+            if counter is not None:
+                setattr(self, counter, getattr(self, counter) + 1)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                times[phase] += time.perf_counter() - start
+
+        setattr(obj, method_name, timed_method)
+
+    def instrument_store(self, store):
+        """Time the moves, node updates and path records of store."""
+        self._wrap(store, 'move_customer', 'move', counter='num_move_attempts')
+        for method_name in ['_customer_arrival', '_customer_wait', '_customer_departure']:
+            self._wrap(store, method_name, 'node_updates')
+        self._wrap(store, 'record_customer_path', 'trace')
+
+    def instrument_env(self, env: Union[simpy.Environment, object]):
+        """Count the events that a SimPy environment processes (event_kernel counts its events itself)."""
+        if isinstance(env, simpy.Environment):
+            step = env.step
+
+            def counted_step():
+                self.num_events += 1
+                step()
+
+            env.step = counted_step
+
+    def instrument_path_generator(self, path_generator) -> _TimedPathGenerator:
+        return _TimedPathGenerator(path_generator, self)
+
+    def get_results(self, store, num_cust: int) -> dict:
+        num_events = getattr(store.env, 'num_processed_events', self.num_events)
+        simulation_time = self.times['simulation']
+        results = {f'time_{phase}': seconds for phase, seconds in self.times.items()}
+        results.update({'num_events': num_events,
+                        'num_move_attempts': self.num_move_attempts,
+                        'num_move_retries': int(store.num_blocked_moves_per_node.sum()),
+                        'customers_per_sec': num_cust / simulation_time if simulation_time > 0 else 0.,
+                        'events_per_sec': num_events / simulation_time if simulation_time > 0 else 0.})
+        return results
+
+
+def create_instrumentation(config: dict) -> NullInstrumentation:
+    """The instrumentation of a day (config key 'instrument', default False)."""
+    return DayInstrumentation() if config.get('instrument', False) else NullInstrumentation()
+
+
+def start_worker_profile():
+    """Start (or resume) the cProfile profile of this process."""
+    global _worker_profiler
+    if _worker_profiler is None:
+        _worker_profiler = cProfile.Profile()
+    _worker_profiler.enable()
+
+
+def dump_worker_profile(profile_dir: Union[str, os.PathLike]) -> str:
+    """Stop the profile of this process and write everything it has recorded so far to
+    profile_dir/profile_<pid>.pstats. Returns the path of the file."""
+    os.makedirs(profile_dir, exist_ok=True)
+    file_path = os.path.join(profile_dir, f'profile_{os.getpid()}.pstats')
+    _worker_profiler.disable()
+    _worker_profiler.dump_stats(file_path)
+    return file_path
+
+
+@contextlib.contextmanager
+def worker_profile(profile_dir: Optional[Union[str, os.PathLike]]):
+    """Run the block under the profile of this process (nothing happens if profile_dir is None). Blocks can be nested,
+    e.g. the days of a batch inside the batch: the profile is only stopped and written to profile_dir when the
+    outermost block ends, also if it fails, so that it is written once per batch instead of after every day."""
+    global _worker_profile_depth
+    if profile_dir is None:
+        yield
+        return
+    if _worker_profile_depth == 0:
+        start_worker_profile()
+    _worker_profile_depth += 1
+    try:
+        yield
+    finally:
+        _worker_profile_depth -= 1
+        if _worker_profile_depth == 0:
+            dump_worker_profile(profile_dir)
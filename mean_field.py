@@ -0,0 +1,208 @@
+"""Mean-field estimates of the per-node encounters and exposure times, to screen configs before simulating them.
+
+The estimate uses the same inputs as simulate_one_day (config, G and the path generator) and takes milliseconds per
+config once the visit rates of a corpus are known:
+
+- Visit rates: every position of a path is one stay of traversal_time minutes on average at its node (consecutive
+  positions at the same node are a customer that stays to buy something). events_per_customer[v] is the mean number
+  of positions at node v per path of the corpus.
+- Occupancy (Little's law): customers arrive at rate arrival_rate for num_hours_open hours, so the mean number of
+  customers at v is L[v] = arrival_rate * events_per_customer[v] * traversal_time.
+- Co-presence: without capacity limits the customers do not interact, so the number of customers at v is Poisson
+  with mean L[v] (M/G/inf), split into independent Poisson numbers of infected (infection_proportion) and susceptible
+  customers. Every arrival or stay at v meets the customers of the other kind that are there, and every pair of an
+  infected and a susceptible customer at v adds their time together to the exposure time.
+- Node capacity: the occupancy is truncated at node_capacity (Erlang loss distribution). max_customers_in_store caps
+  the arrival rate at the rate at which a full store lets customers in. Both are crude; blocked customers waiting at
+  the previous node are not modelled.
+
+estimate_one_day returns the per-node dataframes (df_num_encounters_per_node, df_exposure_time_per_node and
+df_num_unique_visitors_per_node) and totals in the same form as simulate_one_day, and get_calibration_report compares
+the estimates with the means of simulated days.
+"""
+import math
+import random
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from core import StoreLayout
+from path_corpus import PathCorpus
+from simulator import simulate_several_days
+
+# Stats that are estimated, and compared with the simulation by get_calibration_report
+estimated_per_node_stats = ['num_encounters_per_node', 'exposure_time_per_node', 'num_unique_visitors_per_node']
+estimated_scalar_stats = ['num_cust', 'num_contacts', 'total_exposure_time', 'mean_num_cust_in_store']
+
+
+class VisitRates(NamedTuple):
+    """Visit rates of the nodes of a store graph for the paths of a corpus."""
+    events_per_customer: np.ndarray  # mean number of path positions at the node
+    visit_probability: np.ndarray  # fraction of paths that visit the node at least once
+    mean_path_length: float
+
+
+def get_visit_rates(corpus: PathCorpus, num_nodes: int, chunk_size: int = 2 ** 26) -> VisitRates:
+    """Count the positions and the unique visitors of every node in the paths of corpus. The unique visitors are
+    counted with a (paths x nodes) bitmap of visited nodes, for at most chunk_size path-node pairs at a time."""
+    num_paths = len(corpus)
+    nodes = np.asarray(corpus.nodes, dtype=np.int64)
+    path_lengths = corpus.path_lengths()
+    events_per_customer = np.bincount(nodes, minlength=num_nodes) / num_paths
+    num_visitors = np.zeros(num_nodes, dtype=np.int64)
+    paths_per_chunk = max(chunk_size // num_nodes, 1)
+    for first_path in range(0, num_paths, paths_per_chunk):
+        last_path = min(first_path + paths_per_chunk, num_paths)
+        chunk_nodes = nodes[corpus.offsets[first_path]:corpus.offsets[last_path]]
+        path_ids = np.repeat(np.arange(last_path - first_path), path_lengths[first_path:last_path])
+        is_visited = np.zeros((last_path - first_path, num_nodes), dtype=bool)
+        is_visited[path_ids, chunk_nodes] = True
+        num_visitors += is_visited.sum(axis=0)
+    return VisitRates(events_per_customer, num_visitors / num_paths, float(path_lengths.mean()))
+
+
+def get_corpus(path_generator_function, path_generator_args: list, num_sample_paths: int = 100000,
+               seed: Optional[int] = 0) -> PathCorpus:
+    """The corpus of the path generator, or num_sample_paths paths drawn from it if it does not draw from a corpus.
+    The paths are drawn with the global random states of random and np.random seeded with seed, which are restored
+    afterwards (as in simulate_one_day)."""
+    path_generator = path_generator_function(*path_generator_args)
+    corpus = getattr(path_generator, 'all_paths', None)
+    if corpus is None:
+        if seed is not None:
+            random_state, np_random_state = random.getstate(), np.random.get_state()
+            random.seed(seed)
+            np.random.seed(seed)
+        try:
+            corpus = [path_generator.__next__() for _ in range(num_sample_paths)]
+        finally:
+            if seed is not None:
+                random.setstate(random_state)
+                np.random.set_state(np_random_state)
+    return corpus if isinstance(corpus, PathCorpus) else PathCorpus.from_paths(corpus)
+
+
+def _get_occupancy_moments(mean_occupancy: np.ndarray, capacity: float) -> (np.ndarray, np.ndarray):
+    """E[N] and E[N (N - 1)] of the number N of customers at every node: Poisson with mean_occupancy, truncated at
+    capacity if it is finite."""
+    if np.isinf(capacity):
+        return mean_occupancy, mean_occupancy ** 2
+    pmf = np.zeros((int(capacity) + 1, len(mean_occupancy)))
+    pmf[0] = 1.
+    for k in range(1, len(pmf)):
+        pmf[k] = pmf[k - 1] * mean_occupancy / k
+    pmf /= pmf.sum(axis=0)
+    k = np.arange(len(pmf))[:, None]
+    return (k * pmf).sum(axis=0), (k * (k - 1) * pmf).sum(axis=0)
+
+
+def estimate_one_day(config: dict, G: Union[nx.Graph, StoreLayout], path_generator_function=None,
+                     path_generator_args: Optional[list] = None, visit_rates: Optional[VisitRates] = None) -> dict:
+    """
+    Mean-field estimate of the expected results of one day (see the module docstring).
+
+    :param config: Simulation config (as for simulate_one_day)
+    :param G: Store graph (or StoreLayout)
+    :param visit_rates: Visit rates of the corpus (see get_visit_rates). If not given, they are computed from the
+    path generator, so pass them when estimating many configs with the same corpus.
+    :return: Dict with num_cust, num_contacts, total_exposure_time and mean_num_cust_in_store, and the one-row
+    dataframes df_num_encounters_per_node, df_exposure_time_per_node and df_num_unique_visitors_per_node
+    """
+    num_nodes = len(G)
+    if visit_rates is None:
+        visit_rates = get_visit_rates(get_corpus(path_generator_function, path_generator_args), num_nodes)
+    open_length = config['num_hours_open'] * 60
+    traversal_time = config['traversal_time']
+    infection_proportion = config['infection_proportion']
+    arrival_rate = config['arrival_rate']
+    max_customers_in_store = config.get('max_customers_in_store', None)
+    if max_customers_in_store is not None:
+        # A full store lets in one customer whenever one leaves
+        mean_shopping_time = visit_rates.mean_path_length * traversal_time
+        arrival_rate = min(arrival_rate, max_customers_in_store / mean_shopping_time)
+    node_capacity = config.get('node_capacity', 2) if config.get('with_node_capacity', False) else np.inf
+
+    num_cust = arrival_rate * open_length
+    events_per_node = num_cust * visit_rates.events_per_customer
+    mean_occupancy = arrival_rate * visit_rates.events_per_customer * traversal_time
+    mean_n, mean_n_pairs = _get_occupancy_moments(mean_occupancy, node_capacity)
+    pair_proportion = infection_proportion * (1 - infection_proportion)
+    # Mean number of other customers that a customer at the node meets (size-biased occupancy minus itself)
+    mean_others = np.divide(mean_n_pairs, mean_n, out=np.zeros(num_nodes), where=mean_n > 0)
+    num_encounters_per_node = 2 * pair_proportion * events_per_node * mean_others
+    exposure_time_per_node = pair_proportion * mean_n_pairs * open_length
+    num_unique_visitors_per_node = num_cust * visit_rates.visit_probability
+
+    nodes = range(num_nodes)
+    return {'num_cust': num_cust,
+            'num_contacts': float(num_encounters_per_node.sum()),
+            'total_exposure_time': float(exposure_time_per_node.sum()),
+            # While the store is open (the simulated mean also covers the last customers leaving after closing time)
+            'mean_num_cust_in_store': arrival_rate * visit_rates.mean_path_length * traversal_time,
+            'df_num_encounters_per_node': pd.DataFrame([num_encounters_per_node], columns=nodes),
+            'df_exposure_time_per_node': pd.DataFrame([exposure_time_per_node], columns=nodes),
+            'df_num_unique_visitors_per_node': pd.DataFrame([num_unique_visitors_per_node], columns=nodes),
+            }
+
+
+def screen_configs(configs: List[dict], layouts: Dict[str, tuple]) -> pd.DataFrame:
+    """Estimate the totals of every config, e.g. of a make_config_grid grid, before sweeping it (see sweep.py).
+    layouts maps layout names to (G, path_generator_function, path_generator_args), and the visit rates of every
+    layout are computed once. Returns one row per config with the swept config values and the estimated totals."""
+    from sweep import get_layout_name
+
+    visit_rates = {}
+    swept_keys = [key for key in dict.fromkeys(key for config in configs for key in config)
+                  if len({repr(config.get(key)) for config in configs}) > 1]
+    rows = []
+    for config in configs:
+        layout = get_layout_name(config, layouts)
+        G, path_generator_function, path_generator_args = layouts[layout]
+        if layout not in visit_rates:
+            visit_rates[layout] = get_visit_rates(get_corpus(path_generator_function, path_generator_args), len(G))
+        estimate = estimate_one_day(config, G, visit_rates=visit_rates[layout])
+        row = {key: config.get(key) for key in swept_keys}
+        row.update({f'estimated_{stat}': estimate[stat] for stat in estimated_scalar_stats})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _get_rank_correlation(x: np.ndarray, y: np.ndarray) -> float:
+    """Spearman correlation (Pearson correlation of the ranks)."""
+    return float(np.corrcoef(pd.Series(x).rank(), pd.Series(y).rank())[0, 1])
+
+
+def get_calibration_report(config: dict, G: nx.Graph, path_generator_function, path_generator_args: list,
+                           num_days: int = 100, seed: Optional[int] = 0, **kwargs) -> pd.DataFrame:
+    """
+    Compare the estimates with the means of num_days simulated days (simulate_several_days, which also gets kwargs,
+    e.g. use_parallel=True).
+
+    :return: One row per estimated stat with the simulated mean (the sum over nodes for per-node stats), its standard
+    error, the estimate and the relative error of the estimate. For per-node stats, pearson and spearman are the
+    correlations of the estimated and the simulated means of the nodes, i.e. whether the estimate ranks the nodes
+    right even if its level is off.
+    """
+    results = simulate_several_days(config, G, path_generator_function, path_generator_args,
+                                    num_iterations=num_days, seed=seed, **kwargs)
+    df_stats = results.df_stats
+    simulated_per_node = {stat: results.get_per_node(stat) for stat in estimated_per_node_stats}
+    estimate = estimate_one_day(config, G, path_generator_function, path_generator_args)
+    rows = []
+    for stat in estimated_scalar_stats:
+        values = df_stats[stat].astype(float)
+        rows.append({'stat': stat, 'simulated': values.mean(), 'std_error': values.std() / math.sqrt(num_days),
+                     'estimated': estimate[stat]})
+    for stat in estimated_per_node_stats:
+        daily_totals = simulated_per_node[stat].sum(axis=1).astype(float)
+        simulated_means = simulated_per_node[stat].mean(axis=0).to_numpy(dtype=float)
+        estimated = estimate[f'df_{stat}'].iloc[0].to_numpy()
+        rows.append({'stat': stat, 'simulated': daily_totals.mean(),
+                     'std_error': daily_totals.std() / math.sqrt(num_days), 'estimated': estimated.sum(),
+                     'pearson': float(np.corrcoef(estimated, simulated_means)[0, 1]),
+                     'spearman': _get_rank_correlation(estimated, simulated_means)})
+    report = pd.DataFrame(rows).set_index('stat')
+    report['rel_error'] = (report['estimated'] - report['simulated']) / report['simulated']
+    return report[['simulated', 'std_error', 'estimated', 'rel_error', 'pearson', 'spearman']]
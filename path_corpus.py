@@ -0,0 +1,365 @@
+"""Compact storage of shopping path corpora.
+
+A corpus of full shopping paths is stored in CSR form as two flat integer arrays: the nodes of path i are
+nodes[offsets[i]:offsets[i + 1]]. Both PathCorpus and SharedPathCorpus behave like a read-only list of paths
+(len(corpus), corpus[i]), so they can be passed to paths_generator_from_actual_paths instead of a list of lists.
+
+On disk, a corpus is stored in a binary file (conventionally *.corpus): a 64-byte header followed by the offsets array
+(uint32, or uint64 for very large corpora) and the nodes array (uint8 for up to 256 nodes, else uint16/uint32).
+load_path_corpus opens it with np.memmap, so loading is instant and the paths are only read from disk when used.
+Convert an existing json corpus with `python path_corpus.py convert 10_6.json 10_6.corpus`.
+"""
+import argparse
+import json
+import os
+import shutil
+from itertools import chain
+from multiprocessing import shared_memory
+from typing import List, Optional, Union
+
+import numpy as np
+
+
+def get_node_dtype(max_node: int) -> np.dtype:
+    """Smallest unsigned integer dtype that can hold all node ids up to max_node."""
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_node <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+class PathCorpus(object):
+    """Corpus of shopping paths stored as a pair of flat arrays (offsets, nodes).
+
+    A corpus loaded with load_path_corpus remembers its file; pickling it then only sends the file path, and the
+    receiving process memory-maps the same file (so pool workers share the operating system's page cache)."""
+
+    def __init__(self, offsets: np.ndarray, nodes: np.ndarray, file_path: Optional[str] = None):
+        """
+
+        :param offsets: Array of length num_paths + 1 with the start of each path in nodes (offsets[0] == 0)
+        :param nodes: Concatenation of all paths
+        :param file_path: Corpus file that offsets and nodes are memory-mapped from (if any)
+        """
+        self.offsets = offsets
+        self.nodes = nodes
+        self.file_path = file_path
+
+    @classmethod
+    def from_paths(cls, paths: List[List[int]]) -> 'PathCorpus':
+        """Create a corpus from a list of paths (e.g. loaded from a json file)."""
+        path_lengths = np.fromiter((len(path) for path in paths), dtype=np.int64, count=len(paths))
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum(path_lengths, out=offsets[1:])
+        max_node = max((max(path) for path in paths if len(path) > 0), default=0)
+        nodes = np.fromiter(chain.from_iterable(paths), dtype=get_node_dtype(max_node), count=offsets[-1])
+        return cls(offsets, nodes)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> List[int]:
+        return self.nodes[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def path_lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.nodes.nbytes
+
+    def __getstate__(self) -> dict:
+        if self.file_path is not None:
+            return {'file_path': self.file_path}
+        return {'offsets': self.offsets, 'nodes': self.nodes, 'file_path': None}
+
+    def __setstate__(self, state: dict):
+        if state['file_path'] is not None:
+            state = _attach_corpus_file(state['file_path']).__dict__
+        self.__dict__.update(state)
+
+
+class ShortestPathTable(object):
+    """All shortest paths between all pairs of nodes in array form.
+
+    The shortest paths themselves are stored in a PathCorpus. The shortest paths from source to target are the paths
+    pair_offsets[k], ..., pair_offsets[k + 1] - 1 of that corpus, where k = node_index[source] * num_nodes +
+    node_index[target]. A pair without any path (e.g. in a one-way layout) has no paths."""
+
+    def __init__(self, nodes: np.ndarray, pair_offsets: np.ndarray, paths: PathCorpus):
+        """
+
+        :param nodes: Sorted array of the node ids
+        :param pair_offsets: Array of length num_nodes ** 2 + 1 with the first path of each (source, target) pair
+        :param paths: Corpus of all shortest paths
+        """
+        self.nodes = nodes
+        self.pair_offsets = pair_offsets
+        self.paths = paths
+        self.num_nodes = len(nodes)
+        self.node_index = np.full(int(nodes.max()) + 1, -1, dtype=np.int64)
+        self.node_index[nodes] = np.arange(self.num_nodes)
+
+    @classmethod
+    def from_shortest_path_dict(cls, shortest_path_dict: dict, multiple_paths: bool = True) -> 'ShortestPathTable':
+        """Create the table from a dict such that shortest_path_dict[source][target] is a list of all shortest paths
+        from source to target (e.g. from get_all_shortest_path_dicts).
+        With multiple_paths=False, shortest_path_dict[source][target] is a single path instead
+        (e.g. from dict(nx.all_pairs_dijkstra_path(G)))."""
+        if not multiple_paths:
+            shortest_path_dict = {source: {target: [path] for target, path in paths.items()}
+                                  for source, paths in shortest_path_dict.items()}
+        nodes = np.array(sorted(shortest_path_dict), dtype=np.int64)
+        all_paths = []
+        num_paths_per_pair = []
+        for source in nodes.tolist():
+            for target in nodes.tolist():
+                paths = shortest_path_dict[source].get(target, [])
+                all_paths += paths
+                num_paths_per_pair.append(len(paths))
+        pair_offsets = np.zeros(len(nodes) ** 2 + 1, dtype=np.int64)
+        np.cumsum(num_paths_per_pair, out=pair_offsets[1:])
+        return cls(nodes, pair_offsets, PathCorpus.from_paths(all_paths))
+
+    def pair_ids(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        return self.node_index[sources] * self.num_nodes + self.node_index[targets]
+
+    def get_paths(self, source: int, target: int) -> List[List[int]]:
+        pair = self.pair_ids(np.array([source]), np.array([target]))[0]
+        return [self.paths[i] for i in range(self.pair_offsets[pair], self.pair_offsets[pair + 1])]
+
+# Binary corpus file format
+corpus_file_magic = b'PATHCORP'
+corpus_file_version = 1
+corpus_header_dtype = np.dtype([('magic', 'S8'), ('version', '<u4'), ('offsets_dtype', 'S4'), ('nodes_dtype', 'S4'),
+                                ('num_paths', '<u8'), ('num_nodes', '<u8')])
+corpus_header_size = 64
+
+
+def get_corpus_header(num_paths: int, num_nodes: int, nodes_dtype: np.dtype) -> (bytes, np.dtype):
+    """Header of a corpus file and the dtype of its offsets."""
+    offsets_dtype = np.dtype('<u4') if num_nodes <= np.iinfo(np.uint32).max else np.dtype('<u8')
+    header = np.zeros(1, dtype=corpus_header_dtype)
+    header['magic'] = corpus_file_magic
+    header['version'] = corpus_file_version
+    header['offsets_dtype'] = offsets_dtype.str.encode()
+    header['nodes_dtype'] = nodes_dtype.str.encode()
+    header['num_paths'] = num_paths
+    header['num_nodes'] = num_nodes
+    return header.tobytes().ljust(corpus_header_size, b'\0'), offsets_dtype
+
+
+def save_path_corpus(corpus: PathCorpus, file_path: Union[str, os.PathLike]):
+    """Write a corpus to a binary corpus file."""
+    num_nodes = len(corpus.nodes)
+    max_node = int(corpus.nodes.max()) if num_nodes > 0 else 0
+    nodes_dtype = get_node_dtype(max_node).newbyteorder('<')
+    header, offsets_dtype = get_corpus_header(len(corpus), num_nodes, nodes_dtype)
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(np.asarray(corpus.offsets, dtype=offsets_dtype).tobytes())
+        f.write(np.asarray(corpus.nodes, dtype=nodes_dtype).tobytes())
+
+
+class PathCorpusWriter(object):
+    """Write a binary corpus file chunk by chunk, for corpora that should not be held in memory at once.
+
+    The nodes of every chunk are appended to a temporary file next to file_path, and only the path lengths are kept in
+    memory. The corpus file is assembled when the writer is closed. Use it as a context manager:
+
+        with PathCorpusWriter('paths.corpus', max_node=len(G) - 1) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+
+    def __init__(self, file_path: Union[str, os.PathLike], max_node: int):
+        """
+
+        :param file_path: Path of the corpus file
+        :param max_node: Largest node id in the corpus (determines the node dtype)
+        """
+        self.file_path = file_path
+        self.max_node = max_node
+        self.nodes_dtype = get_node_dtype(max_node).newbyteorder('<')
+        self.nodes_path = f'{os.fspath(file_path)}.nodes.tmp'
+        self._nodes_file = open(self.nodes_path, 'wb')
+        self._path_lengths = []
+        self.num_paths = 0
+        self.num_nodes = 0
+
+    def write(self, paths: Union[PathCorpus, List[List[int]]]):
+        """Append paths to the corpus."""
+        corpus = paths if isinstance(paths, PathCorpus) else PathCorpus.from_paths(paths)
+        if len(corpus.nodes) > 0 and int(corpus.nodes.max()) > self.max_node:
+            raise ValueError(f'Node {int(corpus.nodes.max())} is larger than max_node == {self.max_node}')
+        self._nodes_file.write(np.asarray(corpus.nodes, dtype=self.nodes_dtype).tobytes())
+        self._path_lengths.append(corpus.path_lengths())
+        self.num_paths += len(corpus)
+        self.num_nodes += len(corpus.nodes)
+
+    def close(self):
+        """Assemble the corpus file and remove the temporary file."""
+        self._nodes_file.close()
+        header, offsets_dtype = get_corpus_header(self.num_paths, self.num_nodes, self.nodes_dtype)
+        offsets = np.zeros(self.num_paths + 1, dtype=offsets_dtype)
+        if self._path_lengths:
+            np.cumsum(np.concatenate(self._path_lengths), out=offsets[1:])
+        with open(self.file_path, 'wb') as f:
+            f.write(header)
+            f.write(offsets.tobytes())
+            with open(self.nodes_path, 'rb') as nodes_file:
+                shutil.copyfileobj(nodes_file, f)
+        os.remove(self.nodes_path)
+
+    def __enter__(self) -> 'PathCorpusWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._nodes_file.close()
+            os.remove(self.nodes_path)
+
+
+def load_path_corpus(file_path: Union[str, os.PathLike]) -> PathCorpus:
+    """Open a binary corpus file. The arrays are memory-mapped read-only, nothing is read until a path is used."""
+    header = np.fromfile(file_path, dtype=corpus_header_dtype, count=1)[0]
+    assert header['magic'] == corpus_file_magic, f'{file_path} is not a path corpus file'
+    assert header['version'] == corpus_file_version, \
+        f'{file_path} has corpus file version {header["version"]}, but we can only read {corpus_file_version}'
+    offsets_dtype = np.dtype(header['offsets_dtype'].decode())
+    nodes_dtype = np.dtype(header['nodes_dtype'].decode())
+    num_paths = int(header['num_paths'])
+    num_nodes = int(header['num_nodes'])
+    offsets = np.memmap(file_path, dtype=offsets_dtype, mode='r', offset=corpus_header_size, shape=(num_paths + 1,))
+    nodes_offset = corpus_header_size + offsets.nbytes
+    if num_nodes > 0:
+        nodes = np.memmap(file_path, dtype=nodes_dtype, mode='r', offset=nodes_offset, shape=(num_nodes,))
+    else:
+        nodes = np.zeros(0, dtype=nodes_dtype)
+    return PathCorpus(offsets, nodes, file_path=os.fspath(file_path))
+
+
+def convert_json_corpus(json_path: Union[str, os.PathLike], corpus_path: Union[str, os.PathLike]) -> PathCorpus:
+    """Convert a json file with a list of paths (e.g. 10_6.json) to a binary corpus file."""
+    with open(json_path, 'r') as f:
+        paths = json.load(f)
+    save_path_corpus(PathCorpus.from_paths(paths), corpus_path)
+    return load_path_corpus(corpus_path)
+
+
+# Corpora that this process has attached to, so that every worker process attaches only once, no matter how many
+# tasks it runs. Shared corpora are keyed by the name of their nodes block, corpus files by ('file', path, mtime, size),
+# so that a file that is rewritten at the same path is opened again.
+_attached_corpora = {}
+
+
+def _attach_corpus_file(file_path: str) -> PathCorpus:
+    """The corpus in file_path, memory-mapped once per process (and again if the file has changed)."""
+    stat = os.stat(file_path)
+    key = ('file', file_path, stat.st_mtime_ns, stat.st_size)
+    if key not in _attached_corpora:
+        for old_key in [old_key for old_key in _attached_corpora if old_key[:2] == ('file', file_path)]:
+            del _attached_corpora[old_key]
+        _attached_corpora[key] = load_path_corpus(file_path)
+    return _attached_corpora[key]
+
+
+def clear_attached_corpora():
+    """Forget all corpora that this process has attached to (e.g. when a worker starts a new run). Their files and
+    shared memory blocks are closed when the last PathCorpus that uses them is gone."""
+    _attached_corpora.clear()
+
+
+class SharedPathCorpus(object):
+    """PathCorpus whose arrays live in multiprocessing.shared_memory.
+
+    Pickling a SharedPathCorpus only sends the names and sizes of the shared memory blocks, so tasks sent to a
+    multiprocessing pool carry a small handle instead of the corpus. Worker processes attach to the blocks the first
+    time they access a path and read from them without copying the corpus.
+    The process that creates the corpus owns the blocks and has to call unlink() (or use it as a context manager)
+    when no worker needs them any more.
+    """
+
+    def __init__(self, corpus: PathCorpus):
+        self._is_owner = True
+        self._shms = []
+        arrays = []
+        for array in [corpus.offsets, corpus.nodes]:
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared_array[:] = array
+            self._shms.append(shm)
+            arrays.append(shared_array)
+        self.offsets_name, self.nodes_name = [shm.name for shm in self._shms]
+        self.num_paths = len(corpus)
+        self.offsets_dtype = corpus.offsets.dtype.str
+        self.num_nodes = len(corpus.nodes)
+        self.nodes_dtype = corpus.nodes.dtype.str
+        self._corpus = PathCorpus(*arrays)
+
+    def __getstate__(self) -> dict:
+        return {'offsets_name': self.offsets_name, 'nodes_name': self.nodes_name, 'num_paths': self.num_paths,
+                'offsets_dtype': self.offsets_dtype, 'num_nodes': self.num_nodes, 'nodes_dtype': self.nodes_dtype}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._is_owner = False
+        self._shms = []
+        self._corpus = None
+
+    def get_corpus(self) -> PathCorpus:
+        """PathCorpus backed by the shared memory blocks (attaches to them if necessary)."""
+        if self._corpus is None:
+            if self.nodes_name not in _attached_corpora:
+                offsets_shm = shared_memory.SharedMemory(name=self.offsets_name)
+                nodes_shm = shared_memory.SharedMemory(name=self.nodes_name)
+                offsets = np.ndarray((self.num_paths + 1,), dtype=self.offsets_dtype, buffer=offsets_shm.buf)
+                nodes = np.ndarray((self.num_nodes,), dtype=self.nodes_dtype, buffer=nodes_shm.buf)
+                corpus = PathCorpus(offsets, nodes)
+                corpus._shms = [offsets_shm, nodes_shm]  # closed together with the corpus
+                _attached_corpora[self.nodes_name] = corpus
+            self._corpus = _attached_corpora[self.nodes_name]
+        return self._corpus
+
+    def __len__(self) -> int:
+        return self.num_paths
+
+    def __getitem__(self, i: int) -> List[int]:
+        return self.get_corpus()[i]
+
+    def __iter__(self):
+        return iter(self.get_corpus())
+
+    def unlink(self):
+        """Release the shared memory blocks (only the owner can do this)."""
+        assert self._is_owner, 'Only the process that created the shared corpus can unlink it'
+        self._corpus = None
+        _attached_corpora.pop(self.nodes_name, None)
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self) -> 'SharedPathCorpus':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a json path corpus to a binary corpus file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='Convert a json corpus to a binary corpus file')
+    convert_parser.add_argument('json_path')
+    convert_parser.add_argument('corpus_path')
+    args = parser.parse_args()
+    if args.command == 'convert':
+        corpus = convert_json_corpus(args.json_path, args.corpus_path)
+        print(f'Wrote {len(corpus)} paths ({corpus.nbytes / 1e6:.1f} MB) to {args.corpus_path}')
@@ -0,0 +1,316 @@
+"""Columnar collection of the results of many simulated days.
+
+Worker processes send the results of every batch of days as a compact DayBatchResults record (see pack_day_results
+and pack_day_batch), and ResultsCollector folds the results of every day into preallocated NumPy arrays as they arrive
+(in any order): one array per scalar statistic, a days x nodes array per per-node statistic, and a flat values array
+with per-day lengths for ragged per-customer lists such as exposure_times. Optionally, per-customer lists are also
+folded into histograms. The path index counts of trace='counter' (see trace_sinks.py) are summed over all days.
+
+With output_dir, the collector only keeps chunk_size days in memory and appends them to Parquet files as row groups,
+so a run of any number of days needs constant memory. This needs pyarrow.
+"""
+import logging
+import os
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+# Per-node statistics (the names of their dataframes without the df_ prefix) and their dtypes
+per_node_stats = {'num_encounters_per_node': np.int64,
+                  'exposure_time_per_node': float,
+                  'num_unique_visitors_per_node': np.int64,
+                  'time_crowded_per_node': float,
+                  'time_at_capacity_per_node': float,
+                  'num_blocked_moves_per_node': np.int64}
+# Per-customer lists that are recorded for every day
+ragged_stats = ['exposure_times']
+# dtypes of the per-customer lists of a day that can be packed (e.g. for histograms)
+packed_ragged_stats = {'exposure_times': float,
+                       'shopping_times': float,
+                       'num_contacts_per_cust': np.int64}
+# Packed path_index_counts of a day (with trace='counter'): one record per used path index
+path_index_count_dtype = np.dtype([('path_index', '<i8'), ('count', '<i8')])
+
+
+class SimulationResults(NamedTuple):
+    """Results of several days (see simulator.simulate_several_days): df_stats with one row of scalar statistics per
+    day and a days x nodes dataframe per per-node statistic (see per_node_stats). With output_dir, the paths of the
+    Parquet files instead. Use the field names rather than unpacking, as statistics may be added."""
+    df_stats: Union[pd.DataFrame, str]
+    df_num_encounters_per_node: Union[pd.DataFrame, str]
+    df_exposure_time_per_node: Union[pd.DataFrame, str]
+    df_num_unique_visitors_per_node: Union[pd.DataFrame, str]
+    df_time_crowded_per_node: Union[pd.DataFrame, str]
+    df_time_at_capacity_per_node: Union[pd.DataFrame, str]
+    df_num_blocked_moves_per_node: Union[pd.DataFrame, str]
+
+    def get_per_node(self, stat: str) -> Union[pd.DataFrame, str]:
+        """The dataframe (or file path) of the per-node statistic stat, e.g. 'num_encounters_per_node'."""
+        return getattr(self, f'df_{stat}')
+
+
+# Every per-node statistic has a field
+assert SimulationResults._fields == ('df_stats',) + tuple(f'df_{stat}' for stat in per_node_stats)
+
+
+class DayResults(NamedTuple):
+    """Compact results of one day: a structured array with a single record of all scalar statistics, a NumPy array
+    per per-node statistic and a NumPy array per per-customer list."""
+    scalars: np.ndarray
+    per_node: Dict[str, np.ndarray]
+    ragged: Dict[str, np.ndarray]
+
+
+def pack_day_results(results: dict, ragged_stats_to_pack: Optional[List[str]] = None) -> DayResults:
+    """Pack the results of simulate_one_day into a DayResults record. The per-node statistics can be lists, arrays
+    or one-row dataframes (with the df_ prefix). Only the per-customer lists in ragged_stats_to_pack are packed
+    (default: ragged_stats). The path_index_counts Counter of trace='counter' is packed as ragged['path_index_counts']
+    (path_index_count_dtype)."""
+    if ragged_stats_to_pack is None:
+        ragged_stats_to_pack = ragged_stats
+    scalar_cols = [key for key, val in results.items() if isinstance(val, (int, np.integer, float))]
+    scalar_dtype = np.dtype([(col, np.int64 if isinstance(results[col], (int, np.integer)) else float)
+                             for col in scalar_cols])
+    scalars = np.array([tuple(results[col] for col in scalar_cols)], dtype=scalar_dtype)
+    per_node = {stat: np.asarray(results[stat] if stat in results else results[f'df_{stat}'], dtype=dtype).reshape(-1)
+                for stat, dtype in per_node_stats.items()}
+    ragged = {stat: np.asarray(results[stat], dtype=packed_ragged_stats[stat]) for stat in ragged_stats_to_pack}
+    if 'path_index_counts' in results:
+        ragged['path_index_counts'] = np.array(sorted(results['path_index_counts'].items()),
+                                               dtype=path_index_count_dtype).reshape(-1)
+    return DayResults(scalars, per_node, ragged)
+
+
+class DayBatchResults(NamedTuple):
+    """Compact results of a batch of days (see simulator.simulate_days_batch): the days, a structured array with one
+    record of scalar statistics per day, a days x nodes array per per-node statistic, and the concatenated values of
+    every per-customer list with the number of values of every day."""
+    days: np.ndarray
+    scalars: np.ndarray
+    per_node: Dict[str, np.ndarray]
+    ragged_values: Dict[str, np.ndarray]
+    ragged_lengths: Dict[str, np.ndarray]
+
+    def iter_days(self) -> Iterator[Tuple[int, DayResults]]:
+        """(day, DayResults) of every day of the batch (the arrays are views into the batch)."""
+        ragged_ends = {stat: np.cumsum(lengths) for stat, lengths in self.ragged_lengths.items()}
+        for i, day in enumerate(self.days):
+            ragged = {stat: self.ragged_values[stat][ragged_ends[stat][i] - self.ragged_lengths[stat][i]:
+                                                     ragged_ends[stat][i]]
+                      for stat in self.ragged_values}
+            yield int(day), DayResults(self.scalars[i:i + 1], {stat: array[i] for stat, array in self.per_node.items()},
+                                       ragged)
+
+
+def pack_day_batch(days: List[int], day_results: List[DayResults]) -> DayBatchResults:
+    """Concatenate the DayResults of several days into one DayBatchResults."""
+    first = day_results[0]
+    return DayBatchResults(np.asarray(days, dtype=np.int64),
+                           np.concatenate([results.scalars for results in day_results]),
+                           {stat: np.stack([results.per_node[stat] for results in day_results])
+                            for stat in first.per_node},
+                           {stat: np.concatenate([results.ragged[stat] for results in day_results])
+                            for stat in first.ragged},
+                           {stat: np.array([len(results.ragged[stat]) for results in day_results], dtype=np.int64)
+                            for stat in first.ragged})
+
+
+class ResultsCollector(object):
+    """Collects the results of simulate_one_day for num_days days (see the module docstring)."""
+
+    def __init__(self, num_days: int, nodes: List[int], output_dir: Optional[Union[str, os.PathLike]] = None,
+                 chunk_size: int = 1024, histogram_bins: Optional[Dict[str, np.ndarray]] = None):
+        """
+
+        :param num_days: Number of days
+        :param nodes: Node ids of the store graph (the columns of the per-node statistics)
+        :param output_dir: If given, results are written to Parquet files in output_dir instead of kept in memory
+        :param chunk_size: Number of days per Parquet row group (only with output_dir)
+        :param histogram_bins: Maps per-customer statistics (e.g. 'exposure_times', 'shopping_times' or
+        'num_contacts_per_cust') to histogram bin edges. Their values of all days are counted in histograms
+        (values outside the bins are not counted).
+        """
+        self.num_days = num_days
+        self.nodes = list(nodes)
+        self.output_dir = output_dir
+        self.num_rows = num_days if output_dir is None else min(chunk_size, num_days)
+        self.histogram_bins = {stat: np.asarray(bins) for stat, bins in (histogram_bins or {}).items()}
+        self.histograms = {stat: np.zeros(len(bins) - 1, dtype=np.int64)
+                           for stat, bins in self.histogram_bins.items()}
+        self.scalars = None  # structured array, created from the first day
+        self.days = np.zeros(self.num_rows, dtype=np.int64)
+        self.per_node_arrays = {stat: np.zeros((self.num_rows, len(self.nodes)), dtype=dtype)
+                                for stat, dtype in per_node_stats.items()}
+        self.ragged_values = {stat: np.zeros(1024) for stat in ragged_stats}
+        self.ragged_starts = {stat: np.zeros(self.num_rows, dtype=np.int64) for stat in ragged_stats}
+        self.ragged_lengths = {stat: np.zeros(self.num_rows, dtype=np.int64) for stat in ragged_stats}
+        self.ragged_sizes = {stat: 0 for stat in ragged_stats}
+        self.path_index_counts = None  # counts of path index - 1 (with trace='counter'), created from the first day
+        self.num_buffered = 0
+        self.num_collected = 0
+        self._writers = {}
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, day: int, results: Union[DayResults, dict]):
+        """Fold the results of day (as returned by simulate_one_day) into the arrays."""
+        if not isinstance(results, DayResults):
+            results = pack_day_results(results, self.get_ragged_stats_to_pack())
+        if self.scalars is None:
+            logging.info(f'Recording the scalar stats for {list(results.scalars.dtype.names) + ragged_stats}.')
+            self.scalars = np.zeros(self.num_rows, dtype=results.scalars.dtype)
+        row = day if self.output_dir is None else self.num_buffered
+        self.days[row] = day
+        self.scalars[row] = results.scalars[0]
+        for stat, array in self.per_node_arrays.items():
+            array[row] = results.per_node[stat]
+        for stat in ragged_stats:
+            self._append_ragged(stat, row, results.ragged[stat])
+        for stat, bins in self.histogram_bins.items():
+            self.histograms[stat] += np.histogram(results.ragged[stat], bins=bins)[0]
+        if 'path_index_counts' in results.ragged:
+            self._add_path_index_counts(results.ragged['path_index_counts'])
+        self.num_buffered += 1
+        self.num_collected += 1
+        if self.output_dir is not None and self.num_buffered == self.num_rows:
+            self.flush()
+
+    def add_batch(self, batch: DayBatchResults):
+        """Fold the results of a batch of days (as returned by simulate_days_batch) into the arrays."""
+        for day, results in batch.iter_days():
+            self.add(day, results)
+
+    def truncate(self, num_days: int):
+        """Stop early: only keep the first num_days days, which all have to be collected already (e.g. when a run
+        has converged before the planned number of days)."""
+        assert self.num_collected == num_days, f'{self.num_collected} days were collected, not {num_days}'
+        self.num_days = num_days
+
+    def get_ragged_stats_to_pack(self) -> List[str]:
+        """Per-customer lists that the collector needs from every day."""
+        return ragged_stats + [stat for stat in self.histogram_bins if stat not in ragged_stats]
+
+    def _append_ragged(self, stat: str, row: int, values: np.ndarray):
+        size = self.ragged_sizes[stat]
+        if size + len(values) > len(self.ragged_values[stat]):
+            new_values = np.zeros(max(2 * len(self.ragged_values[stat]), size + len(values)))
+            new_values[:size] = self.ragged_values[stat][:size]
+            self.ragged_values[stat] = new_values
+        self.ragged_values[stat][size:size + len(values)] = values
+        self.ragged_starts[stat][row] = size
+        self.ragged_lengths[stat][row] = len(values)
+        self.ragged_sizes[stat] = size + len(values)
+
+    def _add_path_index_counts(self, counts: np.ndarray):
+        if self.path_index_counts is None:
+            self.path_index_counts = np.zeros(1024, dtype=np.int64)
+        # Path index -1 (paths that are not drawn from a corpus) is counted at 0
+        rows = counts['path_index'] + 1
+        if len(rows) > 0 and rows.max() >= len(self.path_index_counts):
+            new_counts = np.zeros(max(2 * len(self.path_index_counts), rows.max() + 1), dtype=np.int64)
+            new_counts[:len(self.path_index_counts)] = self.path_index_counts
+            self.path_index_counts = new_counts
+        np.add.at(self.path_index_counts, rows, counts['count'])
+
+    def get_path_index_counts(self) -> Optional[pd.Series]:
+        """Number of customers of all collected days that walked every path index (only the used ones, sorted by
+        path index), or None if the days were not simulated with trace='counter'."""
+        if self.path_index_counts is None:
+            return None
+        rows = np.flatnonzero(self.path_index_counts)
+        return pd.Series(self.path_index_counts[rows], index=pd.Index(rows - 1, name='path_index'), name='count')
+
+    def _get_ragged_lists(self, stat: str, num_rows: int) -> List[List[float]]:
+        values = self.ragged_values[stat]
+        return [values[start:start + length].tolist()
+                for start, length in zip(self.ragged_starts[stat][:num_rows], self.ragged_lengths[stat][:num_rows])]
+
+    def _get_per_node_dataframe(self, stat: str, num_rows: int) -> pd.DataFrame:
+        return pd.DataFrame(self.per_node_arrays[stat][:num_rows], columns=self.nodes)
+
+    def get_dataframes(self) -> SimulationResults:
+        """df_stats and the per-node dataframes of all days, in order of days (only without output_dir).
+        The histograms are in df_stats.attrs['histograms'] and the path index counts (see get_path_index_counts) in
+        df_stats.attrs['path_index_counts']."""
+        assert self.output_dir is None, 'The results were written to output_dir'
+        assert self.num_collected == self.num_days, f'Only {self.num_collected} of {self.num_days} days were collected'
+        df_stats = pd.DataFrame(self.scalars[:self.num_days])
+        for stat in ragged_stats:
+            df_stats[stat] = self._get_ragged_lists(stat, self.num_days)
+        if self.histograms:
+            df_stats.attrs['histograms'] = self.get_histograms()
+        if self.path_index_counts is not None:
+            df_stats.attrs['path_index_counts'] = self.get_path_index_counts()
+        return SimulationResults(df_stats, *(self._get_per_node_dataframe(stat, self.num_days)
+                                             for stat in per_node_stats))
+
+    def get_results(self) -> SimulationResults:
+        """The dataframes of all days (see get_dataframes), or with output_dir, close the collector and return the
+        paths of the Parquet files of df_stats and the per-node statistics (see get_file_paths for all files)."""
+        if self.output_dir is None:
+            return self.get_dataframes()
+        self.close()
+        file_paths = self.get_file_paths()
+        return SimulationResults(file_paths['stats'], *(file_paths[stat] for stat in per_node_stats))
+
+    def get_histograms(self) -> Dict[str, pd.DataFrame]:
+        """Histogram of every statistic in histogram_bins, with columns bin_left, bin_right and count."""
+        return {stat: pd.DataFrame({'bin_left': bins[:-1], 'bin_right': bins[1:], 'count': self.histograms[stat]})
+                for stat, bins in self.histogram_bins.items()}
+
+    def get_file_paths(self) -> Dict[str, str]:
+        """Parquet file of every table (only with output_dir)."""
+        names = ['stats'] + list(per_node_stats) + [stat for stat in ragged_stats if stat not in self.histogram_bins]
+        if self.path_index_counts is not None:
+            names.append('path_index_counts')
+        return {name: os.path.join(self.output_dir, f'{name}.parquet') for name in names}
+
+    def flush(self):
+        """Append the buffered days to the Parquet files (only with output_dir)."""
+        if self.num_buffered == 0:
+            return
+        num_rows = self.num_buffered
+        days = self.days[:num_rows]
+        df_stats = pd.DataFrame(self.scalars[:num_rows])
+        df_stats.insert(0, 'day', days)
+        tables = {'stats': df_stats}
+        for stat in per_node_stats:
+            df = self._get_per_node_dataframe(stat, num_rows)
+            df.columns = df.columns.astype(str)
+            df.insert(0, 'day', days)
+            tables[stat] = df
+        for stat in ragged_stats:
+            if stat not in self.histogram_bins:
+                # Long format: one row per value
+                lengths = self.ragged_lengths[stat][:num_rows]
+                tables[stat] = pd.DataFrame({'day': np.repeat(days, lengths),
+                                             stat: self.ragged_values[stat][:self.ragged_sizes[stat]]})
+            self.ragged_sizes[stat] = 0
+        for name, df in tables.items():
+            self._write_table(name, df)
+        self.num_buffered = 0
+
+    def _write_table(self, name: str, df: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if name not in self._writers:
+            file_path = os.path.join(self.output_dir, f'{name}.parquet')
+            self._writers[name] = pq.ParquetWriter(file_path, table.schema)
+        self._writers[name].write_table(table)
+
+    def close(self):
+        """Write the remaining days and the histograms, and close the Parquet files (only with output_dir)."""
+        if self.output_dir is None:
+            return
+        self.flush()
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        for stat, df in self.get_histograms().items():
+            df.to_parquet(os.path.join(self.output_dir, f'histogram_{stat}.parquet'))
+        if self.path_index_counts is not None:
+            self.get_path_index_counts().reset_index().to_parquet(
+                os.path.join(self.output_dir, 'path_index_counts.parquet'))
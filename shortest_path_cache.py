@@ -0,0 +1,146 @@
+"""On-disk cache of the shortest-path tables of store layouts.
+
+Computing all shortest paths of a store network is slow (minutes for get_all_shortest_path_dicts on our 200-node
+market), but the tables only depend on the layout. ShortestPathCache stores every ShortestPathTable in a directory
+named after a fingerprint of the layout (node positions, edges, edge weights and directedness), so it is computed once
+per layout and shared by all later runs and worker processes. The arrays are memory-mapped when loaded, so nothing is
+read until a path is used. Both the tables in memory and the layouts on disk are evicted in least recently used order.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Optional, Union
+
+import networkx as nx
+import numpy as np
+
+from path_corpus import ShortestPathTable, load_path_corpus, save_path_corpus
+
+# Bump this if the way tables are computed or stored changes, so that old cache entries are not used
+cache_format_version = 1
+default_cache_dir = os.path.join('.cache', 'shortest_paths')
+
+
+def get_graph_fingerprint(G: nx.Graph) -> str:
+    """Hash of the node positions, edges, edge weights and directedness of a store network."""
+    nodes = sorted(G.nodes())
+    node_data = [(node, tuple(G.nodes[node].get('pos', ()))) for node in nodes]
+    if G.is_directed():
+        edges = sorted((u, v, G.edges[u, v].get('weight', 1)) for u, v in G.edges())
+    else:
+        edges = sorted((min(u, v), max(u, v), G.edges[u, v].get('weight', 1)) for u, v in G.edges())
+    description = repr((cache_format_version, G.is_directed(), node_data, edges))
+    return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+
+def compute_shortest_path_table(G: nx.Graph, multiple_paths: bool = True) -> ShortestPathTable:
+    """Compute the shortest-path table of G.
+    With multiple_paths=True, the table has all shortest paths (in number of hops) between every pair of nodes
+    (get_all_shortest_path_dicts). Otherwise it has one shortest path by edge weight (nx.all_pairs_dijkstra_path)."""
+    if multiple_paths:
+        from covid19_supermarket_abm.utils.create_synthetic_baskets import get_all_shortest_path_dicts
+        return ShortestPathTable.from_shortest_path_dict(get_all_shortest_path_dicts(G))
+    else:
+        return ShortestPathTable.from_shortest_path_dict(dict(nx.all_pairs_dijkstra_path(G)), multiple_paths=False)
+
+
+def save_shortest_path_table(table: ShortestPathTable, dir_path: Union[str, os.PathLike]):
+    """Write a table to a directory: nodes.npy, pair_offsets.npy and the paths as a binary corpus file."""
+    os.makedirs(dir_path, exist_ok=True)
+    pair_offsets = table.pair_offsets
+    if len(table.paths) <= np.iinfo(np.uint32).max:
+        pair_offsets = pair_offsets.astype(np.uint32)
+    np.save(os.path.join(dir_path, 'nodes.npy'), table.nodes)
+    np.save(os.path.join(dir_path, 'pair_offsets.npy'), pair_offsets)
+    save_path_corpus(table.paths, os.path.join(dir_path, 'paths.corpus'))
+
+
+def load_shortest_path_table(dir_path: Union[str, os.PathLike]) -> ShortestPathTable:
+    """Open a table written by save_shortest_path_table. The pair offsets and paths are memory-mapped."""
+    nodes = np.load(os.path.join(dir_path, 'nodes.npy'))
+    pair_offsets = np.load(os.path.join(dir_path, 'pair_offsets.npy'), mmap_mode='r')
+    paths = load_path_corpus(os.path.join(dir_path, 'paths.corpus'))
+    return ShortestPathTable(nodes, pair_offsets, paths)
+
+
+class ShortestPathCache(object):
+    """LRU cache of shortest-path tables, in memory and on disk."""
+
+    def __init__(self, cache_dir: Union[str, os.PathLike] = default_cache_dir, max_tables_in_memory: int = 4,
+                 max_tables_on_disk: int = 32):
+        """
+
+        :param cache_dir: Directory of the cache entries
+        :param max_tables_in_memory: Number of loaded tables that are kept open
+        :param max_tables_on_disk: Number of tables kept in cache_dir. The least recently used ones are deleted.
+        """
+        self.cache_dir = cache_dir
+        self.max_tables_in_memory = max_tables_in_memory
+        self.max_tables_on_disk = max_tables_on_disk
+        self.tables = OrderedDict()
+
+    def get_entry_path(self, G: nx.Graph, multiple_paths: bool = True) -> str:
+        kind = 'all' if multiple_paths else 'dijkstra'
+        return os.path.join(self.cache_dir, f'{get_graph_fingerprint(G)}-{kind}')
+
+    def get(self, G: nx.Graph, multiple_paths: bool = True) -> ShortestPathTable:
+        """Shortest-path table of G (see compute_shortest_path_table), computed only if it is not cached yet."""
+        entry_path = self.get_entry_path(G, multiple_paths)
+        if entry_path in self.tables:
+            self.tables.move_to_end(entry_path)
+        else:
+            if not os.path.isdir(entry_path):
+                self._write_entry(entry_path, compute_shortest_path_table(G, multiple_paths))
+            self.tables[entry_path] = load_shortest_path_table(entry_path)
+            if len(self.tables) > self.max_tables_in_memory:
+                self.tables.popitem(last=False)
+        os.utime(entry_path)  # mark as recently used
+        return self.tables[entry_path]
+
+    def _write_entry(self, entry_path: str, table: ShortestPathTable):
+        """Write the entry to a temporary directory first, so that other processes never see half-written entries."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            save_shortest_path_table(table, tmp_path)
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another process has written the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(entry_path):
+                raise
+        self._evict_from_disk(keep=entry_path)
+
+    def _evict_from_disk(self, keep: str):
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                   if not name.startswith('.')]
+        entries.sort(key=os.path.getmtime)
+        num_to_evict = len(entries) - self.max_tables_on_disk
+        for entry_path in entries:
+            if num_to_evict <= 0:
+                break
+            if entry_path != keep:
+                self.tables.pop(entry_path, None)
+                shutil.rmtree(entry_path, ignore_errors=True)
+                num_to_evict -= 1
+
+    def clear(self):
+        """Delete all cached tables."""
+        self.tables.clear()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+_default_cache: Optional[ShortestPathCache] = None
+
+
+def get_shortest_path_table(G: nx.Graph, multiple_paths: bool = True,
+                            cache: Optional[ShortestPathCache] = None) -> ShortestPathTable:
+    """Shortest-path table of G from cache (by default a ShortestPathCache in default_cache_dir)."""
+    global _default_cache
+    if cache is None:
+        if _default_cache is None:
+            _default_cache = ShortestPathCache()
+        cache = _default_cache
+    return cache.get(G, multiple_paths)
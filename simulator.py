@@ -1,5 +1,6 @@
-import multiprocessing
-from itertools import repeat
+import os
+import random
+from typing import List, Optional, Union
 
 import networkx as nx
 import numpy as np
@@ -9,10 +10,52 @@ import logging
 from tqdm import tqdm
 
 import core as core
-from covid19_supermarket_abm.utils import istarmap  # enable progress bar with multiprocessing
+from convergence import ConvergenceMonitor
+from executors import Executor, get_executor
+import event_kernel
+import instrumentation
+import trace_sinks
+import path_corpus
+from path_corpus import PathCorpus, SharedPathCorpus
+from results_collector import (DayBatchResults, ResultsCollector, SimulationResults, pack_day_batch, pack_day_results,
+                               per_node_stats)
 
 
-def simulate_one_day(config: dict, G: nx.Graph, path_generator_function, path_generator_args: list):
+def simulate_one_day(config: dict, G: Union[nx.Graph, core.StoreLayout], path_generator_function,
+                     path_generator_args: list, seed: Optional[int] = None, day: int = 0, compact: bool = False,
+                     ragged_stats_to_pack: Optional[List[str]] = None):
+    """Simulate one day. G can also be a StoreLayout that is shared between days. If seed is given, the global random
+    states of random and np.random are seeded with it for the day and restored afterwards, so that the day can be
+    re-run exactly from its seed (e.g. from the seed column of df_stats) without changing the random state of the
+    caller.
+    day is the number of the day in the path trace (see trace_sinks.py).
+    With compact=True, the results are returned as a DayResults record of NumPy arrays (see results_collector.py)
+    instead of a dict with one-row dataframes, which is much cheaper to build and to send between processes.
+    It only holds the per-customer lists in ragged_stats_to_pack (default: exposure_times).
+    With config['instrument'] = True, the results also hold phase timers, event counts and throughput, and with
+    config['profile_dir'], the day is profiled with cProfile (see instrumentation.py)."""
+    if seed is not None:
+        seed = int(seed)
+        random_state, np_random_state = random.getstate(), np.random.get_state()
+        random.seed(seed)
+        np.random.seed(get_np_random_seed(seed))
+    try:
+        with instrumentation.worker_profile(config.get('profile_dir', None)):
+            return _simulate_one_day(config, G, path_generator_function, path_generator_args, seed, day, compact,
+                                     ragged_stats_to_pack)
+    finally:
+        if seed is not None:
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+
+
+def _simulate_one_day(config: dict, G: Union[nx.Graph, core.StoreLayout], path_generator_function,
+                      path_generator_args: list, seed: Optional[int], day: int, compact: bool,
+                      ragged_stats_to_pack: Optional[List[str]]):
+    """simulate_one_day, with the random states already seeded (and the profiler started)."""
+    day_instrumentation = instrumentation.create_instrumentation(config)
+    day_instrumentation.start('setup')
+
     # Get parameters
     num_hours_open = config['num_hours_open']
     logging_enabled = True
@@ -29,17 +72,54 @@ def simulate_one_day(config: dict, G: nx.Graph, path_generator_function, path_ge
             raise ValueError('If you set the parameter "max_customers_in_store_per_sqm", '
                              'you need to specify the floor area via the "floorarea" parameter in the config.')
 
+    engine = config.get('engine', 'simpy')
+    if engine == 'simpy':
+        env = simpy.Environment()
+    elif engine == 'heapq':
+        env = event_kernel.EventQueueEnvironment()
+    else:
+        raise ValueError(f'Unknown engine == {engine}')
+
     # Set up environment and run
-    env = simpy.Environment()
-    store = core.Store(env, G, max_customers_in_store=max_customers_in_store, logging_enabled=logging_enabled)
+    store = core.Store(env, G, max_customers_in_store=max_customers_in_store, logging_enabled=logging_enabled,
+                       crowded_thres=config.get('crowded_thres', 4))
     if with_node_capacity:
         node_capacity = config.get('node_capacity', 2)
         store.enable_node_capacity(node_capacity)
+        capacity_wakeup = config.get('capacity_wakeup', 'poll')
+        if capacity_wakeup == 'event':
+            store.enable_capacity_wakeup_events()
+        elif capacity_wakeup != 'poll':
+            raise ValueError(f'Unknown capacity_wakeup == {capacity_wakeup}')
+    exposure_accounting = config.get('exposure_accounting', 'pairwise')
+    if exposure_accounting == 'integral':
+        store.enable_integral_exposure_accounting()
+    elif exposure_accounting != 'pairwise':
+        raise ValueError(f'Unknown exposure_accounting == {exposure_accounting}')
+    trace_sink = trace_sinks.create_trace_sink(config, day)
+    store.enable_path_trace(trace_sink)
     path_generator = path_generator_function(*path_generator_args)
+    corpus = getattr(path_generator, 'all_paths', None)
+    if isinstance(G, core.StoreLayout) and corpus is not None:
+        # A shared layout validates the whole corpus once, instead of every move of every day
+        G.validate_paths(corpus)
+        store.enable_prevalidated_paths()
+    day_instrumentation.instrument_store(store)
+    day_instrumentation.instrument_env(env)
+    path_generator = day_instrumentation.instrument_path_generator(path_generator)
+    day_instrumentation.stop('setup')
+    day_instrumentation.start('simulation')
     # env.process(_)
-    env.process(core._customer_arrivals(env, store, path_generator, config))
-    env.process(core._stats_recorder(store))
-    env.run(until=num_hours_open * 60 * 10)
+    if engine == 'simpy':
+        env.process(core._customer_arrivals(env, store, path_generator, config))
+        env.run(until=num_hours_open * 60 * 10)
+    else:
+        event_kernel.run_one_day(store, path_generator, config, until=num_hours_open * 60 * 10)
+    day_instrumentation.stop('simulation')
+    day_instrumentation.start('trace')
+    trace_sink.close()
+    day_instrumentation.stop('trace')
+    day_instrumentation.start('results')
 
     # Record stats
     core._sanity_checks(store, raise_test_error=raise_test_error)
@@ -52,102 +132,265 @@ def simulate_one_day(config: dict, G: nx.Graph, path_generator_function, path_ge
     if num_waiting_people > 0:
         mean_waiting_time = np.mean(waiting_times[b])
     else:
-        mean_waiting_time = 0
+        mean_waiting_time = 0.
 
     num_contacts_per_cust = [contacts for contacts in store.number_encounters_with_infected.values() if contacts != 0]
-    df_num_encounters_per_node = pd.DataFrame(store.number_encounters_per_node, index=[0])
-    df_num_encounters_per_node = df_num_encounters_per_node[range(len(G))]
-    df_exposure_time_per_node = pd.DataFrame(store.time_with_infected_per_node, index=[0])
-    df_exposure_time_per_node = df_exposure_time_per_node[range(len(G))]
+    nodes = range(len(G))
+    num_encounters_per_node = [store.number_encounters_per_node[node] for node in nodes]
+    exposure_time_per_node = [store.time_with_infected_per_node[node] for node in nodes]
+    num_unique_visitors_per_node = [store.number_unique_visitors_per_node[node] for node in nodes]
     exposure_times = [val for val in list(store.time_with_infected_per_customer.values()) if val > 0]
     results = {'num_cust': num_cust,
                'num_S': num_S,
                'num_I': num_cust - num_S,
-               'total_exposure_time': sum(store.time_with_infected_per_customer.values()),
+               'total_exposure_time': float(sum(store.time_with_infected_per_customer.values())),
                'num_contacts_per_cust': num_contacts_per_cust,
                'num_cust_w_contact': len(num_contacts_per_cust),
-               'mean_num_cust_in_store': np.mean(list(store.stats['num_customers_in_store'].values())),
-               'max_num_cust_in_store': max(list(store.stats['num_customers_in_store'].values())),
+               'mean_num_cust_in_store': store.get_mean_num_customers_in_store(),
+               'max_num_cust_in_store': store.max_num_customers_in_store,
                'num_contacts': sum(num_contacts_per_cust),
                'shopping_times': shopping_times,
                'mean_shopping_time': np.mean(shopping_times),
                'num_waiting_people': num_waiting_people,
                'mean_waiting_time': mean_waiting_time,
-               'store_open_length': max(list(store.stats['num_customers_in_store'].keys())),
-               'df_num_encounters_per_node': df_num_encounters_per_node,
-               'df_exposure_time_per_node': df_exposure_time_per_node,
+               'store_open_length': store.get_open_length(),
+               'num_encounters_per_node': num_encounters_per_node,
+               'exposure_time_per_node': exposure_time_per_node,
+               'num_unique_visitors_per_node': num_unique_visitors_per_node,
+               'time_crowded_per_node': store.time_crowded_per_node,
+               'time_at_capacity_per_node': store.time_at_capacity_per_node,
+               'num_blocked_moves_per_node': store.num_blocked_moves_per_node,
                'total_time_crowded': store.total_time_crowded,
                'exposure_times': exposure_times,
                }
+    if seed is not None:
+        results['seed'] = seed
+    results.update(trace_sink.get_results())
 
     # logs_data = {'log': store.logs}
     # df = pd.DataFrame(logs_data)
     # df.to_parquet("logs_config_new_1000.txt", index=True)
-    
-    with open('all_buyer_paths.txt', 'a') as f:
-        for log in store.logs:
-            f.write(log + '\n') 
-    f.close()
 
     if floorarea is not None:
         results['mean_num_cust_in_store_per_sqm'] = results['mean_num_cust_in_store'] / floorarea
         results['max_num_cust_in_store_per_sqm'] = results['max_num_cust_in_store'] / floorarea
+    day_instrumentation.stop('results')
+    results.update(day_instrumentation.get_results(store, num_cust))
     # results['logs'] = store.logs
+    if compact:
+        return pack_day_results(results, ragged_stats_to_pack)
+    for stat, dtype in per_node_stats.items():
+        results[f'df_{stat}'] = pd.DataFrame([np.array(results.pop(stat), dtype=dtype)], columns=nodes)
     return results
 
 
+def simulate_days_batch(config: dict, G: Union[nx.Graph, core.StoreLayout], path_generator_function,
+                        path_generator_args: list, n_days: int, seed: Optional[int] = None,
+                        day_seeds: Optional[List[int]] = None, days: Optional[List[int]] = None,
+                        ragged_stats_to_pack: Optional[List[str]] = None) -> DayBatchResults:
+    """Simulate n_days independent days in this process and return their results as one DayBatchResults record.
+    The StoreLayout of G is built once and shared by the stores of all days, so that only the state that changes
+    during a day is created per day. The days are numbered days (default: 0, ..., n_days - 1) and get the seeds
+    day_seeds (default: get_day_seeds(n_days, seed)), so every day equals simulate_one_day with the same seed."""
+    if day_seeds is None:
+        day_seeds = get_day_seeds(n_days, seed)
+    if days is None:
+        days = list(range(n_days))
+    assert len(day_seeds) == len(days) == n_days, f'{len(day_seeds)} seeds and {len(days)} days for {n_days} days'
+    layout = G if isinstance(G, core.StoreLayout) else core.StoreLayout(G)
+    # The profile (with config['profile_dir']) is written once for the whole batch
+    with instrumentation.worker_profile(config.get('profile_dir', None)):
+        day_results = [simulate_one_day(config, layout, path_generator_function, path_generator_args, seed=day_seed,
+                                        day=day, compact=True, ragged_stats_to_pack=ragged_stats_to_pack)
+                       for day, day_seed in zip(days, day_seeds)]
+    return pack_day_batch(days, day_results)
+
+
 def simulate_several_days(config: dict,
                           G: nx.Graph,
                         #   extra_outputs,
                           path_generator_function,
                           path_generator_args: list,
                           num_iterations: int = 1000,
-                          use_parallel: bool = False):
-    """Run several simulations and return selected number of stats from these simulations"""
+                          use_parallel: bool = False,
+                          seed: Optional[int] = None,
+                          output_dir: Optional[str] = None,
+                          chunk_size: int = 1024,
+                          histogram_bins: Optional[dict] = None,
+                          tasks_per_chunk: Optional[int] = None,
+                          executor: Optional[Executor] = None) -> SimulationResults:
+    """Run several simulations and return selected number of stats from these simulations, as a SimulationResults
+    record of df_stats and one dataframe per per-node statistic (e.g. results.df_num_encounters_per_node)
+
+    Every day gets its own seed, spawned from numpy.random.SeedSequence(seed), so the days are independent (also
+    across worker processes) and each day's seed is recorded in the seed column of df_stats. Using the same seed
+    for several configs gives common random numbers across them. If seed is None, fresh entropy is used.
+
+    With use_parallel=True, every PathCorpus in path_generator_args is moved to shared memory for the duration of the
+    run, so that tasks only carry a small handle and all workers read the same copy of the corpus. A PathCorpus loaded
+    from a corpus file is already shared, as workers memory-map the same file. Days are sent to the workers in batches
+    of tasks_per_chunk days (by default about four batches per worker, at most 32 days each). Every worker builds the
+    StoreLayout of G once and every batch sends back one compact DayBatchResults record (see simulate_days_batch);
+    the dataframes are only built once, at the end.
+    To run the days elsewhere, e.g. on several machines, pass an executor (see executors.py); it replaces use_parallel
+    and is not shut down at the end, so it can be used for several runs.
+
+    The results of every day are folded into preallocated arrays as they arrive (see results_collector.py).
+    With output_dir, they are instead written to Parquet files in output_dir every chunk_size days, so that memory use
+    does not grow with num_iterations, and the paths of the files are returned instead of the dataframes.
+    histogram_bins maps per-customer statistics (e.g. 'exposure_times' or 'shopping_times') to histogram bin edges;
+    values outside the bins are not counted. The histograms are in df_stats.attrs['histograms'] (or in output_dir)."""
 
     # Run simulations
 
     # path_generation = config.get('path_generation', 'synthetic')
     # path_generator_function, path_generator_args = get_path_generator(G, path_generation, zone_paths=extra_outputs,
     #                                                                   synthetic_path_generator_args=extra_outputs)
-    if use_parallel:
-        args = [config, G, path_generator_function, path_generator_args]
-        repeated_args = zip(*[repeat(item, num_iterations) for item in args])
-        num_cores = multiprocessing.cpu_count()
-        with multiprocessing.Pool(num_cores) as p:
-            with tqdm(total=num_iterations) as pbar:
-                results = []
-                for i, results_dict in enumerate(p.istarmap(simulate_one_day, repeated_args)):
-                    results.append(results_dict)
+    day_seeds = get_day_seeds(num_iterations, seed)
+    collector = ResultsCollector(num_iterations, range(len(G)), output_dir=output_dir, chunk_size=chunk_size,
+                                 histogram_bins=histogram_bins)
+    with _DayRunner(config, G, path_generator_function, path_generator_args, day_seeds,
+                    collector.get_ragged_stats_to_pack(), use_parallel, tasks_per_chunk, executor) as runner:
+        for day, day_results in tqdm(runner.run(range(num_iterations)), total=num_iterations):
+            collector.add(day, day_results)
+    return collector.get_results()
+
+
+def simulate_until_converged(config: dict,
+                             G: nx.Graph,
+                             path_generator_function,
+                             path_generator_args: list,
+                             target_stats: List[str],
+                             rel_tol: float = 0.05,
+                             confidence: float = 0.95,
+                             batch_size: int = 50,
+                             min_days: int = 30,
+                             max_days: int = 1000,
+                             use_parallel: bool = False,
+                             seed: Optional[int] = None,
+                             output_dir: Optional[str] = None,
+                             chunk_size: int = 1024,
+                             histogram_bins: Optional[dict] = None,
+                             tasks_per_chunk: Optional[int] = None,
+                             executor: Optional[Executor] = None) -> SimulationResults:
+    """Like simulate_several_days, but run days in batches of batch_size days until the confidence interval of the
+    mean of every stat in target_stats (scalar stats of df_stats, e.g. 'num_contacts') has a half-width of at most
+    rel_tol times the mean, or until max_days days have run (see convergence.py).
+
+    Day i gets the same seed as in simulate_several_days(..., num_iterations=max_days, seed=seed), so a converged run
+    equals the first days of a fixed-length run. With use_parallel=True (or an executor), all batches run on the same
+    workers.
+    The convergence report (num_days, mean, half_width, rel_half_width and converged per target stat) is in
+    df_stats.attrs['convergence'], or in output_dir/convergence.parquet with output_dir."""
+    monitor = ConvergenceMonitor(target_stats, rel_tol=rel_tol, confidence=confidence, min_days=min_days)
+    day_seeds = get_day_seeds(max_days, seed)
+    collector = ResultsCollector(max_days, range(len(G)), output_dir=output_dir, chunk_size=chunk_size,
+                                 histogram_bins=histogram_bins)
+    num_days = 0
+    with _DayRunner(config, G, path_generator_function, path_generator_args, day_seeds,
+                    collector.get_ragged_stats_to_pack(), use_parallel, tasks_per_chunk, executor) as runner:
+        with tqdm(total=max_days) as pbar:
+            while num_days < max_days and not monitor.has_converged():
+                batch_days = range(num_days, min(num_days + batch_size, max_days))
+                batch_scalars = []
+                for day, day_results in runner.run(batch_days):
+                    collector.add(day, day_results)
+                    batch_scalars.append(day_results.scalars)
                     pbar.update()
+                monitor.update(np.concatenate(batch_scalars))
+                num_days = batch_days.stop
+    report = monitor.get_report()
+    logging.info(f'Stopped after {num_days} of at most {max_days} days:\n{report}')
+    collector.truncate(num_days)
+    results = collector.get_results()
+    if output_dir is not None:
+        report.to_parquet(os.path.join(output_dir, 'convergence.parquet'))
     else:
-        results = []
-        for _ in tqdm(range(num_iterations)):
-            results_dict = simulate_one_day(config, G, path_generator_function, path_generator_args)
-            results.append(results_dict)
-
-    # Initialize containers to save any scalar statistics
-    df_num_encounters_per_node_list = []
-    df_exposure_time_per_node_list = []
-    stats_dict = {}
-    cols_to_record = [key for key, val in results_dict.items()
-                      if isinstance(val, (int, np.integer)) or isinstance(val, (float, float))]
-    cols_to_record += ['exposure_times']
-    cols_not_recording = [key for key in results_dict.keys() if key not in cols_to_record]
-    logging.info(f'Recording the scalar stats for {cols_to_record}.')
-    logging.info(f'We are not recording {cols_not_recording}.')
-    for stat in cols_to_record:
-        stats_dict[stat] = []
-
-    # Record encounter stats as well
-    logging.info('Recording stats for df_num_encounters_per_node, df_exposure_time_per_node')
-    for i in range(num_iterations):
-        results_dict = results[i]
-        df_num_encounters_per_node_list.append(results_dict['df_num_encounters_per_node'])
-        df_exposure_time_per_node_list.append(results_dict['df_exposure_time_per_node'])
-        for col in cols_to_record:
-            stats_dict[col].append(results_dict[col])
-    df_stats = pd.DataFrame(stats_dict)
-    df_num_encounter_per_node_stats = pd.concat(df_num_encounters_per_node_list).reset_index(drop=True)
-    df_encounter_time_per_node_stats = pd.concat(df_exposure_time_per_node_list).reset_index(drop=True)
-    return df_stats, df_num_encounter_per_node_stats, df_encounter_time_per_node_stats
+        results.df_stats.attrs['convergence'] = report
+    return results
+
+
+class _DayRunner(object):
+    """Runs days of one config on an executor (see executors.py), whose workers are initialized with the config, G
+    and the path generator once. If the executor shares memory with this process (use_parallel=True), every PathCorpus
+    in path_generator_args is moved to shared memory while the runner is open (see simulate_several_days)."""
+
+    def __init__(self, config: dict, G: nx.Graph, path_generator_function, path_generator_args: list,
+                 day_seeds: List[int], ragged_stats_to_pack: List[str], use_parallel: bool = False,
+                 tasks_per_chunk: Optional[int] = None, executor: Optional[Executor] = None):
+        self.config = trace_sinks.with_trace_run_id(config)
+        self.G = G
+        self.path_generator_function = path_generator_function
+        self.path_generator_args = path_generator_args
+        self.day_seeds = day_seeds
+        self.ragged_stats_to_pack = ragged_stats_to_pack
+        self.tasks_per_chunk = tasks_per_chunk
+        self.owns_executor = executor is None
+        self.executor = get_executor(use_parallel, executor)
+
+    def __enter__(self):
+        if self.executor.shares_memory:
+            self.path_generator_args = [SharedPathCorpus(arg) if isinstance(arg, PathCorpus) and arg.file_path is None
+                                        else arg for arg in self.path_generator_args]
+        self.executor.start(_init_day_worker, (self.config, self.G, self.path_generator_function,
+                                               self.path_generator_args, self.ragged_stats_to_pack))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.owns_executor:
+            self.executor.shutdown()
+        else:
+            self.executor.finish()
+        for arg in self.path_generator_args:
+            if isinstance(arg, SharedPathCorpus):
+                arg.unlink()
+
+    def run(self, days: range):
+        """Yield (day, DayResults) for every day of days, in order of completion. The days are sent to the workers
+        in batches of tasks_per_chunk consecutive days (see simulate_days_batch)."""
+        tasks_per_chunk = self.tasks_per_chunk
+        if tasks_per_chunk is None:
+            tasks_per_chunk = min(max(len(days) // (4 * self.executor.num_workers), 1), 32)
+        tasks = [(list(batch_days), [self.day_seeds[day] for day in batch_days])
+                 for batch_days in (days[i:i + tasks_per_chunk] for i in range(0, len(days), tasks_per_chunk))]
+        for batch in self.executor.imap_unordered(_simulate_days_batch_task, tasks):
+            yield from batch.iter_days()
+
+
+# (config, StoreLayout, path_generator_function, path_generator_args, ragged_stats_to_pack) of the worker process,
+# set by _init_day_worker
+_worker_day_args: tuple = ()
+
+
+def _init_day_worker(config: dict, G: nx.Graph, path_generator_function, path_generator_args: list,
+                     ragged_stats_to_pack: List[str]):
+    global _worker_day_args
+    path_corpus.clear_attached_corpora()
+    _worker_day_args = (config, core.StoreLayout(G), path_generator_function, path_generator_args,
+                        ragged_stats_to_pack)
+
+
+def _simulate_days_batch_task(task: tuple) -> DayBatchResults:
+    """simulate_days_batch for task = (days, day_seeds), with the arguments the worker was initialized with."""
+    days, day_seeds = task
+    config, layout, path_generator_function, path_generator_args, ragged_stats_to_pack = _worker_day_args
+    return simulate_days_batch(config, layout, path_generator_function, path_generator_args, len(day_seeds),
+                               day_seeds=day_seeds, days=days, ragged_stats_to_pack=ragged_stats_to_pack)
+
+
+def get_day_seeds(num_days: int, seed: Optional[int] = None) -> List[int]:
+    """Derive independent seeds for num_days days from seed using numpy.random.SeedSequence.
+    Every day seed is a 63-bit integer from the state of a child of the SeedSequence, so that it fits in the int64 seed
+    column of df_stats and a day can be re-run from it. simulate_one_day seeds random and np.random with all of its
+    bits (see get_np_random_seed), so two of 100000 days are the same with a probability of only about 5e-10."""
+    seed_sequence = np.random.SeedSequence(seed)
+    logging.info(f'Seed sequence entropy: {seed_sequence.entropy}')
+    return [int(child.generate_state(1, np.uint64)[0] >> np.uint64(1)) for child in seed_sequence.spawn(num_days)]
+
+
+def get_np_random_seed(seed: int) -> Union[int, np.ndarray]:
+    """Seed for np.random.seed that uses all bits of seed: seeds below 2 ** 32 are passed on as they are (so they seed
+    np.random as before), larger ones as an array of 32-bit words."""
+    if seed < 2 ** 32:
+        return seed
+    return np.array([(seed >> shift) & 0xFFFFFFFF for shift in range(0, seed.bit_length(), 32)], dtype=np.uint32)
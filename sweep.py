@@ -0,0 +1,273 @@
+"""Parameter sweeps: many configs x replications on one worker pool.
+
+A sweep runs num_replications days for every config of a grid (see make_config_grid) on a single multiprocessing
+pool (or any other executor, see executors.py). The store networks and path generators of all layouts are sent to
+every worker once, when the sweep starts (every PathCorpus is moved to shared memory first), so tasks only carry a
+config and a batch of days with their seeds.
+Every config picks its layout with the 'layout' key (default 'original'), e.g.
+
+    layouts = {'original': (G, path_generator_function, path_generator_args),
+               'oneway': (G_oneway, path_generator_function, path_generator_args_oneway)}
+    configs = make_config_grid(config, {'arrival_rate': [1.5, 2.5], 'layout': ['original', 'oneway']})
+    results = run_sweep(configs, layouts, num_replications=1000, seed=0, checkpoint_dir='sweep_checkpoint')
+
+iter_sweep yields the results of every (config, day) as they arrive, tagged with the index of the config.
+With checkpoint_dir, every result is also appended to a checkpoint file, and a sweep that is restarted with the same
+configs, number of replications and seed only runs the days that are missing.
+"""
+import itertools
+import json
+import logging
+import os
+import pickle
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from executors import Executor, InProcessExecutor, PoolExecutor
+import path_corpus
+import trace_sinks
+from path_corpus import PathCorpus, SharedPathCorpus
+from core import StoreLayout
+from results_collector import DayBatchResults, DayResults, ResultsCollector, SimulationResults, ragged_stats
+from simulator import get_day_seeds, simulate_days_batch
+
+# (G, path_generator_function, path_generator_args) of a layout
+Layout = Tuple[nx.Graph, object, list]
+
+default_layout = 'original'
+
+# Layouts of the worker process, with a StoreLayout instead of G, set by _init_sweep_worker
+_worker_layouts: Dict[str, Tuple[StoreLayout, object, list]] = {}
+
+
+def make_config_grid(base_config: dict, grid: Dict[str, list]) -> List[dict]:
+    """All combinations of the values in grid, each applied on top of base_config.
+    E.g. make_config_grid(config, {'arrival_rate': [1, 2], 'layout': ['original', 'oneway']}) gives 4 configs."""
+    keys = list(grid)
+    return [{**base_config, **dict(zip(keys, values))} for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def get_layout_name(config: dict, layouts: Dict[str, Layout]) -> str:
+    layout = config.get('layout', default_layout)
+    if layout not in layouts:
+        raise ValueError(f'Unknown layout == {layout}')
+    return layout
+
+
+def _share_layouts(layouts: Dict[str, Layout]) -> Dict[str, Layout]:
+    """Copy of layouts with every in-memory PathCorpus in the path generator args moved to shared memory."""
+    return {name: (G, path_generator_function,
+                   [SharedPathCorpus(arg) if isinstance(arg, PathCorpus) and arg.file_path is None else arg
+                    for arg in path_generator_args])
+            for name, (G, path_generator_function, path_generator_args) in layouts.items()}
+
+
+def _unlink_layouts(layouts: Dict[str, Layout]):
+    for _, _, path_generator_args in layouts.values():
+        for arg in path_generator_args:
+            if isinstance(arg, SharedPathCorpus):
+                arg.unlink()
+
+
+def _init_sweep_worker(layouts: Dict[str, Layout]):
+    global _worker_layouts
+    path_corpus.clear_attached_corpora()
+    _worker_layouts = {name: (StoreLayout(G), path_generator_function, path_generator_args)
+                       for name, (G, path_generator_function, path_generator_args) in layouts.items()}
+
+
+def _simulate_sweep_task(task: tuple) -> Tuple[int, DayBatchResults]:
+    """(config_index, compact results) of task = (config_index, config, days, day_seeds, ragged_stats_to_pack)."""
+    config_index, config, days, day_seeds, ragged_stats_to_pack = task
+    layout, path_generator_function, path_generator_args = _worker_layouts[get_layout_name(config, _worker_layouts)]
+    return config_index, simulate_days_batch(config, layout, path_generator_function, path_generator_args, len(days),
+                                             day_seeds=day_seeds, days=days,
+                                             ragged_stats_to_pack=ragged_stats_to_pack)
+
+
+class SweepCheckpoint(object):
+    """Append-only file of the (config_index, day, DayResults) records of a sweep, next to a sweep.json file that
+    describes the sweep (configs, number of replications and seed entropy)."""
+
+    def __init__(self, checkpoint_dir: Union[str, os.PathLike]):
+        self.checkpoint_dir = checkpoint_dir
+        self.description_path = os.path.join(checkpoint_dir, 'sweep.json')
+        self.results_path = os.path.join(checkpoint_dir, 'results.pkl')
+        self._file = None
+
+    def get_saved_entropy(self) -> Optional[int]:
+        """Seed entropy of the checkpointed sweep, if there is one."""
+        if not os.path.exists(self.description_path):
+            return None
+        with open(self.description_path) as f:
+            return int(json.load(f)['entropy'])
+
+    def open(self, description: dict) -> List[Tuple[int, int, DayResults]]:
+        """Start the sweep, or resume it if the checkpoint has the same description.
+        Returns the records of the days that are already done."""
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        records = []
+        if os.path.exists(self.description_path):
+            with open(self.description_path) as f:
+                old_description = json.load(f)
+            if old_description != json.loads(json.dumps(description, default=str)):
+                raise ValueError(f'The checkpoint in {self.checkpoint_dir} belongs to a different sweep')
+            records = self._read_records()
+        else:
+            with open(self.description_path, 'w') as f:
+                json.dump(description, f, indent=1, default=str)
+            open(self.results_path, 'wb').close()
+        self._file = open(self.results_path, 'ab')
+        return records
+
+    def _read_records(self) -> List[Tuple[int, int, DayResults]]:
+        """Read all complete records and cut off a record that was only partly written (e.g. after a crash)."""
+        records = []
+        end_of_records = 0
+        with open(self.results_path, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                    break
+                end_of_records = f.tell()
+        with open(self.results_path, 'r+b') as f:
+            f.truncate(end_of_records)
+        logging.info(f'Resuming sweep with {len(records)} days from {self.results_path}.')
+        return records
+
+    def write(self, config_index: int, day: int, day_results: DayResults):
+        pickle.dump((config_index, day, day_results), self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_sweep(configs: List[dict], layouts: Dict[str, Layout], num_replications: int = 1000,
+               seed: Optional[int] = None, checkpoint_dir: Optional[Union[str, os.PathLike]] = None,
+               use_parallel: bool = True, num_processes: Optional[int] = None, tasks_per_chunk: Optional[int] = None,
+               ragged_stats_to_pack: Optional[List[str]] = None,
+               executor: Optional[Executor] = None) -> Iterator[Tuple[int, int, DayResults]]:
+    """
+    Run num_replications days of every config and yield (config_index, day, DayResults) as the days finish.
+
+    :param configs: Simulation configs, e.g. from make_config_grid. The 'layout' key selects the layout.
+    :param layouts: Maps layout names to (G, path_generator_function, path_generator_args)
+    :param num_replications: Number of days per config
+    :param seed: Every config gets the same day seeds (get_day_seeds), so configs are compared with common random
+    numbers. If seed is None, fresh entropy is used (or the entropy recorded in the checkpoint, when resuming).
+    :param checkpoint_dir: If given, results are checkpointed there and a restarted sweep skips the days that are
+    done (their results are yielded first)
+    :param use_parallel: Run the days on a pool of num_processes worker processes (default: one per core)
+    :param tasks_per_chunk: Number of days of a config that a worker simulates in one batch (simulate_days_batch; by
+    default about four batches per worker, at most 32 days each)
+    :param ragged_stats_to_pack: Per-customer lists to return (see pack_day_results)
+    :param executor: Run the days on this executor instead (e.g. a SocketExecutor, see executors.py). It is not shut
+    down at the end, so it can be used for several sweeps.
+    """
+    for config in configs:
+        get_layout_name(config, layouts)
+    if ragged_stats_to_pack is None:
+        ragged_stats_to_pack = ragged_stats
+    checkpoint = None if checkpoint_dir is None else SweepCheckpoint(checkpoint_dir)
+    if seed is None and checkpoint is not None:
+        seed = checkpoint.get_saved_entropy()
+    entropy = np.random.SeedSequence(seed).entropy
+    day_seeds = get_day_seeds(num_replications, entropy)
+    done = set()
+    if checkpoint is not None:
+        description = {'configs': configs, 'num_replications': num_replications, 'entropy': str(entropy),
+                       'ragged_stats_to_pack': ragged_stats_to_pack}
+        for config_index, day, day_results in checkpoint.open(description):
+            done.add((config_index, day))
+            yield config_index, day, day_results
+    days_to_run = [[day for day in range(num_replications) if (config_index, day) not in done]
+                   for config_index in range(len(configs))]
+    num_days_to_run = sum(len(days) for days in days_to_run)
+
+    if num_days_to_run == 0:
+        if checkpoint is not None:
+            checkpoint.close()
+        return
+    owns_executor = executor is None
+    if owns_executor:
+        executor = PoolExecutor(num_processes) if use_parallel else InProcessExecutor()
+    worker_layouts = _share_layouts(layouts) if executor.shares_memory else layouts
+    if tasks_per_chunk is None:
+        tasks_per_chunk = min(max(num_days_to_run // (4 * executor.num_workers), 1), 32)
+    # Batches of days of one config
+    # Every config of this (part of the) sweep writes its own trace files (see trace_sinks.py)
+    run_id = trace_sinks.new_trace_run_id()
+    run_configs = [dict(config, trace_run_id=f'{run_id}_{config_index}')
+                   if config.get('trace', 'off') in ['text', 'binary'] and 'trace_run_id' not in config else config
+                   for config_index, config in enumerate(configs)]
+    if any(run_config is not config for run_config, config in zip(run_configs, configs)):
+        logging.info(f'Writing the traces of this sweep with run id {run_id}_<config index>.')
+    tasks = [(config_index, run_configs[config_index], days[i:i + tasks_per_chunk],
+              [day_seeds[day] for day in days[i:i + tasks_per_chunk]], ragged_stats_to_pack)
+             for config_index, days in enumerate(days_to_run) for i in range(0, len(days), tasks_per_chunk)]
+    try:
+        executor.start(_init_sweep_worker, (worker_layouts,))
+        with tqdm(total=num_days_to_run) as pbar:
+            for config_index, batch in executor.imap_unordered(_simulate_sweep_task, tasks):
+                for day, day_results in batch.iter_days():
+                    if checkpoint is not None:
+                        checkpoint.write(config_index, day, day_results)
+                    yield config_index, day, day_results
+                    pbar.update()
+    finally:
+        if owns_executor:
+            executor.shutdown()
+        else:
+            executor.finish()
+        if worker_layouts is not layouts:
+            _unlink_layouts(worker_layouts)
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def run_sweep(configs: List[dict], layouts: Dict[str, Layout], num_replications: int = 1000,
+              seed: Optional[int] = None, checkpoint_dir: Optional[Union[str, os.PathLike]] = None,
+              output_dir: Optional[Union[str, os.PathLike]] = None, chunk_size: int = 1024,
+              histogram_bins: Optional[dict] = None, **kwargs) -> List[SimulationResults]:
+    """Run a sweep (see iter_sweep) and return the results of every config, in the order of configs, in the same
+    form as simulate_several_days. The config of the results is in df_stats.attrs['config'].
+    With output_dir, the results of config i are written to Parquet files in output_dir/config_<i> instead."""
+    collectors = []
+    for config_index, config in enumerate(configs):
+        G = layouts[get_layout_name(config, layouts)][0]
+        config_output_dir = None if output_dir is None else os.path.join(output_dir, f'config_{config_index}')
+        collectors.append(ResultsCollector(num_replications, range(len(G)), output_dir=config_output_dir,
+                                           chunk_size=chunk_size, histogram_bins=histogram_bins))
+    for config_index, day, day_results in iter_sweep(configs, layouts, num_replications, seed, checkpoint_dir,
+                                                     ragged_stats_to_pack=collectors[0].get_ragged_stats_to_pack(),
+                                                     **kwargs):
+        collectors[config_index].add(day, day_results)
+
+    results = []
+    for config, collector in zip(configs, collectors):
+        config_results = collector.get_results()
+        if output_dir is None:
+            config_results.df_stats.attrs['config'] = config
+        results.append(config_results)
+    return results
+
+
+def get_sweep_summary(configs: List[dict], results: List[SimulationResults], stats: List[str]) -> pd.DataFrame:
+    """One row per config with the swept config values and the mean of every stat in stats over the days."""
+    swept_keys = [key for key in dict.fromkeys(itertools.chain(*configs))
+                  if len({repr(config.get(key)) for config in configs}) > 1]
+    rows = []
+    for config, config_results in zip(configs, results):
+        df_stats = config_results.df_stats
+        row = {key: config.get(key) for key in swept_keys}
+        row.update({f'mean_{stat}': df_stats[stat].mean() for stat in stats})
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -1,11 +1,13 @@
+import argparse
+import json
+import os
 import random
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 from covid19_supermarket_abm.utils.create_store_network import create_store_network
 import networkx as nx
 import numpy as np
-from covid19_supermarket_abm.utils.create_synthetic_baskets import get_all_shortest_path_dicts
-from covid19_supermarket_abm.utils.load_example_data import load_example_store_graph, load_example_paths
-import json
+from path_corpus import PathCorpus, PathCorpusWriter, ShortestPathTable, load_path_corpus
+from shortest_path_cache import get_shortest_path_table
 
 """The synthetic path generator generates a random customer path as follows:
     First, it samples the size K of the shopping basket using a log-normal random variable with parameter mu and sigma.
@@ -95,81 +97,70 @@ edges = [
     (123, 145), (145, 146), (84, 85), (148, 147), (9, 11), (139, 199), (51, 198)
 ]
 
-# # FOR ONEWAY SETUP
-# edges = [
-#      (4, 5), (5, 6), (6, 7), (7, 8), (8, 9), (9, 12), (12, 13), (13, 14), (14, 15), (15, 16), (16, 17), (17, 18), (18, 19), (19, 20),
-#     (20, 21), (21, 22), (22, 23), (26, 25), (27, 26), (28, 27), (29, 28), (30, 29), (31, 30),
-# (32, 31), (33, 32), (34, 33), (35, 34), (36, 35), (37, 36), (38, 37), 
-# (38, 31), (39, 38), (40, 39), (148, 147), (56, 198), (139, 199), (122, 102),  (124, 123), (199, 140), (185, 184),
-
-
-#     (43, 44), (44, 45), (45, 46), (46, 47), (47, 48), (48, 49), (49, 50), (50, 51),
-#     (51, 52), (52, 53), (53, 54), (54, 55), (55, 56), (57, 58), (58, 59), (59, 60), (60, 61),
-#     (64, 63), (65, 64), (66, 65), (67, 66), (68, 67), (69, 68), (70, 69), (71, 70),
-
-
-# (72, 71), (73, 72), (74, 73), (75, 74), (76, 75), (77, 76), (78, 77), (79, 78), (80, 79), (81, 80),
-#     (83, 84), (85, 86), (86, 87), (87, 88), (88, 89), (89, 90), (90, 91), (91, 92),
-#     (92, 93), (93, 94), (94, 95), (95, 96), (96, 97), (97, 98), (98, 99), (99, 100), (100, 101),
-#     (104, 103), (105, 104), (106, 105), (107, 106), (108, 107), (109, 108), (110, 109), (111, 110), (84, 85),  (102, 122),
-
-
-# (112, 111), (113, 112), (114, 113), (115, 114), (116, 115), (117, 116), (118, 117), (119, 118), (120, 119),
-# (121, 120), (123, 124), (124, 125), (125, 126), (126, 127), (127, 128), (128, 129),
-#     (129, 130), (130, 131), (131, 132), (132, 133), (133, 134), (134, 135), (135, 136), (136, 137), (137, 138),
-#     (138, 139), (140, 141), (141, 142), (142, 143), (143, 144),
+# FOR ONEWAY SETUP (use with directed=True)
+oneway_edges = [
+    (4, 5), (5, 6), (6, 7), (7, 8), (8, 9), (9, 12), (12, 13), (13, 14), (14, 15), (15, 16), (16, 17), (17, 18), (18, 19), (19, 20),
+    (20, 21), (21, 22), (22, 23), (26, 25), (27, 26), (28, 27), (29, 28), (30, 29), (31, 30),
+    (32, 31), (33, 32), (34, 33), (35, 34), (36, 35), (37, 36), (38, 37),
+    (38, 31), (39, 38), (40, 39), (148, 147), (56, 198), (139, 199), (122, 102),  (124, 123), (199, 140), (185, 184),
 
+    (43, 44), (44, 45), (45, 46), (46, 47), (47, 48), (48, 49), (49, 50), (50, 51),
+    (51, 52), (52, 53), (53, 54), (54, 55), (55, 56), (57, 58), (58, 59), (59, 60), (60, 61),
+    (64, 63), (65, 64), (66, 65), (67, 66), (68, 67), (69, 68), (70, 69), (71, 70),
 
-#     (166, 167), (167, 168), (168, 169), (169, 170), (170, 171), (171, 172), (172, 173), (173, 174), (174, 175),
-#     (175, 176), (176, 177), (177, 178), (178, 179), (179, 180), (180, 181), (181, 182), (182, 183), (183, 184),
-#     (184, 185), (187, 186), (188, 187), (189, 188), (190, 189), (191, 190), (192, 191), (193, 192),
-# (194, 193), (195, 194), (196, 195), (197, 196), (198, 57),
+    (72, 71), (73, 72), (74, 73), (75, 74), (76, 75), (77, 76), (78, 77), (79, 78), (80, 79), (81, 80),
+    (83, 84), (85, 86), (86, 87), (87, 88), (88, 89), (89, 90), (90, 91), (91, 92),
+    (92, 93), (93, 94), (94, 95), (95, 96), (96, 97), (97, 98), (98, 99), (99, 100), (100, 101),
+    (104, 103), (105, 104), (106, 105), (107, 106), (108, 107), (109, 108), (110, 109), (111, 110), (84, 85),  (102, 122),
 
-# (149, 148), (150, 149), (151, 150), (152, 151), (153, 152), (154, 153), (155, 154), 
-# (156, 155), (157, 156), (158, 157), (159, 158), (160, 159), (161, 160), (162, 161), (163, 162), (164, 163), (165, 164),
-    
-    
-#     # verticals
-#     (4, 24), (24, 42), (42, 62), (62, 82), (82, 102), (102, 123), (146, 166), (166, 186),
-#     (147, 166),  (6, 25), (25, 43), (43, 63), (63, 83), (83, 103), (103, 124), (124, 147),
-#     (11, 9), (11, 28), (28, 46), (46, 66), (66, 86), (86, 106), (106, 127),
-#     (14, 31), (31, 49), (49, 69), (69, 89), (89, 109), (109, 131),
-#     (10, 17), (17, 34), (34, 52), (52, 72), (72, 92), (92, 112), (112, 135),  
+    (112, 111), (113, 112), (114, 113), (115, 114), (116, 115), (117, 116), (118, 117), (119, 118), (120, 119),
+    (121, 120), (123, 124), (124, 125), (125, 126), (126, 127), (127, 128), (128, 129),
+    (129, 130), (130, 131), (131, 132), (132, 133), (133, 134), (134, 135), (135, 136), (136, 137), (137, 138),
+    (138, 139), (140, 141), (141, 142), (142, 143), (143, 144),
 
-#     (20, 37), (37, 55), (55, 75), (75, 95), (95, 115), (115, 138),
-#     (58, 78), (78, 98), (98, 118), (141, 162), (162, 181),
-#     (61, 81), (81, 101), (101, 121), (121, 144), (144, 165), (165, 184),
-#     (139, 159), (159, 178), (178, 197), (0, 1), (1, 2), (2, 3), (3, 4),
+    (166, 167), (167, 168), (168, 169), (169, 170), (170, 171), (171, 172), (172, 173), (173, 174), (174, 175),
+    (175, 176), (176, 177), (177, 178), (178, 179), (179, 180), (180, 181), (181, 182), (182, 183), (183, 184),
+    (184, 185), (187, 186), (188, 187), (189, 188), (190, 189), (191, 190), (192, 191), (193, 192),
+    (194, 193), (195, 194), (196, 195), (197, 196), (198, 57),
 
+    (149, 148), (150, 149), (151, 150), (152, 151), (153, 152), (154, 153), (155, 154),
+    (156, 155), (157, 156), (158, 157), (159, 158), (160, 159), (161, 160), (162, 161), (163, 162), (164, 163), (165, 164),
 
-#     (134, 155), (155, 174), (174, 193),
-#     (129, 151), (151, 170), (170, 189),
-#     (41, 59), (41, 60),
-#     (23, 40), (40, 57),
-#     (123, 145), (145, 146),   (9, 11),  
-    
+    # verticals
+    (4, 24), (24, 42), (42, 62), (62, 82), (82, 102), (102, 123), (146, 166), (166, 186),
+    (147, 166),  (6, 25), (25, 43), (43, 63), (63, 83), (83, 103), (103, 124), (124, 147),
+    (11, 9), (11, 28), (28, 46), (46, 66), (66, 86), (86, 106), (106, 127),
+    (14, 31), (31, 49), (49, 69), (69, 89), (89, 109), (109, 131),
+    (10, 17), (17, 34), (34, 52), (52, 72), (72, 92), (92, 112), (112, 135),
 
+    (20, 37), (37, 55), (55, 75), (75, 95), (95, 115), (115, 138),
+    (58, 78), (78, 98), (98, 118), (141, 162), (162, 181),
+    (61, 81), (81, 101), (101, 121), (121, 144), (144, 165), (165, 184),
+    (139, 159), (159, 178), (178, 197), (0, 1), (1, 2), (2, 3), (3, 4),
 
-#     (24, 4), (42, 24), (62, 42), (82, 62), (102, 82), (123, 102),
-#     (4, 3), (3, 2), (2, 1), (1, 0),
-#     (166, 147), (147, 124), (124, 103), (103, 83), (83, 63), (63, 43), (43, 25), (25, 6),
-#     (127, 106), (106, 86), (86, 66), (66, 46), (46, 28), (28, 9), 
+    (134, 155), (155, 174), (174, 193),
+    (129, 151), (151, 170), (170, 189),
+    (41, 59), (41, 60),
+    (23, 40), (40, 57),
+    (123, 145), (145, 146),   (9, 11),
 
+    (24, 4), (42, 24), (62, 42), (82, 62), (102, 82), (123, 102),
+    (4, 3), (3, 2), (2, 1), (1, 0),
+    (166, 147), (147, 124), (124, 103), (103, 83), (83, 63), (63, 43), (43, 25), (25, 6),
+    (127, 106), (106, 86), (86, 66), (66, 46), (46, 28), (28, 9),
 
-#     (189, 170), (170, 151), (151, 129),
-#     (193, 174), (174, 155), (155, 134),
-#     (131, 109), (109, 89), (89, 69), (69, 49), (49, 31), (31, 14), (11, 9),
-#     (135, 112), (112, 92), (92, 72), (72, 52), (52, 34), (34, 17), (17, 10), (197, 178), (178, 159), (159, 139), (138, 115), (115, 95), (95, 75), (75, 55), (55, 37), (37, 20),
-    
-#     (181, 162), (162, 141), (118, 98), (98, 78), (78, 58), (57, 40), (40, 23), (59, 41), (60, 41), (184, 165), (165, 144), (144, 121), (121, 101), (101, 81), (81, 61), (9, 11),
-#     (186, 166), (166, 146), (146, 145), (145, 123), (147, 166)
+    (189, 170), (170, 151), (151, 129),
+    (193, 174), (174, 155), (155, 134),
+    (131, 109), (109, 89), (89, 69), (69, 49), (49, 31), (31, 14), (11, 9),
+    (135, 112), (112, 92), (92, 72), (72, 52), (52, 34), (34, 17), (17, 10), (197, 178), (178, 159), (159, 139), (138, 115), (115, 95), (95, 75), (75, 55), (55, 37), (37, 20),
 
-# ]
+    (181, 162), (162, 141), (118, 98), (98, 78), (78, 58), (57, 40), (40, 23), (59, 41), (60, 41), (184, 165), (165, 144), (144, 121), (121, 101), (101, 81), (81, 61), (9, 11),
+    (186, 166), (166, 146), (146, 145), (145, 123), (147, 166)
+]
 
+layouts = {'original': edges,
+           'oneway': oneway_edges}
 
-G = create_store_network(pos, edges)
-# print(G)
-shortest_path_dict = get_all_shortest_path_dicts(G)
 mu = 0.07
 sigma = 0.76
 entrance_nodes = [0, 11, 122, 10, 41, 185]
@@ -179,17 +170,51 @@ intersections = [9, 57, 189, 170, 151, 129, 106, 86, 66, 46, 28, 127, 193, 174,
 item_nodes = [node for node in range(200) if node not in entrance_nodes and intersections]
 
 
+def create_layout_graph(layout: str = 'original', directed: bool = False) -> nx.Graph:
+    """Store network of one of the layouts of this module ('original' or 'oneway')."""
+    if layout not in layouts:
+        raise ValueError(f'Unknown layout == {layout}')
+    return create_store_network(pos, layouts[layout], directed=directed)
 
-def paths_generator_from_actual_paths(all_paths):
-    num_paths = len(all_paths)
-    while True:
-        i = np.random.randint(0, num_paths)
-        yield all_paths[i]
 
 
-def path_generator_from_transition_matrix(tmatrix: List[List[int]], shortest_path_dict: Dict):
+class CorpusPathGenerator(object):
+    """Iterator over uniformly random paths of all_paths. last_index is the index of the last path in all_paths,
+    so that traces can record the index instead of the whole path (see trace_sinks.py)."""
+
+    def __init__(self, all_paths):
+        self.all_paths = all_paths
+        self.num_paths = len(all_paths)
+        self.last_index = -1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> List[int]:
+        i = np.random.randint(0, self.num_paths)
+        self.last_index = int(i)
+        return self.all_paths[i]
+
+
+def paths_generator_from_actual_paths(all_paths):
+    return CorpusPathGenerator(all_paths)
+
+
+def path_generator_from_transition_matrix(tmatrix: Union[List[List[int]], 'TransitionTable'],
+                                          shortest_path_dict: Union[Dict, ShortestPathTable],
+                                          batch_size: int = 1000):
+    """Path generator that samples batch_size Markov chains at a time from the transition matrix
+    (see TransitionTable.sample_zone_paths) and maps them to full paths.
+    tmatrix can be a TransitionTable or a transition matrix as returned by get_transition_matrix, and
+    shortest_path_dict can be a ShortestPathTable or a dict of single shortest paths such as
+    dict(nx.all_pairs_dijkstra_path(G))."""
+    if not isinstance(tmatrix, TransitionTable):
+        tmatrix = TransitionTable.from_matrix(tmatrix)
+    if isinstance(shortest_path_dict, dict):
+        shortest_path_dict = ShortestPathTable.from_shortest_path_dict(shortest_path_dict, multiple_paths=False)
     while True:
-        yield zone_path_to_full_path(create_one_path(tmatrix), shortest_path_dict)
+        zone_paths = tmatrix.sample_zone_paths(batch_size)
+        yield from zone_paths_to_full_paths(zone_paths, shortest_path_dict)
 
 
 def get_transition_matrix(all_paths, num_states):
@@ -209,6 +234,96 @@ def get_transition_matrix(all_paths, num_states):
     return transition_matrix
 
 
+class TransitionTable(object):
+    """Sparse version of the transition matrix of get_transition_matrix, for sampling many Markov chains at once.
+
+    Row i of the matrix is stored in CSR form: targets[row_offsets[i]:row_offsets[i + 1]] are the states that can
+    follow state i, and cdf holds their cumulative probabilities shifted by i (the last entry of row i is i + 1).
+    This way, the next states of chains in states s are found with a single np.searchsorted(cdf, s + u) for uniform
+    random numbers u in [0, 1). The last state (num_states - 1) is the end state.
+    """
+
+    def __init__(self, row_offsets: np.ndarray, targets: np.ndarray, probabilities: np.ndarray):
+        self.num_states = len(row_offsets) - 1
+        self.row_offsets = row_offsets
+        self.targets = targets
+        self.probabilities = probabilities
+        row_lengths = np.diff(row_offsets)
+        rows = np.repeat(np.arange(self.num_states), row_lengths)
+        cdf = np.zeros(len(probabilities) + 1)
+        np.cumsum(probabilities, out=cdf[1:])
+        cdf = cdf[1:] - np.repeat(cdf[row_offsets[:-1]], row_lengths)
+        # Avoid rounding errors at the end of each row
+        cdf[row_offsets[1:][row_lengths > 0] - 1] = 1
+        self.cdf = rows + cdf
+
+    @classmethod
+    def from_paths(cls, all_paths: Union[List[List[int]], PathCorpus], num_states: int) -> 'TransitionTable':
+        """Vectorized version of get_transition_matrix (the transitions are counted with np.unique)."""
+        corpus = all_paths if isinstance(all_paths, PathCorpus) else PathCorpus.from_paths(all_paths)
+        n = num_states + 1  # number of states
+        nodes = corpus.nodes.astype(np.int64)
+        last_nodes = corpus.offsets[1:][corpus.path_lengths() > 0] - 1
+        is_transition = np.ones(len(nodes), dtype=bool)
+        is_transition[last_nodes] = False
+        transitions = np.flatnonzero(is_transition)
+        pairs = np.concatenate([nodes[transitions] * n + nodes[transitions + 1],
+                                nodes[last_nodes] * n + n - 1])  # ending
+        pairs, counts = np.unique(pairs, return_counts=True)
+        rows = pairs // n
+        row_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=row_offsets[1:])
+        row_totals = np.bincount(rows, weights=counts, minlength=n)
+        return cls(row_offsets, pairs % n, counts / row_totals[rows])
+
+    @classmethod
+    def from_matrix(cls, tmatrix: Union[List[List[float]], np.ndarray]) -> 'TransitionTable':
+        tmatrix = np.asarray(tmatrix, dtype=float)
+        rows, targets = np.nonzero(tmatrix)
+        probabilities = tmatrix[rows, targets]
+        probabilities = probabilities / np.bincount(rows, weights=probabilities, minlength=len(tmatrix))[rows]
+        row_offsets = np.zeros(len(tmatrix) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(tmatrix)), out=row_offsets[1:])
+        return cls(row_offsets, targets, probabilities)
+
+    def to_matrix(self) -> np.ndarray:
+        """Dense transition matrix (same values as get_transition_matrix)."""
+        tmatrix = np.zeros((self.num_states, self.num_states))
+        rows = np.repeat(np.arange(self.num_states), np.diff(self.row_offsets))
+        tmatrix[rows, self.targets] = self.probabilities
+        return tmatrix
+
+    def sample_zone_paths(self, num_paths: int, start_state: int = 0, max_length: int = 100000) -> PathCorpus:
+        """Vectorized version of create_one_path: advance num_paths Markov chains from start_state in lockstep
+        until every chain has reached the end state. Chains longer than max_length are cut off."""
+        end_state = self.num_states - 1
+        path_ids = [np.arange(num_paths)]
+        states = [np.full(num_paths, start_state, dtype=np.int64)]
+        active_path_ids = path_ids[0]
+        active_states = states[0]
+        length = 1
+        while len(active_path_ids) > 0:
+            if length > max_length:
+                print(f'{len(active_path_ids)} generated paths are over {max_length} stops long. '
+                      f'Something must have gone wrong!')
+                break
+            next_states = self.targets[np.searchsorted(self.cdf, active_states + np.random.rand(len(active_states)),
+                                                       side='right')]
+            is_active = next_states != end_state
+            active_path_ids = active_path_ids[is_active]
+            active_states = next_states[is_active]
+            path_ids.append(active_path_ids)
+            states.append(active_states)
+            length += 1
+
+        # Group the states by chain (a stable sort keeps every chain in order)
+        path_ids = np.concatenate(path_ids)
+        order = np.argsort(path_ids, kind='stable')
+        offsets = np.zeros(num_paths + 1, dtype=np.int64)
+        np.cumsum(np.bincount(path_ids, minlength=num_paths), out=offsets[1:])
+        return PathCorpus(offsets, np.concatenate(states)[order])
+
+
 def zone_path_to_full_path(zone_path, shortest_path_dict):
     full_path_dict = []
     for start, end in zip(zone_path[:-1], zone_path[1:]):
@@ -304,6 +419,80 @@ def sythetic_paths_generator(mu, sigma, entrance_nodes, exit_nodes, item_nodes,
     return mylist
 
 
+def generate_synthetic_corpus(mu, sigma, entrance_nodes, exit_nodes, item_nodes,
+                              shortest_path_table: ShortestPathTable, num_paths: int) -> PathCorpus:
+    """Vectorized version of sythetic_paths_generator that returns num_paths paths as a PathCorpus.
+    All baskets are sampled and expanded to full paths at once (see zone_paths_to_full_paths). Given the same random
+    state, the paths are the same as those of sythetic_paths_generator with the corresponding shortest_path_dict."""
+    num_items = sample_num_products_in_basket_batch(mu, sigma, num_paths)
+    random_entrance_nodes = np.random.choice(entrance_nodes, size=num_paths)
+    random_exit_nodes = np.random.choice(exit_nodes, size=num_paths)
+    concatenated_baskets = np.random.choice(item_nodes, size=np.sum(num_items))
+
+    # Zone sequences (entrance, items..., exit) of all baskets, concatenated
+    zone_offsets = np.zeros(num_paths + 1, dtype=np.int64)
+    np.cumsum(num_items + 2, out=zone_offsets[1:])
+    first_zones = zone_offsets[:-1]
+    last_zones = zone_offsets[1:] - 1
+    zones = np.empty(zone_offsets[-1], dtype=np.int64)
+    is_item = np.ones(len(zones), dtype=bool)
+    is_item[first_zones] = False
+    is_item[last_zones] = False
+    zones[first_zones] = random_entrance_nodes
+    zones[last_zones] = random_exit_nodes
+    zones[is_item] = concatenated_baskets
+
+    return zone_paths_to_full_paths(PathCorpus(zone_offsets, zones), shortest_path_table)
+
+
+def zone_paths_to_full_paths(zone_paths: PathCorpus, shortest_path_table: ShortestPathTable) -> PathCorpus:
+    """Vectorized version of zone_path_to_full_path_multiple_paths for a whole corpus of zone paths.
+    Every leg between consecutive zones picks one of its shortest paths with a single np.random.randint call, and the
+    legs are concatenated with one gather from the table's flat node array."""
+    zones = zone_paths.nodes.astype(np.int64)
+    num_paths = len(zone_paths)
+    path_lengths = zone_paths.path_lengths()
+    last_zones = zone_paths.offsets[1:][path_lengths > 0] - 1
+
+    # Legs between consecutive zones of the same zone path
+    is_leg_start = np.ones(len(zones), dtype=bool)
+    is_leg_start[last_zones] = False
+    leg_starts = np.flatnonzero(is_leg_start)
+    leg_sources = zones[leg_starts]
+    leg_targets = zones[leg_starts + 1]
+    leg_path_ids = np.repeat(np.arange(num_paths), np.maximum(path_lengths - 1, 0))
+    pairs = shortest_path_table.pair_ids(leg_sources, leg_targets)
+    first_shortest_paths = shortest_path_table.pair_offsets[pairs]
+    num_shortest_paths = shortest_path_table.pair_offsets[pairs + 1] - first_shortest_paths
+    if np.any(num_shortest_paths == 0):
+        i = np.flatnonzero(num_shortest_paths == 0)[0]
+        raise ValueError(f'There is no path from {leg_sources[i]} to {leg_targets[i]} in the store graph.')
+    leg_paths = first_shortest_paths + np.random.randint(0, num_shortest_paths)
+
+    # Concatenate the nodes of all legs
+    leg_path_starts = shortest_path_table.paths.offsets[leg_paths].astype(np.int64)
+    leg_lengths = shortest_path_table.paths.offsets[leg_paths + 1] - leg_path_starts
+    leg_node_offsets = np.cumsum(leg_lengths) - leg_lengths
+    node_positions = np.repeat(leg_path_starts - leg_node_offsets, leg_lengths) + np.arange(leg_lengths.sum())
+    nodes = shortest_path_table.paths.nodes[node_positions]
+    offsets = np.zeros(num_paths + 1, dtype=np.int64)
+    np.cumsum(np.bincount(leg_path_ids, weights=leg_lengths, minlength=num_paths).astype(np.int64), out=offsets[1:])
+    return PathCorpus(offsets, nodes)
+
+
+def synthetic_paths_stream(mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table,
+                           batch_size: int = 10000):
+    """Path generator that creates synthetic paths on the fly, batch_size paths at a time
+    (see generate_synthetic_corpus), so that simulations do not need a precomputed corpus.
+    shortest_path_table can also be a shortest_path_dict as returned by get_all_shortest_path_dicts."""
+    if isinstance(shortest_path_table, dict):
+        shortest_path_table = ShortestPathTable.from_shortest_path_dict(shortest_path_table)
+    while True:
+        corpus = generate_synthetic_corpus(mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table,
+                                           batch_size)
+        yield from corpus
+
+
 def get_next_term(num_states, trow):
     return random.choices(range(num_states), trow)[0]
 
@@ -333,61 +522,124 @@ def replace_till_zone(path, till_zone, all_till_zones):
 
 
 def get_path_generator(path_generation: str = 'empirical', G: Optional[nx.Graph]=None,
-                       full_paths: Optional[List[List[int]]]=None,
+                       full_paths: Optional[Union[List[List[int]], PathCorpus, str, os.PathLike]]=None,
                        zone_paths: Optional[List[List[int]]]=None,
                        synthetic_path_generator_args: Optional[list] = None):
     """Create path generator functions.
     Note that a zone path is a sequence of zones that a customer purchased items from, so consecutive zones in the sequence
     may not be adjacent in the store graph. We map the zone path to the full shopping path by assuming that
-    customers walk shortest paths between purchases."""
+    customers walk shortest paths between purchases. The shortest paths of G are cached on disk
+    (see shortest_path_cache.py), so they are only computed once per store layout.
+    For path_generation='empirical', full_paths can be a list of paths, a PathCorpus or the file path of a binary
+    corpus file (see path_corpus.py), which is memory-mapped."""
 
     # Decide how paths are generated
     if path_generation == 'empirical':
         path_generator_function = paths_generator_from_actual_paths
-        if full_paths is not None:
+        if isinstance(full_paths, (str, os.PathLike)):
+            path_generator_args = [load_path_corpus(full_paths)]
+        elif full_paths is not None:
             path_generator_args = [full_paths]
         else:
             assert zone_paths is not None, "If you use path_generation='empirical', you need to specify either zone_paths or full_paths"
             assert G is not None, "If you use path_generation='empirical' with zone_paths, you need to input the store network G"
-            shortest_path_dict = dict(nx.all_pairs_dijkstra_path(G))
-            shopping_paths = [zone_path_to_full_path(path, shortest_path_dict) for path in zone_paths]
-            full_paths = [zone_path_to_full_path(path, shortest_path_dict) for path in shopping_paths]
+            shortest_path_table = get_shortest_path_table(G, multiple_paths=False)
+            shopping_paths = zone_paths_to_full_paths(PathCorpus.from_paths(zone_paths), shortest_path_table)
+            full_paths = zone_paths_to_full_paths(shopping_paths, shortest_path_table)
             path_generator_args = [full_paths]
     elif path_generation == 'synthetic':
         assert synthetic_path_generator_args is not None, \
             "If you use path_generation='synthetic', " \
             "you need to input synthetic_path_generator_args=" \
-            "[mu, sigma, entrance_nodes, till_nodes, exit_nodes, item_nodes, shortest_path_dict]"
+            "[mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table]"
         assert type(synthetic_path_generator_args) is list, \
             "If you use path_generation='synthetic', " \
             "you need to input synthetic_path_generator_args=" \
-            "[mu, sigma, entrance_nodes, till_nodes, exit_nodes, item_nodes, shortest_path_dict]"
-        assert len(synthetic_path_generator_args) == 7, \
+            "[mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table]"
+        assert len(synthetic_path_generator_args) == 6, \
             "If you use path_generation='synthetic', " \
             "you need to input synthetic_path_generator_args=" \
-            "[mu, sigma, entrance_nodes, till_nodes, exit_nodes, item_nodes, shortest_path_dict]"
-        path_generator_function = sythetic_paths_generator
+            "[mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table]"
+        path_generator_function = synthetic_paths_stream
         path_generator_args = synthetic_path_generator_args  # [mu, sigma, entrance_nodes,
-        # till_nodes, exit_nodes, item_nodes, shortest_path_dict]
+        # exit_nodes, item_nodes, shortest_path_table]
     elif path_generation == 'tmatrix':
         assert zone_paths is not None, "If you use path_generation='tmatrix', you need to input zone_paths"
         assert G is not None, "If you use path_generation='tmatrix', you need to input the store network G"
-        shortest_path_dict = dict(nx.all_pairs_dijkstra_path(G))
-        shopping_paths = [zone_path_to_full_path(path, shortest_path_dict) for path in zone_paths]
-        tmatrix = get_transition_matrix(shopping_paths, len(G))
+        shortest_path_table = get_shortest_path_table(G, multiple_paths=False)
+        shopping_paths = zone_paths_to_full_paths(PathCorpus.from_paths(zone_paths), shortest_path_table)
+        tmatrix = TransitionTable.from_paths(shopping_paths, len(G))
         path_generator_function = path_generator_from_transition_matrix
-        path_generator_args = [tmatrix, shortest_path_dict]
+        path_generator_args = [tmatrix, shortest_path_table]
     else:
         raise ValueError(f'Unknown path_generation scheme == {path_generation}')
     return path_generator_function, path_generator_args
 
 
-zone_paths = sythetic_paths_generator(mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_dict)
-
-# file_path = '10^6_DIRECTIONAL.json' # for directed
-file_path = '10_6.json' 
 
-with open(file_path, 'w') as json_file:
-    json.dump(zone_paths, json_file)
+def write_synthetic_paths(file_path: Union[str, os.PathLike], num_paths: int, G: nx.Graph,
+                          output_format: str = 'corpus', chunk_size: int = 100000, seed: Optional[int] = None):
+    """
+    Generate num_paths synthetic paths on G (see generate_synthetic_corpus) and write them to file_path.
+    The paths are generated and written chunk_size paths at a time, so memory use does not grow with num_paths.
 
-print(f"The list has been written to {file_path}")
\ No newline at end of file
+    :param output_format: 'corpus' for a binary corpus file (see path_corpus.py) or 'json' for a list of paths
+    :param seed: Seed of np.random. The paths depend on both seed and chunk_size.
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    shortest_path_table = get_shortest_path_table(G)
+    chunk_sizes = [chunk_size] * (num_paths // chunk_size)
+    if num_paths % chunk_size:
+        chunk_sizes.append(num_paths % chunk_size)
+    chunks = (generate_synthetic_corpus(mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table, size)
+              for size in chunk_sizes)
+    if output_format == 'corpus':
+        with PathCorpusWriter(file_path, max_node=max(G)) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    elif output_format == 'json':
+        with open(file_path, 'w') as f:
+            f.write('[')
+            for i, chunk in enumerate(chunks):
+                if i > 0:
+                    f.write(', ')
+                f.write(', '.join(json.dumps(path) for path in chunk))
+            f.write(']')
+    else:
+        raise ValueError(f'Unknown output_format == {output_format}')
+
+
+def get_default_corpus_name(layout: str = 'original', directed: bool = False) -> str:
+    """File name (without extension) of the corpus of a layout: 10_6 for the original layout and 10^6_DIRECTIONAL for
+    the one-way setup (the oneway layout as a directed network). Other combinations get the layout and the direction in
+    their name, so that they never overwrite these two corpora."""
+    if layout not in layouts:
+        raise ValueError(f'Unknown layout == {layout}')
+    if (layout, directed) == ('original', False):
+        return '10_6'
+    if (layout, directed) == ('oneway', True):
+        return '10^6_DIRECTIONAL'
+    return f'10_6_{layout}_{"directed" if directed else "undirected"}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a corpus of synthetic shopping paths')
+    parser.add_argument('--num-paths', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--layout', choices=list(layouts), default='original')
+    parser.add_argument('--directed', action='store_true', help='Create a directed store network (one-way aisles)')
+    parser.add_argument('--format', choices=['corpus', 'json'], default='corpus')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--output', default=None,
+                        help='Output file (default: 10_6.corpus for the original layout, 10^6_DIRECTIONAL.corpus for '
+                             '--layout oneway --directed, see get_default_corpus_name)')
+    args = parser.parse_args()
+
+    file_path = args.output
+    if file_path is None:
+        file_path = f'{get_default_corpus_name(args.layout, args.directed)}.{args.format}'
+    G = create_layout_graph(args.layout, directed=args.directed)
+    write_synthetic_paths(file_path, args.num_paths, G, output_format=args.format, chunk_size=args.chunk_size,
+                          seed=args.seed)
+    print(f"The list has been written to {file_path}")
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# The modules of this repository are imported by name (import core, import simulator, ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import create_grid_market, create_random_full_paths  # noqa: E402
+from path_corpus import PathCorpus  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def G():
+    """Small 5 x 5 grid market."""
+    return create_grid_market(5, 5)
+
+
+@pytest.fixture(scope='session')
+def full_paths(G):
+    return create_random_full_paths(G, 500, seed=0)
+
+
+@pytest.fixture(scope='session')
+def corpus(full_paths):
+    return PathCorpus.from_paths(full_paths)
+
+
+@pytest.fixture
+def config():
+    """Short, quiet day on the small market."""
+    return {'arrival_rate': 2,
+            'traversal_time': 0.5,
+            'num_hours_open': 2,
+            'infection_proportion': 0.2,
+            'trace': 'off',
+            }
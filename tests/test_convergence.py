@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from convergence import ConvergenceMonitor, RunningStats
+from simulator import simulate_several_days, simulate_until_converged
+from synthetic_path_gen import paths_generator_from_actual_paths
+
+
+def test_running_stats_equal_numpy_on_split_batches():
+    values = np.random.default_rng(0).lognormal(5, 1, size=1000)
+    running_stats = RunningStats()
+    assert np.isnan(running_stats.variance)
+    for batch in np.split(values, [1, 7, 7, 300, 301, 650]):
+        running_stats.update(batch)
+    assert running_stats.count == len(values)
+    assert np.isclose(running_stats.mean, np.mean(values), rtol=1e-12)
+    assert np.isclose(running_stats.variance, np.var(values, ddof=1), rtol=1e-10)
+
+
+def test_monitor_rejects_unknown_stats():
+    monitor = ConvergenceMonitor(['num_contacts'])
+    with pytest.raises(ValueError, match='Unknown target stat'):
+        monitor.update(np.zeros(3, dtype=[('num_cust', float)]))
+
+
+def test_converged_run_equals_first_days_of_fixed_run(config, G, corpus):
+    config = dict(config, arrival_rate=4)
+    args = (config, G, paths_generator_from_actual_paths, [corpus])
+    converged = simulate_until_converged(*args, target_stats=['num_cust'], rel_tol=0.05, batch_size=5, min_days=10,
+                                         max_days=40, seed=0)
+    report = converged.df_stats.attrs['convergence']
+    num_days = len(converged.df_stats)
+    assert report.loc['num_cust', 'converged']
+    assert 10 <= num_days < 40 and num_days % 5 == 0
+    assert report.loc['num_cust', 'num_days'] == num_days
+    assert np.isclose(report.loc['num_cust', 'mean'], converged.df_stats.num_cust.mean())
+    fixed = simulate_several_days(*args, num_iterations=40, seed=0)
+    for name in converged._fields:
+        assert getattr(converged, name).equals(getattr(fixed, name).iloc[:num_days]), name
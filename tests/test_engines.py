@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from simulator import simulate_one_day
+from synthetic_path_gen import paths_generator_from_actual_paths
+from validation import compare_engines
+
+scenarios = {'default': {},
+             'node capacity': {'with_node_capacity': True, 'node_capacity': 3},
+             'node capacity (event wakeup)': {'with_node_capacity': True, 'node_capacity': 3,
+                                              'capacity_wakeup': 'event'},
+             'queueing': {'max_customers_in_store': 10, 'arrival_rate': 4},
+             }
+
+
+@pytest.mark.parametrize('scenario', list(scenarios))
+def test_engines_agree(config, G, corpus, scenario):
+    df = compare_engines(dict(config, **scenarios[scenario]), G, paths_generator_from_actual_paths, [corpus],
+                         num_days=30, seed=0)
+    assert df.passed.all(), df.to_string()
+
+
+@pytest.mark.parametrize('engine', ['simpy', 'heapq'])
+def test_same_seed_gives_same_day(config, G, corpus, engine):
+    config = dict(config, engine=engine)
+    results = [simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=3) for _ in range(2)]
+    assert results[0]['num_cust'] == results[1]['num_cust']
+    assert results[0]['exposure_times'] == results[1]['exposure_times']
+    assert results[0]['df_num_encounters_per_node'].equals(results[1]['df_num_encounters_per_node'])
+
+
+@pytest.mark.parametrize('engine', ['simpy', 'heapq'])
+def test_integral_exposure_accounting_equals_pairwise(config, G, corpus, engine):
+    config = dict(config, engine=engine, arrival_rate=6, traversal_time=2)
+    pairwise = simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=1)
+    integral = simulate_one_day(dict(config, exposure_accounting='integral'), G, paths_generator_from_actual_paths,
+                                [corpus], seed=1)
+    assert pairwise['total_exposure_time'] > 0
+    assert np.isclose(integral['total_exposure_time'], pairwise['total_exposure_time'])
+    assert np.allclose(integral['exposure_times'], pairwise['exposure_times'])
+    assert np.allclose(integral['df_exposure_time_per_node'], pairwise['df_exposure_time_per_node'])
+
+
+def test_unknown_engine(config, G, corpus):
+    with pytest.raises(ValueError, match='Unknown engine'):
+        simulate_one_day(dict(config, engine='foo'), G, paths_generator_from_actual_paths, [corpus], seed=0)
@@ -0,0 +1,93 @@
+import os
+import pickle
+
+import pytest
+
+from executors import InProcessExecutor, PoolExecutor, SocketExecutor
+from simulator import simulate_several_days
+from synthetic_path_gen import paths_generator_from_actual_paths
+
+
+def _square(x: int) -> int:
+    return x * x
+
+
+def _fail(x: int) -> int:
+    raise RuntimeError('Test error')
+
+
+# Set by _set_worker_value, the initializer of the runs of test_pool_is_kept_for_several_runs
+_worker_value = None
+
+
+def _set_worker_value(value: str):
+    global _worker_value
+    _worker_value = value
+
+
+def _get_worker_value(x: int) -> str:
+    return _worker_value
+
+
+def _run(config, G, corpus, **kwargs):
+    return simulate_several_days(config, G, paths_generator_from_actual_paths, [corpus], num_iterations=6, seed=0,
+                                 **kwargs)
+
+
+@pytest.fixture(scope='module')
+def socket_executor():
+    with SocketExecutor(('127.0.0.1', 0), num_local_workers=2, max_retries=1) as executor:
+        yield executor
+
+
+@pytest.mark.parametrize('executor_class', [InProcessExecutor, PoolExecutor])
+def test_imap_unordered(executor_class):
+    with executor_class() as executor:
+        executor.start()
+        assert sorted(executor.imap_unordered(_square, range(10), chunksize=3)) == [x * x for x in range(10)]
+
+
+def test_pool_is_kept_for_several_runs():
+    with PoolExecutor(2) as executor:
+        executor.start(_set_worker_value, ('first run',))
+        pool = executor.pool
+        assert set(executor.imap_unordered(_get_worker_value, range(8))) == {'first run'}
+        executor.finish()
+        executor.start(_set_worker_value, ('second run',))
+        assert executor.pool is pool
+        assert set(executor.imap_unordered(_get_worker_value, range(8))) == {'second run'}
+    assert executor.pool is None
+
+
+def test_pool_tasks_do_not_carry_the_initargs():
+    with PoolExecutor(2) as executor:
+        executor.start(_set_worker_value, ('x' * 1000000,))
+        assert len(pickle.dumps(executor._get_task_function(_get_worker_value))) < 1000
+        assert set(len(value) for value in executor.imap_unordered(_get_worker_value, range(8))) == {1000000}
+        init_file_path = executor.init_file_path
+        executor.finish()
+        assert not os.path.exists(init_file_path)
+
+
+def test_socket_executor_imap_unordered(socket_executor):
+    socket_executor.start()
+    assert sorted(socket_executor.imap_unordered(_square, range(10), chunksize=3)) == [x * x for x in range(10)]
+
+
+def test_socket_executor_gives_up_after_max_retries(socket_executor):
+    socket_executor.start()
+    with pytest.raises(RuntimeError, match='failed 2 times'):
+        list(socket_executor.imap_unordered(_fail, range(2)))
+
+
+def test_executors_give_the_same_results(config, G, corpus, socket_executor):
+    df_stats = _run(config, G, corpus).df_stats
+    assert df_stats.seed.is_unique
+    with PoolExecutor(2) as executor:
+        pool_results = _run(config, G, corpus, executor=executor)
+        # An executor can be used for several runs
+        pool_results_again = _run(config, G, corpus, executor=executor)
+    socket_results = _run(config, G, corpus, executor=socket_executor)
+    for results in [pool_results, pool_results_again, socket_results]:
+        assert results.df_stats.equals(df_stats)
+    assert _run(config, G, corpus, use_parallel=True).df_stats.equals(df_stats)
@@ -0,0 +1,46 @@
+import random
+
+import numpy as np
+
+from mean_field import estimate_one_day, get_calibration_report, get_corpus, screen_configs
+from sweep import make_config_grid
+from synthetic_path_gen import paths_generator_from_actual_paths
+
+
+def _random_paths(full_paths):
+    """Path generator that does not draw from a corpus (it has no all_paths)."""
+    while True:
+        yield full_paths[np.random.randint(len(full_paths))]
+
+
+def test_sampled_corpus_keeps_the_random_state_of_the_caller(full_paths):
+    random.seed(123)
+    np.random.seed(123)
+    expected = random.random(), np.random.rand()
+    random.seed(123)
+    np.random.seed(123)
+    corpus = get_corpus(_random_paths, [full_paths], num_sample_paths=200, seed=1)
+    assert (random.random(), np.random.rand()) == expected
+    assert len(corpus) == 200
+    assert list(corpus) == list(get_corpus(_random_paths, [full_paths], num_sample_paths=200, seed=1))
+
+
+def test_estimate_agrees_with_short_simulation(config, G, corpus):
+    report = get_calibration_report(config, G, paths_generator_from_actual_paths, [corpus], num_days=20)
+    for stat in ['num_cust', 'num_contacts', 'total_exposure_time', 'num_unique_visitors_per_node']:
+        assert abs(report.loc[stat, 'rel_error']) < 0.1, report.to_string()
+    assert (report['pearson'].dropna() > 0.95).all(), report.to_string()
+
+
+def test_screen_configs(config, G, corpus, full_paths):
+    configs = make_config_grid(config, {'arrival_rate': [1, 2, 4]})
+    layouts = {'original': (G, _random_paths, [full_paths])}
+    np.random.seed(5)
+    expected = np.random.rand()
+    np.random.seed(5)
+    df = screen_configs(configs, layouts)
+    assert np.random.rand() == expected
+    assert df.arrival_rate.tolist() == [1, 2, 4]
+    assert df.estimated_num_contacts.is_monotonic_increasing
+    estimate = estimate_one_day(configs[1], G, paths_generator_from_actual_paths, [corpus])
+    assert np.isclose(df.estimated_num_cust[1], estimate['num_cust'])
@@ -0,0 +1,100 @@
+import gc
+import pickle
+
+import numpy as np
+import pytest
+
+from core import StoreLayout
+from path_corpus import PathCorpus, PathCorpusWriter, SharedPathCorpus, load_path_corpus, save_path_corpus
+
+
+def test_from_paths(full_paths):
+    corpus = PathCorpus.from_paths(full_paths)
+    assert len(corpus) == len(full_paths)
+    assert list(corpus) == full_paths
+    assert corpus.nodes.dtype == np.uint8
+    assert np.array_equal(corpus.path_lengths(), [len(path) for path in full_paths])
+
+
+def test_node_dtype():
+    assert PathCorpus.from_paths([[0, 300, 0]]).nodes.dtype == np.uint16
+
+
+def test_save_and_load(tmp_path, corpus):
+    file_path = tmp_path / 'paths.corpus'
+    save_path_corpus(corpus, file_path)
+    loaded = load_path_corpus(file_path)
+    assert isinstance(loaded.nodes, np.memmap)
+    assert loaded.file_path == str(file_path)
+    assert list(loaded) == list(corpus)
+
+
+def test_save_and_load_empty_corpus(tmp_path):
+    file_path = tmp_path / 'empty.corpus'
+    save_path_corpus(PathCorpus.from_paths([]), file_path)
+    assert len(load_path_corpus(file_path)) == 0
+
+
+def test_load_rejects_other_files(tmp_path):
+    file_path = tmp_path / 'paths.json'
+    file_path.write_bytes(b'[[0, 1, 0]]'.ljust(64, b' '))
+    with pytest.raises(AssertionError, match='is not a path corpus file'):
+        load_path_corpus(file_path)
+
+
+def test_writer_equals_save(tmp_path, full_paths, corpus):
+    save_path_corpus(corpus, tmp_path / 'saved.corpus')
+    with PathCorpusWriter(tmp_path / 'written.corpus', max_node=int(corpus.nodes.max())) as writer:
+        for i in range(0, len(full_paths), 128):
+            writer.write(full_paths[i:i + 128])
+    assert (tmp_path / 'written.corpus').read_bytes() == (tmp_path / 'saved.corpus').read_bytes()
+    assert not (tmp_path / 'written.corpus.nodes.tmp').exists()
+
+
+def test_pickled_file_corpus_only_carries_its_path(tmp_path, corpus):
+    file_path = tmp_path / 'paths.corpus'
+    save_path_corpus(corpus, file_path)
+    loaded = load_path_corpus(file_path)
+    data = pickle.dumps(loaded)
+    assert len(data) < 1000
+    assert list(pickle.loads(data)) == list(corpus)
+
+
+def test_shared_corpus(corpus):
+    with SharedPathCorpus(corpus) as shared:
+        data = pickle.dumps(shared)
+        assert len(data) < 1000
+        attached = pickle.loads(data)
+        assert len(attached) == len(corpus)
+        assert attached[7] == corpus[7]
+        assert list(attached) == list(corpus)
+        with pytest.raises(AssertionError):
+            attached.unlink()
+
+
+def test_validate_paths(G, corpus):
+    layout = StoreLayout(G)
+    layout.validate_paths(corpus)
+    with pytest.raises(ValueError, match=r'0 -> 24 is not a valid transition in the graph! \(path 1\)'):
+        layout.validate_paths(PathCorpus.from_paths([[0, 1, 0], [0, 24, 0]]))
+
+
+def test_validated_corpora_are_not_kept_alive(G, full_paths):
+    layout = StoreLayout(G)
+    corpus = PathCorpus.from_paths(full_paths)
+    layout.validate_paths(corpus)
+    assert corpus in layout._validated_paths
+    del corpus
+    gc.collect()
+    assert len(layout._validated_paths) == 0
+    layout.validate_paths(full_paths)
+    assert pickle.loads(pickle.dumps(layout)).valid_next_nodes == layout.valid_next_nodes
+
+
+def test_rewritten_corpus_file_is_attached_again(tmp_path, corpus):
+    file_path = tmp_path / 'paths.corpus'
+    save_path_corpus(corpus, file_path)
+    data = pickle.dumps(load_path_corpus(file_path))
+    assert len(pickle.loads(data)) == len(corpus)
+    save_path_corpus(PathCorpus.from_paths(list(corpus)[:10]), file_path)
+    assert list(pickle.loads(data)) == list(corpus)[:10]
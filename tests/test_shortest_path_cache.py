@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pytest
+
+import shortest_path_cache
+from benchmarks import create_grid_market
+from shortest_path_cache import ShortestPathCache, compute_shortest_path_table, get_graph_fingerprint
+
+
+def test_fingerprint(G):
+    fingerprint = get_graph_fingerprint(G)
+    assert get_graph_fingerprint(create_grid_market(5, 5)) == fingerprint
+    assert get_graph_fingerprint(create_grid_market(5, 5, directed=True)) != fingerprint
+    G_fewer_edges = G.copy()
+    G_fewer_edges.remove_edge(0, 1)
+    assert get_graph_fingerprint(G_fewer_edges) != fingerprint
+    G_weighted = G.copy()
+    G_weighted.edges[0, 1]['weight'] = 2
+    assert get_graph_fingerprint(G_weighted) != fingerprint
+    G_moved = G.copy()
+    G_moved.nodes[0]['pos'] = (-1, -1)
+    assert get_graph_fingerprint(G_moved) != fingerprint
+
+
+def test_cache_hit(tmp_path, G, monkeypatch):
+    cache = ShortestPathCache(cache_dir=tmp_path)
+    table = cache.get(G)
+    assert cache.get(G) is table
+    expected = compute_shortest_path_table(G)
+    assert np.array_equal(table.pair_offsets, expected.pair_offsets)
+    assert list(table.paths) == list(expected.paths)
+
+    # A new cache loads the table from disk instead of computing it again
+    def compute_shortest_path_table_again(*args):
+        raise AssertionError('The table was computed again')
+    monkeypatch.setattr(shortest_path_cache, 'compute_shortest_path_table', compute_shortest_path_table_again)
+    loaded = ShortestPathCache(cache_dir=tmp_path).get(G)
+    assert isinstance(loaded.pair_offsets, np.memmap)
+    assert list(loaded.paths) == list(expected.paths)
+    with pytest.raises(AssertionError, match='computed again'):
+        ShortestPathCache(cache_dir=tmp_path).get(G, multiple_paths=False)
+
+
+def test_lru_eviction(tmp_path):
+    graphs = [create_grid_market(2, num_cols) for num_cols in (2, 3, 4)]
+    cache = ShortestPathCache(cache_dir=tmp_path, max_tables_in_memory=1, max_tables_on_disk=2)
+    entry_paths = [cache.get_entry_path(G) for G in graphs]
+    cache.get(graphs[0])
+    cache.get(graphs[1])
+    cache.get(graphs[0])  # graphs[1] is now the least recently used
+    cache.get(graphs[2])
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in entry_paths[::2])
+    assert list(cache.tables) == [entry_paths[2]]
+    cache.clear()
+    assert not os.path.exists(tmp_path)
@@ -0,0 +1,76 @@
+import pstats
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import instrumentation
+from results_collector import SimulationResults, per_node_stats
+from simulator import get_day_seeds, get_np_random_seed, simulate_days_batch, simulate_one_day, simulate_several_days
+from synthetic_path_gen import paths_generator_from_actual_paths
+
+
+def test_seeded_day_keeps_the_random_state_of_the_caller(config, G, corpus):
+    random.seed(123)
+    np.random.seed(123)
+    expected = random.random(), np.random.rand()
+    random.seed(123)
+    np.random.seed(123)
+    simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=0)
+    assert (random.random(), np.random.rand()) == expected
+
+
+def test_day_seeds():
+    day_seeds = get_day_seeds(100, seed=0)
+    assert day_seeds == get_day_seeds(100, seed=0)
+    assert day_seeds[:10] == get_day_seeds(10, seed=0)
+    assert len(set(day_seeds)) == 100
+    assert all(0 <= day_seed < 2 ** 63 for day_seed in day_seeds)
+    assert max(day_seeds) >= 2 ** 32
+
+
+def test_day_seeds_use_all_their_bits(config, G, corpus):
+    # Seeds that only differ above the lowest 32 bits give different days
+    days = [simulate_one_day(dict(config, arrival_rate=6), G, paths_generator_from_actual_paths, [corpus], seed=seed)
+            for seed in [5, 5 + 2 ** 32, 5 + 2 ** 40]]
+    assert len({tuple(day['exposure_times']) + (day['num_cust'],) for day in days}) == 3
+    assert days[1]['seed'] == 5 + 2 ** 32
+    assert np.array_equal(get_np_random_seed(5 + 2 ** 40), [5, 2 ** 8])
+
+
+def test_failed_day_stops_the_profiler(tmp_path, config, G, corpus):
+    with pytest.raises(ValueError, match='Unknown engine'):
+        simulate_one_day(dict(config, engine='foo', profile_dir=str(tmp_path)), G, paths_generator_from_actual_paths,
+                         [corpus], seed=0)
+    assert sys.getprofile() is None
+    assert len(list(tmp_path.glob('profile_*.pstats'))) == 1
+
+
+def test_profile_is_written_once_per_batch(tmp_path, config, G, corpus, monkeypatch):
+    dumps = []
+    dump_worker_profile = instrumentation.dump_worker_profile
+    monkeypatch.setattr(instrumentation, 'dump_worker_profile',
+                        lambda profile_dir: dumps.append(dump_worker_profile(profile_dir)))
+    simulate_days_batch(dict(config, profile_dir=str(tmp_path)), G, paths_generator_from_actual_paths, [corpus],
+                        n_days=4, seed=0)
+    assert sys.getprofile() is None
+    assert len(dumps) == 1
+    function_names = {function[2] for function in pstats.Stats(dumps[0]).stats}
+    assert '_simulate_one_day' in function_names
+
+
+def test_several_days_return_every_stat(tmp_path, config, G, corpus):
+    results = simulate_several_days(config, G, paths_generator_from_actual_paths, [corpus], num_iterations=3, seed=0)
+    assert isinstance(results, SimulationResults)
+    assert len(results.df_stats) == 3
+    assert results.df_stats.seed.tolist() == get_day_seeds(3, seed=0)
+    for stat in per_node_stats:
+        assert results.get_per_node(stat).shape == (3, len(G))
+    file_paths = simulate_several_days(config, G, paths_generator_from_actual_paths, [corpus], num_iterations=3,
+                                       seed=0, output_dir=tmp_path)
+    df_stats = pd.read_parquet(file_paths.df_stats).drop(columns='day')
+    assert df_stats.equals(results.df_stats.drop(columns='exposure_times'))
+    for stat in per_node_stats:
+        assert len(pd.read_parquet(file_paths.get_per_node(stat))) == 3
@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+import pytest
+import simpy
+
+import core
+from simulator import simulate_one_day
+from synthetic_path_gen import paths_generator_from_actual_paths
+from trace_sinks import load_trace
+
+# Results of seed 7 on the small market before the customers at a node were kept in ordered sets: num_cust,
+# num_contacts, total_exposure_time, encounters per node and exposure time per node
+baseline_scenarios = {
+    'pairwise': ({}, 714, 13114, 3246.461323,
+        [2635, 1774, 1227, 674, 139, 391, 517, 563, 514, 173, 295, 437, 403, 416, 150, 214, 403, 583, 490, 151,
+         96, 215, 347, 234, 73],
+        [630.635, 465.4393, 292.6473, 164.1364, 37.0372, 89.6603, 142.6056, 154.6036, 134.3123, 42.1525, 75.0264,
+         103.2017, 89.8985, 112.8352, 37.2235, 52.9397, 95.5103, 124.5667, 127.2866, 35.8541, 22.486, 52.4485,
+         87.8754, 59.2347, 16.8444]),
+    'integral': ({'exposure_accounting': 'integral'}, 714, 13114, 3246.461323,
+        [2635, 1774, 1227, 674, 139, 391, 517, 563, 514, 173, 295, 437, 403, 416, 150, 214, 403, 583, 490, 151,
+         96, 215, 347, 234, 73],
+        [630.635, 465.4393, 292.6473, 164.1364, 37.0372, 89.6603, 142.6056, 154.6036, 134.3123, 42.1525, 75.0264,
+         103.2017, 89.8985, 112.8352, 37.2235, 52.9397, 95.5103, 124.5667, 127.2866, 35.8541, 22.486, 52.4485,
+         87.8754, 59.2347, 16.8444]),
+    'capacity': ({'with_node_capacity': True, 'node_capacity': 3, 'arrival_rate': 2}, 241, 1409, 358.051434,
+        [279, 189, 156, 57, 7, 46, 81, 44, 51, 20, 27, 48, 37, 67, 15, 31, 49, 55, 35, 16, 9, 20, 48, 18, 4],
+        [69.5251, 47.0348, 45.0739, 13.7066, 0.9607, 13.032, 19.6373, 11.8178, 11.116, 4.2342, 6.3003, 9.072,
+         9.505, 18.0405, 3.4034, 9.066, 13.9385, 15.7159, 9.0639, 4.8026, 2.178, 4.4699, 11.7543, 3.5408, 1.062]),
+    'heapq': ({'engine': 'heapq'}, 702, 12782, 3094.661435,
+        [2568, 1725, 1246, 621, 190, 376, 454, 595, 456, 172, 303, 408, 438, 402, 148, 226, 409, 556, 443, 151,
+         87, 205, 305, 248, 50],
+        [590.4869, 410.9783, 312.9255, 146.2767, 55.1, 86.5178, 104.8651, 141.3121, 120.835, 35.2353, 79.3446,
+         94.3, 117.4894, 101.2921, 39.2764, 58.8288, 108.6621, 121.8892, 113.2355, 34.379, 28.3453, 49.874,
+         64.2277, 67.3778, 11.607]),
+}
+
+
+@pytest.mark.parametrize('scenario', list(baseline_scenarios))
+def test_contacts_and_exposure_equal_baseline(config, G, corpus, scenario):
+    extra_config, num_cust, num_contacts, total_exposure_time, encounters, exposure_times = baseline_scenarios[scenario]
+    config = dict(config, **dict({'arrival_rate': 6}, **extra_config))
+    results = simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=7)
+    assert results['num_cust'] == num_cust
+    assert results['num_contacts'] == num_contacts
+    assert results['total_exposure_time'] == pytest.approx(total_exposure_time, abs=1e-6)
+    assert results['df_num_encounters_per_node'].to_numpy().ravel().tolist() == encounters
+    assert np.allclose(results['df_exposure_time_per_node'].to_numpy().ravel(), exposure_times, atol=1e-4)
+
+
+def test_unique_visitors_equal_brute_force_count(tmp_path, config, G, corpus):
+    config = dict(config, trace='binary', trace_dir=str(tmp_path), trace_run_id='unique')
+    results = simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=3)
+    records = load_trace(tmp_path, 'unique')
+    assert len(records) == results['num_cust']
+    num_unique_visitors = np.zeros(len(G), dtype=np.int64)
+    for path_index in records['path_index']:
+        num_unique_visitors[list(set(corpus[path_index]))] += 1
+    assert results['df_num_unique_visitors_per_node'].to_numpy().ravel().tolist() == num_unique_visitors.tolist()
+
+
+@pytest.mark.parametrize('engine', ['simpy', 'heapq'])
+def test_crowding_and_capacity_per_node(config, G, corpus, engine):
+    config = dict(config, engine=engine, arrival_rate=4)
+    results = simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=2)
+    time_crowded = results['df_time_crowded_per_node'].to_numpy().ravel()
+    assert time_crowded.sum() > 0
+    assert (time_crowded <= results['store_open_length']).all()
+    assert np.isclose(time_crowded.sum(), results['total_time_crowded'])
+    # Without node capacity, no node is ever full and no move is blocked
+    assert (results['df_time_at_capacity_per_node'].to_numpy() == 0).all()
+    assert (results['df_num_blocked_moves_per_node'].to_numpy() == 0).all()
+
+    # A node is at capacity exactly when it is crowded if the capacity equals the crowding threshold
+    config = dict(config, with_node_capacity=True, node_capacity=4, crowded_thres=4)
+    results = simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=2)
+    time_at_capacity = results['df_time_at_capacity_per_node'].to_numpy().ravel()
+    assert (time_at_capacity <= results['store_open_length']).all()
+    assert np.allclose(time_at_capacity, results['df_time_crowded_per_node'].to_numpy().ravel())
+    assert results['df_num_blocked_moves_per_node'].to_numpy().sum() > 0
+
+
+def test_occupancy_trace_matches_customers_at_nodes(config, G, full_paths):
+    random.seed(1)
+    np.random.seed(1)
+    env = simpy.Environment()
+    store = core.Store(env, G, max_customers_in_store=15)
+    store.enable_node_capacity(2)
+    samples = []
+
+    def sample_occupancy():
+        while True:
+            yield env.timeout(0.37)
+            samples.append((env.now, sum(len(customers) for customers in store.customers_at_nodes.values())))
+
+    env.process(core._customer_arrivals(env, store, paths_generator_from_actual_paths(full_paths),
+                                        dict(config, arrival_rate=4)))
+    env.process(sample_occupancy())
+    env.run(until=config['num_hours_open'] * 60 * 2)
+    times, counts = store.get_occupancy_trace()
+    assert np.all(np.diff(times) >= 0)
+    assert counts.max() == 15
+    assert [counts[np.searchsorted(times, t, side='right') - 1] for t, _ in samples] == [n for _, n in samples]
+    assert counts[-1] == 0
+    # Node capacity lets customers swap places (and does not limit the entrance), so it does not bound the number of
+    # customers at a node; max_customers_in_store bounds the number in the store
+    assert max(n for _, n in samples) <= 15
+    mean_num_customers = np.sum(counts[:-1] * np.diff(times)) / store.get_open_length()
+    assert np.isclose(store.get_mean_num_customers_in_store(), mean_num_customers)
@@ -0,0 +1,43 @@
+import itertools
+
+from executors import InProcessExecutor
+from sweep import iter_sweep, make_config_grid, run_sweep
+from synthetic_path_gen import paths_generator_from_actual_paths
+
+
+class _CountingExecutor(InProcessExecutor):
+    """Records the (config_index, day) of every day that is run."""
+
+    def __init__(self):
+        self.days_run = []
+
+    def imap_unordered(self, function, tasks, chunksize=1):
+        for task in tasks:
+            config_index, _, days = task[:3]
+            self.days_run.extend((config_index, day) for day in days)
+            yield function(task)
+
+
+def test_resumed_sweep_only_runs_the_missing_days(tmp_path, config, G, corpus):
+    configs = make_config_grid(config, {'arrival_rate': [1, 2]})
+    layouts = {'original': (G, paths_generator_from_actual_paths, [corpus])}
+    kwargs = dict(num_replications=5, seed=0, tasks_per_chunk=2)
+    expected = run_sweep(configs, layouts, executor=InProcessExecutor(), **kwargs)
+
+    # Interrupt the sweep after 3 days
+    interrupted = iter_sweep(configs, layouts, checkpoint_dir=tmp_path, executor=InProcessExecutor(), **kwargs)
+    done = {(config_index, day) for config_index, day, _ in itertools.islice(interrupted, 3)}
+    interrupted.close()
+
+    executor = _CountingExecutor()
+    results = run_sweep(configs, layouts, checkpoint_dir=tmp_path, executor=executor, **kwargs)
+    all_days = {(config_index, day) for config_index in range(2) for day in range(5)}
+    assert sorted(executor.days_run) == sorted(all_days - done)
+    for config_results, expected_results in zip(results, expected):
+        for name in expected_results._fields:
+            assert getattr(config_results, name).equals(getattr(expected_results, name)), name
+
+    # A finished sweep only reads the checkpoint
+    executor = _CountingExecutor()
+    run_sweep(configs, layouts, checkpoint_dir=tmp_path, executor=executor, **kwargs)
+    assert executor.days_run == []
@@ -0,0 +1,107 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from core import StoreLayout
+from path_corpus import PathCorpus
+from shortest_path_cache import compute_shortest_path_table
+from synthetic_path_gen import (CorpusPathGenerator, TransitionTable, generate_synthetic_corpus,
+                                get_default_corpus_name, get_transition_matrix, path_generator_from_transition_matrix,
+                                sythetic_paths_generator, synthetic_paths_stream)
+
+mu = 0.07
+sigma = 0.76
+entrance_nodes = [0, 4]
+exit_nodes = [20, 24]
+item_nodes = list(range(5, 20))
+
+
+@pytest.fixture
+def shortest_path_table(G):
+    return compute_shortest_path_table(G)
+
+
+def _generate_corpus(shortest_path_table, num_paths, seed):
+    np.random.seed(seed)
+    return generate_synthetic_corpus(mu, sigma, entrance_nodes, exit_nodes, item_nodes, shortest_path_table,
+                                     num_paths)
+
+
+def test_synthetic_corpus_has_valid_paths(G, shortest_path_table):
+    corpus = _generate_corpus(shortest_path_table, 2000, seed=1)
+    assert len(corpus) == 2000
+    StoreLayout(G).validate_paths(corpus)
+    for path in corpus:
+        assert path[0] in entrance_nodes
+        assert path[-1] in exit_nodes
+    assert list(corpus) == list(_generate_corpus(shortest_path_table, 2000, seed=1))
+    assert list(corpus) != list(_generate_corpus(shortest_path_table, 2000, seed=2))
+
+
+def test_synthetic_corpus_equals_sythetic_paths_generator(G, shortest_path_table):
+    from covid19_supermarket_abm.utils.create_synthetic_baskets import get_all_shortest_path_dicts
+
+    corpus = _generate_corpus(shortest_path_table, 500, seed=3)
+    np.random.seed(3)
+    paths = sythetic_paths_generator(mu, sigma, entrance_nodes, exit_nodes, item_nodes,
+                                     get_all_shortest_path_dicts(G), batch_size=500)
+    assert list(corpus) == [[int(node) for node in path] for path in paths]
+
+
+def test_synthetic_paths_stream(G, shortest_path_table):
+    np.random.seed(4)
+    paths = list(itertools.islice(synthetic_paths_stream(mu, sigma, entrance_nodes, exit_nodes, item_nodes,
+                                                         shortest_path_table, batch_size=64), 200))
+    StoreLayout(G).validate_paths(PathCorpus.from_paths(paths))
+
+
+def test_corpus_path_generator_records_last_index(corpus):
+    np.random.seed(5)
+    path_generator = CorpusPathGenerator(corpus)
+    assert path_generator.last_index == -1
+    indices = set()
+    for path in itertools.islice(path_generator, 200):
+        assert path == corpus[path_generator.last_index]
+        indices.add(path_generator.last_index)
+    assert len(indices) > 100
+
+
+def test_transition_table_equals_transition_matrix(G, full_paths):
+    transition_table = TransitionTable.from_paths(full_paths, len(G))
+    tmatrix = get_transition_matrix(full_paths, len(G))
+    assert np.allclose(transition_table.to_matrix(), tmatrix)
+    assert np.allclose(TransitionTable.from_matrix(tmatrix).to_matrix(), tmatrix)
+
+
+def test_sampled_zone_paths_follow_the_transitions(G, full_paths):
+    transition_table = TransitionTable.from_paths(full_paths, len(G))
+    tmatrix = transition_table.to_matrix()
+    np.random.seed(6)
+    zone_paths = transition_table.sample_zone_paths(1000)
+    assert len(zone_paths) == 1000
+    for zone_path in zone_paths:
+        assert zone_path[0] == 0
+        assert all(tmatrix[i, j] > 0 for i, j in zip(zone_path, zone_path[1:]))
+        assert tmatrix[zone_path[-1], len(G)] > 0
+    assert len(G) not in zone_paths.nodes
+
+
+def test_transition_matrix_generator_has_valid_paths(G, full_paths, shortest_path_table):
+    tmatrix = get_transition_matrix(full_paths, len(G))
+    np.random.seed(7)
+    paths = list(itertools.islice(path_generator_from_transition_matrix(tmatrix, shortest_path_table, batch_size=64),
+                                  500))
+    StoreLayout(G).validate_paths(PathCorpus.from_paths(paths))
+    # Chains that end right after the start state have no legs, so their full paths are empty
+    assert all(path[0] == 0 for path in paths if len(path) > 0)
+
+
+def test_default_corpus_names():
+    names = {(layout, directed): get_default_corpus_name(layout, directed)
+             for layout in ['original', 'oneway'] for directed in [False, True]}
+    assert names[('original', False)] == '10_6'
+    assert names[('oneway', True)] == '10^6_DIRECTIONAL'
+    assert len(set(names.values())) == 4
+    with pytest.raises(ValueError, match='Unknown layout == foo'):
+        get_default_corpus_name('foo')
@@ -0,0 +1,68 @@
+import os
+
+import pandas as pd
+import pytest
+
+from simulator import get_day_seeds, simulate_one_day, simulate_several_days
+from sweep import make_config_grid, run_sweep
+from synthetic_path_gen import paths_generator_from_actual_paths
+from trace_sinks import NullTraceSink, create_trace_sink, load_trace
+
+
+def _run(config, G, corpus, **kwargs):
+    return simulate_several_days(config, G, paths_generator_from_actual_paths, [corpus], num_iterations=4, seed=0,
+                                 **kwargs)
+
+
+def test_trace_is_off_by_default():
+    assert type(create_trace_sink({})) is NullTraceSink
+    with pytest.raises(ValueError, match='Unknown trace'):
+        create_trace_sink({'trace': 'foo'})
+
+
+@pytest.mark.parametrize('use_parallel', [False, True])
+def test_binary_trace_files_of_runs_are_kept_apart(tmp_path, config, G, corpus, use_parallel):
+    config = dict(config, trace='binary', trace_dir=str(tmp_path))
+    df_stats = _run(config, G, corpus, use_parallel=use_parallel).df_stats
+    _run(dict(config, trace_run_id='second'), G, corpus, use_parallel=use_parallel)
+    second = load_trace(tmp_path, 'second')
+    assert len(second) == df_stats.num_cust.sum()
+    assert sorted(set(second['day'])) == list(range(4))
+    assert (second['path_index'] >= 0).all()
+    assert len(load_trace(tmp_path)) == 2 * len(second)
+    assert len(os.listdir(tmp_path)) >= 2
+
+
+def test_text_trace_is_written_per_run(tmp_path, config, G, corpus):
+    config = dict(config, trace='text', trace_dir=str(tmp_path))
+    df_stats = _run(config, G, corpus).df_stats
+    _run(config, G, corpus)
+    file_names = os.listdir(tmp_path)
+    assert len(file_names) == 2
+    for file_name in file_names:
+        lines = (tmp_path / file_name).read_text().splitlines()
+        assert lines.count('Market closed.') == 4
+        assert len(lines) == df_stats.num_cust.sum() + 4
+
+
+@pytest.mark.parametrize('use_parallel', [False, True])
+def test_path_index_counts_reach_the_caller(config, G, corpus, use_parallel):
+    config = dict(config, trace='counter')
+    df_stats = _run(config, G, corpus, use_parallel=use_parallel).df_stats
+    counts = df_stats.attrs['path_index_counts']
+    assert counts.sum() == df_stats.num_cust.sum()
+    assert counts.index.min() >= 0 and counts.index.max() < len(corpus)
+    day = simulate_one_day(config, G, paths_generator_from_actual_paths, [corpus], seed=get_day_seeds(4, seed=0)[2])
+    assert (counts.loc[list(day['path_index_counts'])] >= list(day['path_index_counts'].values())).all()
+
+
+def test_path_index_counts_of_sweeps_and_output_dirs(tmp_path, config, G, corpus):
+    configs = make_config_grid(dict(config, trace='counter'), {'arrival_rate': [1, 2]})
+    layouts = {'original': (G, paths_generator_from_actual_paths, [corpus])}
+    results = run_sweep(configs, layouts, num_replications=3, seed=0, use_parallel=False)
+    for config_results in results:
+        df_stats = config_results.df_stats
+        assert df_stats.attrs['path_index_counts'].sum() == df_stats.num_cust.sum()
+    run_sweep(configs, layouts, num_replications=3, seed=0, use_parallel=False, output_dir=tmp_path)
+    df_counts = pd.read_parquet(tmp_path / 'config_1' / 'path_index_counts.parquet')
+    assert df_counts.set_index('path_index')['count'].equals(results[1].df_stats.attrs['path_index_counts'])
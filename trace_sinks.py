@@ -0,0 +1,158 @@
+"""Trace sinks record which path every customer that enters the store walks.
+
+A sink is created for every simulated day (see create_trace_sink) and receives one record(customer_id, path_index,
+path) call per admitted customer, where path_index is the index of the path in the corpus it was drawn from (or -1 if
+the path generator does not draw from a corpus). close() is called at the end of the day.
+Set the sink with the 'trace' key of the config:
+
+- 'off' (default): do not record anything.
+- 'text': append the paths as text to trace_dir/buyer_paths_<run id>_<worker>.txt, followed by a 'Market closed.'
+  line after every day.
+- 'binary': append (day, customer_id, path_index) records to trace_dir/trace_<run id>_<worker>.bin (see load_trace).
+- 'counter': only count how often every path index is used. The counts are in results['path_index_counts'].
+
+The files are written by one process each (<worker> is the host name and process id), so days of different workers
+never interleave. Every run of simulate_several_days, simulate_until_converged or a sweep gets a new run id, which is
+logged (set 'trace_run_id' in the config to choose it), so files of earlier runs are never appended to, even when a
+process id is reused. Days simulated directly with simulate_one_day use one run id per process.
+"""
+import glob
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import Counter
+from typing import List, Optional, Union
+
+import numpy as np
+
+trace_record_dtype = np.dtype([('day', '<u4'), ('customer_id', '<u4'), ('path_index', '<i8')])
+
+# Run id of the days that are simulated without one in their config, set by get_trace_file_name
+_process_run_id: Optional[str] = None
+
+
+def new_trace_run_id() -> str:
+    return f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+
+
+def with_trace_run_id(config: dict) -> dict:
+    """config with a new 'trace_run_id' if it writes trace files and does not have one yet."""
+    if config.get('trace', 'off') not in ['text', 'binary'] or 'trace_run_id' in config:
+        return config
+    run_id = new_trace_run_id()
+    logging.info(f'Writing the trace of this run to {config.get("trace_dir", "traces")} with run id {run_id}.')
+    return dict(config, trace_run_id=run_id)
+
+
+def get_trace_file_name(prefix: str, run_id: Optional[str], extension: str) -> str:
+    """<prefix>_<run id>_<host name>_<process id>.<extension>"""
+    global _process_run_id
+    if run_id is None:
+        if _process_run_id is None:
+            _process_run_id = new_trace_run_id()
+        run_id = _process_run_id
+    return f'{prefix}_{run_id}_{socket.gethostname()}_{os.getpid()}.{extension}'
+
+
+class NullTraceSink(object):
+    """Records nothing."""
+
+    def record(self, customer_id: int, path_index: int, path: List[int]):
+        pass
+
+    def close(self):
+        pass
+
+    def get_results(self) -> dict:
+        """Entries to add to the results of the day."""
+        return {}
+
+
+class TextTraceSink(NullTraceSink):
+    """Appends every path as text to trace_dir/buyer_paths_<run id>_<worker>.txt, followed by 'Market closed.' at the
+    end of the day."""
+
+    def __init__(self, trace_dir: Union[str, os.PathLike] = 'traces', run_id: Optional[str] = None):
+        os.makedirs(trace_dir, exist_ok=True)
+        self.file_path = os.path.join(trace_dir, get_trace_file_name('buyer_paths', run_id, 'txt'))
+        self.lines = []
+
+    def record(self, customer_id: int, path_index: int, path: List[int]):
+        self.lines.append(f'{path}')
+
+    def close(self):
+        self.lines.append('Market closed.')
+        with open(self.file_path, 'a') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        self.lines = []
+
+
+class BinaryTraceSink(NullTraceSink):
+    """Appends (day, customer_id, path_index) records to trace_dir/trace_<run id>_<worker>.bin.
+
+    At most buffer_size records are kept in memory before they are written.
+    """
+
+    def __init__(self, day: int, trace_dir: Union[str, os.PathLike] = 'traces', run_id: Optional[str] = None,
+                 buffer_size: int = 65536):
+        self.day = day
+        os.makedirs(trace_dir, exist_ok=True)
+        self.file_path = os.path.join(trace_dir, get_trace_file_name('trace', run_id, 'bin'))
+        self.buffer = np.zeros(buffer_size, dtype=trace_record_dtype)
+        self.buffer['day'] = day
+        self.num_buffered = 0
+
+    def record(self, customer_id: int, path_index: int, path: List[int]):
+        self.buffer['customer_id'][self.num_buffered] = customer_id
+        self.buffer['path_index'][self.num_buffered] = path_index
+        self.num_buffered += 1
+        if self.num_buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        with open(self.file_path, 'ab') as f:
+            f.write(self.buffer[:self.num_buffered].tobytes())
+        self.num_buffered = 0
+
+    def close(self):
+        if self.num_buffered > 0:
+            self.flush()
+
+
+class CounterTraceSink(NullTraceSink):
+    """Counts how often every path index is used."""
+
+    def __init__(self):
+        self.path_index_counts = Counter()
+
+    def record(self, customer_id: int, path_index: int, path: List[int]):
+        self.path_index_counts[path_index] += 1
+
+    def get_results(self) -> dict:
+        return {'path_index_counts': self.path_index_counts}
+
+
+def create_trace_sink(config: dict, day: int = 0) -> NullTraceSink:
+    """Create the trace sink that the config asks for (see the module docstring)."""
+    trace = config.get('trace', 'off')
+    if trace == 'text':
+        return TextTraceSink(config.get('trace_dir', 'traces'), config.get('trace_run_id', None))
+    elif trace == 'binary':
+        return BinaryTraceSink(day, config.get('trace_dir', 'traces'), config.get('trace_run_id', None))
+    elif trace == 'counter':
+        return CounterTraceSink()
+    elif trace == 'off':
+        return NullTraceSink()
+    else:
+        raise ValueError(f'Unknown trace == {trace}')
+
+
+def load_trace(trace_dir: Union[str, os.PathLike] = 'traces', run_id: Optional[str] = None) -> np.ndarray:
+    """Read the records of the binary trace files of run_id (default: all runs) in trace_dir, sorted by day and
+    customer_id."""
+    file_paths = sorted(glob.glob(os.path.join(trace_dir, f'trace_{glob.escape(run_id) if run_id else "*"}_*.bin')))
+    records = np.concatenate([np.fromfile(file_path, dtype=trace_record_dtype) for file_path in file_paths]
+                             or [np.zeros(0, dtype=trace_record_dtype)])
+    return records[np.lexsort((records['customer_id'], records['day']))]
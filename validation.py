@@ -0,0 +1,87 @@
+"""Seeded statistical equivalence checks between the simulation engines.
+
+The SimPy engine and the event kernel draw random numbers in a different order, so single days differ. Instead, we run
+the same seeds on both engines and check that the mean of every statistic agrees within a few standard errors.
+Run from the command line, e.g. `python validation.py --days 200`. tests/test_engines.py runs the same check on a small
+market with a few days.
+"""
+import argparse
+from typing import List, Optional
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from simulator import simulate_one_day
+
+stats_to_compare = ['num_cust', 'num_S', 'num_I', 'num_contacts', 'num_cust_w_contact', 'total_exposure_time',
+                    'mean_num_cust_in_store', 'max_num_cust_in_store', 'mean_shopping_time', 'num_waiting_people',
+                    'mean_waiting_time', 'total_time_crowded']
+
+
+def run_seeded_days(config: dict, G: nx.Graph, path_generator_function, path_generator_args: list,
+                    num_days: int, seed: int = 0) -> pd.DataFrame:
+    """Run num_days days with seeds seed, seed + 1, ..."""
+    rows = []
+    for day in range(num_days):
+        results = simulate_one_day(config, G, path_generator_function, path_generator_args, seed=seed + day)
+        rows.append({stat: results[stat] for stat in stats_to_compare})
+    return pd.DataFrame(rows)
+
+
+def compare_engines(config: dict, G: nx.Graph, path_generator_function, path_generator_args: list,
+                    num_days: int = 100, seed: int = 0, z_thres: float = 4,
+                    engines: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Compare the statistics of two engines on the same seeds.
+
+    :param config: Simulation config (the 'engine' key is overwritten)
+    :param num_days: Number of days to simulate per engine
+    :param seed: Seed of the first day
+    :param z_thres: A statistic passes if the difference of means is less than z_thres standard errors
+    :param engines: Engines to compare (default: ['simpy', 'heapq'])
+    :return: Dataframe with one row per statistic
+    """
+    if engines is None:
+        engines = ['simpy', 'heapq']
+    engine_a, engine_b = engines
+    df_a = run_seeded_days(dict(config, engine=engine_a), G, path_generator_function, path_generator_args,
+                           num_days, seed)
+    df_b = run_seeded_days(dict(config, engine=engine_b), G, path_generator_function, path_generator_args,
+                           num_days, seed)
+    std_error = np.sqrt(df_a.var() / num_days + df_b.var() / num_days)
+    difference = df_b.mean() - df_a.mean()
+    # Statistics that are constant on both engines (e.g. no queue) only pass if they are equal
+    z = (difference / std_error).where(std_error > 0, np.where(difference == 0, 0, np.inf))
+    return pd.DataFrame({f'mean_{engine_a}': df_a.mean(),
+                         f'mean_{engine_b}': df_b.mean(),
+                         'std_error': std_error,
+                         'z': z,
+                         'passed': z.abs() < z_thres})
+
+
+if __name__ == '__main__':
+    from benchmarks import create_grid_market, create_random_full_paths, paths_generator_from_list
+
+    parser = argparse.ArgumentParser(description='Compare the SimPy engine with the event kernel')
+    parser.add_argument('--days', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    G = create_grid_market(10, 10)
+    full_paths = create_random_full_paths(G, 2000, seed=args.seed)
+    base_config = {'arrival_rate': 2.88, 'traversal_time': 0.49, 'num_hours_open': 12, 'infection_proportion': 0.128}
+    scenarios = {'default': {},
+                 'node capacity': {'with_node_capacity': True, 'node_capacity': 4},
+                 'node capacity (event wakeup)': {'with_node_capacity': True, 'node_capacity': 4,
+                                                  'capacity_wakeup': 'event'},
+                 'queueing': {'max_customers_in_store': 30, 'arrival_rate': 6},
+                 }
+    all_passed = True
+    for name, scenario in scenarios.items():
+        df = compare_engines(dict(base_config, **scenario), G, paths_generator_from_list, [full_paths],
+                             num_days=args.days, seed=args.seed)
+        print(f'\n{name}')
+        print(df.to_string())
+        all_passed = all_passed and df.passed.all()
+    print('\nAll statistics agree.' if all_passed else '\nSome statistics do NOT agree.')